@@ -0,0 +1,100 @@
+"""Benchmark of broadcasting a large message with
+``ConnectionsManager.send_message(..., ALL)``.
+
+A 1 MB payload is broadcast to 16 local stand-in Multiplexer servers. For
+every send the benchmark reports the time until all outgoing buffers are
+flushed and the number of bytes copied, i.e. the total length of all distinct
+buffers produced by serialization and framing (buffers referenced by many
+channel queues are counted once).
+
+Run from the source root::
+
+    PYTHONPATH=. python bench/broadcast.py
+"""
+
+from __future__ import with_statement
+
+import time
+from contextlib import closing, nested
+from timeit import default_timer
+
+from pymx.client import Client
+from pymx.connection import ConnectionsManager
+from pymx.future import wait_all
+from pymx.message import MultiplexerMessage
+
+from test.testlib_mxserver import StandInMxServerThread, \
+        create_mx_server_context
+
+SERVERS = 16
+PAYLOAD = 1024 * 1024
+SENDS = 20
+
+class _CopyCounter(object):
+
+    def __init__(self):
+        object.__init__(self)
+        self.seen = {}
+
+    def wrap(self, fifo):
+        put = fifo.put
+        def counting_put(chunk):
+            self.seen[id(chunk)] = (chunk, len(chunk))
+            put(chunk)
+        fifo.put = fifo.append = counting_put
+
+    def serialize_wrapper(self, serialize):
+        def counting_serialize(message):
+            serialized = serialize(message)
+            self.seen[id(serialized)] = (serialized, len(serialized))
+            return serialized
+        return counting_serialize
+
+    def pop(self):
+        copied = sum(length for _, length in self.seen.itervalues())
+        self.seen.clear()
+        return copied
+
+def _flushed(channels):
+    return not any(len(channel._outgoing_buffer) for channel in channels)
+
+def main():
+    servers = [create_mx_server_context(impl=StandInMxServerThread)
+            for _ in xrange(SERVERS)]
+    with nested(*servers) as servers:
+        with closing(Client(type=317)) as client:
+            manager = client._manager
+            wait_all(timeout=5, *[client.connect(server.server_address)
+                for server in servers])
+            channels = list(manager._all_channels)
+            assert len(channels) == SERVERS
+
+            counter = _CopyCounter()
+            for channel in channels:
+                counter.wrap(channel._outgoing_buffer)
+            serialize = MultiplexerMessage.SerializeToString
+            MultiplexerMessage.SerializeToString = \
+                    counter.serialize_wrapper(serialize)
+            try:
+                message = client.create_message(type=0, message='x' * PAYLOAD)
+                elapsed = []
+                copied = []
+                for _ in xrange(SENDS):
+                    counter.pop()
+                    start = default_timer()
+                    client.send_message(message, ConnectionsManager.ALL).wait(5)
+                    while not _flushed(channels):
+                        time.sleep(0.0005)
+                    elapsed.append(default_timer() - start)
+                    copied.append(counter.pop())
+            finally:
+                MultiplexerMessage.SerializeToString = serialize
+
+    print "broadcast of %d bytes to %d channels" % (PAYLOAD, SERVERS)
+    print "  time per send:         %8.2f ms (best), %8.2f ms (avg)" % (
+            min(elapsed) * 1000, sum(elapsed) / len(elapsed) * 1000)
+    print "  bytes copied per send: %8d (%.2f x payload)" % (
+            max(copied), max(copied) / float(PAYLOAD))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Micro-benchmark of frame extraction paths.
+
+Compares the generator based `Deframer.push` with `BufferDeframer.push`, the
+batched `BufferDeframer.push_many` and ``recv_into`` + ``pop_frames`` used by
+`Channel.handle_read`. The input stream is fed in chunks of
+``Channel.read_buffer`` bytes, as the IO thread would receive it.
+
+Run from the source root::
+
+    PYTHONPATH=. python bench/deframer.py
+"""
+
+import sys
+from timeit import default_timer
+
+from pymx.channel import Channel
+from pymx.frame import Deframer, BufferDeframer, create_frame
+
+FRAME_SIZES = (16, 64, 256, 1024, 4096, 65536, 1024 * 1024)
+STREAM_BYTES = 16 * 1024 * 1024
+REPEAT = 3
+
+def _chunks(stream, chunk_length=Channel.read_buffer):
+    return [stream[i:i + chunk_length] for i in xrange(0, len(stream),
+        chunk_length)]
+
+def _generator_path(deframer_factory):
+    def _run(chunks):
+        deframer = deframer_factory()
+        count = 0
+        for chunk in chunks:
+            for contents in deframer.push(chunk):
+                count += 1
+        return count
+    return _run
+
+def _batch_path(chunks):
+    deframer = BufferDeframer()
+    count = 0
+    for chunk in chunks:
+        count += len(deframer.push_many(chunk))
+    return count
+
+def _recv_into_path(chunks):
+    deframer = BufferDeframer()
+    pending = iter(chunks)
+    def recv_into(buffer, nbytes):
+        # stands in for the kernel copying socket data
+        chunk = next(pending, '')
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+    count = 0
+    while deframer.recv_into(recv_into, Channel.read_buffer):
+        count += len(deframer.pop_frames())
+    return count
+
+PATHS = (
+        ('Deframer.push', _generator_path(Deframer)),
+        ('BufferDeframer.push', _generator_path(BufferDeframer)),
+        ('BufferDeframer.push_many', _batch_path),
+        ('BufferDeframer.recv_into', _recv_into_path),
+    )
+
+def main():
+    print "%10s %-26s %12s %12s" % ('frame', 'path', 'frames/s', 'MiB/s')
+    for size in FRAME_SIZES:
+        frame = create_frame('x' * size)
+        count = max(STREAM_BYTES // len(frame), 1)
+        chunks = _chunks(frame * count)
+        for name, path in PATHS:
+            best = None
+            for _ in xrange(REPEAT):
+                start = default_timer()
+                assert path(chunks) == count
+                elapsed = default_timer() - start
+                best = min(best or elapsed, elapsed)
+            print "%10d %-26s %12.0f %12.1f" % (size, name, count / best,
+                    count * len(frame) / best / 2 ** 20)
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
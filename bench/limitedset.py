@@ -0,0 +1,60 @@
+"""Benchmark of message deduplication sets.
+
+Compares `LimitedSet` with `CompactLimitedSet` (the `MessageIdSet` used by
+`ConnectionsManager`) and the approximate `RotatingBloomFilter`: memory taken
+by a full set of random 64-bit message IDs (containers and element objects,
+as reported by ``sys.getsizeof``) and the throughput of `add` of new IDs,
+which evicts the oldest one.
+
+Run from the source root::
+
+    PYTHONPATH=. python bench/limitedset.py [CAPACITY...]
+"""
+
+import sys
+from random import Random
+from timeit import default_timer
+
+from pymx.limitedset import LimitedSet, CompactLimitedSet, \
+        RotatingBloomFilter
+
+CAPACITIES = (20000, 1000000)
+ADDS = 1000000
+
+def _sizeof_limitedset(ls):
+    return sys.getsizeof(ls._elements) + sys.getsizeof(ls._recent) + \
+            sum(sys.getsizeof(x) for x in ls._elements)
+
+def _sizeof_compactlimitedset(ls):
+    return sys.getsizeof(ls._table) + sys.getsizeof(ls._ring)
+
+def _sizeof_rotatingbloomfilter(bf):
+    return sys.getsizeof(bf._current) + sys.getsizeof(bf._previous)
+
+IMPLEMENTATIONS = (
+    ('LimitedSet', LimitedSet, _sizeof_limitedset),
+    ('CompactLimitedSet', CompactLimitedSet, _sizeof_compactlimitedset),
+    ('RotatingBloomFilter', RotatingBloomFilter,
+        _sizeof_rotatingbloomfilter),
+)
+
+def main(capacities=CAPACITIES):
+    rand = Random(0)
+    for capacity in capacities:
+        ids = [rand.getrandbits(64) for _ in xrange(capacity + ADDS)]
+        print "capacity %d, %d adds" % (capacity, ADDS)
+        for name, factory, sizeof in IMPLEMENTATIONS:
+            ls = factory(capacity)
+            add = ls.add
+            for x in ids[:capacity]:
+                add(x)
+            size = sizeof(ls)
+            start = default_timer()
+            for x in ids[capacity:]:
+                add(x)
+            elapsed = default_timer() - start
+            print "  %-20s %6.1f bytes/id %10.0f adds/s" % (name,
+                    float(size) / capacity, ADDS / elapsed)
+
+if __name__ == '__main__':
+    main(map(int, sys.argv[1:]) or CAPACITIES)
@@ -0,0 +1,100 @@
+"""Benchmark of many threads querying through a single `Client`.
+
+64 threads issue queries through one `pymx.client.Client` to an echo backend
+(`pymx.aiobackend.MultiplexerBackend` running in its own thread) behind a
+local stand-in Multiplexer server. Two ways of routing responses are
+measured:
+
+    query
+        `Client.query` (responses dispatched to `pymx.query.Query` objects by
+        the IO thread)
+    queues
+        a query context manager per request (responses put into per-query
+        queues found in the ``references`` routing table)
+
+Run from the source root::
+
+    PYTHONPATH=. python bench/query_contention.py [THREADS [QUERIES]]
+"""
+
+from __future__ import with_statement
+
+import sys
+from contextlib import closing
+from threading import Thread
+from timeit import default_timer
+
+from pymx.aiobackend import MultiplexerBackend
+from pymx.client import Client
+from pymx.protocol_constants import MessageTypes
+
+from test.testlib_mxserver import StandInMxServerThread, \
+        create_mx_server_context
+
+THREADS = 64
+QUERIES = 200
+BACKEND_TYPE = 380
+QUERY_TYPE = 1136
+
+def _query(client, i):
+    return client.query(message=str(i), type=QUERY_TYPE, timeout=5)
+
+def _query_with_queue(client, i):
+    manager = client._manager
+    with manager.query_context_manager() as query_manager:
+        request = client.create_message(message=str(i), type=QUERY_TYPE)
+        query_manager.register_id(request.id)
+        client.send_message(request)
+        return query_manager.receive(5,
+                ignore_types=(MessageTypes.REQUEST_RECEIVED,))
+
+def _worker(query, client, count, latencies):
+    for i in xrange(count):
+        start = default_timer()
+        response = query(client, i)
+        latencies.append(default_timer() - start)
+        assert response.message == str(i), response
+
+def _measure(query, client, threads, queries):
+    latencies = [[] for _ in xrange(threads)]
+    workers = [Thread(target=_worker, args=(query, client, queries,
+        latencies[i])) for i in xrange(threads)]
+    start = default_timer()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = default_timer() - start
+    latencies = sorted(sum(latencies, []))
+    assert len(latencies) == threads * queries
+    return elapsed, latencies
+
+def main(threads=THREADS, queries=QUERIES):
+    with create_mx_server_context(impl=StandInMxServerThread,
+            routes={QUERY_TYPE: BACKEND_TYPE}) as server:
+        backend = MultiplexerBackend(type=BACKEND_TYPE,
+                addresses=[server.server_address],
+                handler=lambda context: context.message.message)
+        backend_thread = Thread(target=backend.start)
+        backend_thread.setDaemon(True)
+        backend_thread.start()
+        try:
+            with closing(Client(type=317)) as client:
+                client.connect(server.server_address, sync=True, timeout=5)
+                print "%d threads x %d queries" % (threads, queries)
+                for name, query in (('query', _query),
+                        ('queues', _query_with_queue)):
+                    elapsed, latencies = _measure(query, client, threads,
+                            queries)
+                    print "  %-7s %8.0f queries/s, latency %6.2f ms " \
+                            "(median), %6.2f ms (99%%)" % (name,
+                                len(latencies) / elapsed,
+                                latencies[len(latencies) // 2] * 1000,
+                                latencies[len(latencies) * 99 // 100] * 1000)
+        finally:
+            backend.shutdown()
+            backend_thread.join()
+            backend.close()
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,57 @@
+"""Benchmark of draining incoming messages with `Client.receive` and
+`Client.receive_many`.
+
+A `pymx.client.Client` connected to a local stand-in Multiplexer server sends
+messages to itself; once all of them are queued, the time of consuming them
+is measured.
+
+Run from the source root::
+
+    PYTHONPATH=. python bench/receive_batch.py [MESSAGES [BATCH]]
+"""
+
+from __future__ import with_statement
+
+import sys
+import time
+from contextlib import closing
+from timeit import default_timer
+
+from pymx.client import Client
+
+from test.testlib_mxserver import StandInMxServerThread, \
+        create_mx_server_context
+
+MESSAGES = 100000
+BATCH = 1000
+
+def _fill(client, messages):
+    for i in xrange(messages):
+        client.publish(client.create_message(to=client.instance_id, type=0,
+            message=str(i)))
+    while client._manager._incoming_messages.qsize() < messages:
+        time.sleep(0.01)
+
+def _receive(client, messages, batch):
+    for _ in xrange(messages):
+        client.receive(timeout=5)
+
+def _receive_many(client, messages, batch):
+    while messages:
+        messages -= len(client.receive_many(batch, timeout=5))
+
+def main(messages=MESSAGES, batch=BATCH):
+    with create_mx_server_context(impl=StandInMxServerThread) as server:
+        with closing(Client(type=317)) as client:
+            client.connect(server.server_address, sync=True, timeout=5)
+            print "%d messages, batches of %d" % (messages, batch)
+            for name, receive in (('receive', _receive),
+                    ('receive_many', _receive_many)):
+                _fill(client, messages)
+                start = default_timer()
+                receive(client, messages, batch)
+                elapsed = default_timer() - start
+                print "  %-12s %10.0f messages/s" % (name, messages / elapsed)
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,54 @@
+"""Benchmark of `Client.send_message` latency.
+
+A `pymx.client.Client` connected to a local stand-in Multiplexer server sends
+messages addressed to itself, one at a time. Two latencies are measured:
+
+    send
+        until the future returned by `Client.send_message` is set
+    delivery
+        until the message (routed back by the server) is received
+
+Run from the source root::
+
+    PYTHONPATH=. python bench/send_latency.py [MESSAGES]
+"""
+
+from __future__ import with_statement
+
+import sys
+from contextlib import closing
+from timeit import default_timer
+
+from pymx.client import Client
+
+from test.testlib_mxserver import StandInMxServerThread, \
+        create_mx_server_context
+
+MESSAGES = 5000
+
+def _percentile(latencies, percent):
+    return latencies[len(latencies) * percent // 100] * 1000
+
+def main(messages=MESSAGES):
+    with create_mx_server_context(impl=StandInMxServerThread) as server:
+        with closing(Client(type=317)) as client:
+            client.connect(server.server_address, sync=True, timeout=5)
+            send, delivery = [], []
+            for i in xrange(messages):
+                message = client.create_message(to=client.instance_id,
+                        type=0, message=str(i))
+                start = default_timer()
+                client.send_message(message).wait(5)
+                send.append(default_timer() - start)
+                received = client.receive(timeout=5)
+                delivery.append(default_timer() - start)
+                assert received.message == str(i), received
+            print "%d messages" % messages
+            for name, latencies in (('send', send), ('delivery', delivery)):
+                latencies.sort()
+                print "  %-9s %6.3f ms (median), %6.3f ms (99%%)" % (name,
+                        _percentile(latencies, 50),
+                        _percentile(latencies, 99))
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,258 @@
+"""Single-threaded, event driven Multiplexer client.
+
+`Client` in this module does not spawn any threads: all its IO and timers
+(heartbits, reconnects, query timeouts) run on an `pymx.ioloop.IOLoop`, which
+is driven by the calling thread (e.g. with `IOLoop.run_until` or by an
+application main loop calling `IOLoop.poll`). Operations return `Future`
+objects (with `Future.add_callback` for completion callbacks) instead of
+blocking.
+
+Example use:
+
+.. python::
+    loop = IOLoop()
+    client = Client(type=PEER_TYPE, io_loop=loop)
+    loop.run_until(client.connect(address), timeout=5)
+    response = loop.run_until(client.query(message='...', type=QUERY_TYPE,
+        timeout=1))
+    for message, channel in client.messages(timeout=10):
+        ...
+"""
+
+from __future__ import absolute_import, with_statement
+
+from time import time
+from collections import deque
+
+from google.protobuf.message import Message
+
+from .channel import Channel
+from .client import _rand64, create_welcome_message
+from .connection import ConnectionsManager, select_channels, \
+        handle_connection_welcome
+from .frame import Frame
+from .future import Future, FutureTimeout
+from .ioloop import IOLoop
+from .limitedset import MessageIdSet
+from .message import MultiplexerMessage, materialize_received
+from .protobuf import make_message
+from .protocol import HEARTBIT_WRITE_INTERVAL, RECONNECT_TIME
+from .protocol_constants import MessageTypes
+from .query import Query
+from .scheduler import ExpiryBatcher
+
+
+class Client(object):
+    """Single-threaded counterpart of `pymx.client.Client`. """
+
+    ONE = ConnectionsManager.ONE
+    ALL = ConnectionsManager.ALL
+
+    def __init__(self, type, multiplexer_password=None, io_loop=None):
+        """Construct new `Client` instance.
+
+        :Parameters:
+            - `type`: peer type of new client
+            - `multiplexer_password`: password send to (and optionally
+              validated by) Multiplexer server
+            - `io_loop`: `IOLoop` to be used (by default a new one is
+              created and closed with the client)
+        """
+        object.__init__(self)
+        self._instance_id = _rand64()
+        self._type = type
+        self._multiplexer_password = multiplexer_password or ''
+        self._welcome_frame = Frame.from_message(create_welcome_message(
+            self._instance_id, type, multiplexer_password))
+        self._heartbit_frame = Frame.from_message(make_message(
+            MultiplexerMessage, type=MessageTypes.HEARTBIT))
+
+        self._owns_io_loop = io_loop is None
+        self._io_loop = io_loop if io_loop is not None else IOLoop()
+        self._channels = set()
+        self._is_closing = False
+        self._recent_messages_pool = MessageIdSet()
+        self._queries = {}
+        self._expired_queries = ExpiryBatcher(self._io_loop.call_later,
+                self.unregister_query)
+        self._incoming_messages = deque()
+        self._receivers = deque()
+
+    @property
+    def instance_id(self):
+        """Peer ID of this client instance."""
+        return self._instance_id
+
+    @property
+    def type(self):
+        """Peer type of this client instance."""
+        return self._type
+
+    @property
+    def io_loop(self):
+        return self._io_loop
+
+    @property
+    def channel_map(self):
+        # used by `Channel`
+        return self._io_loop
+
+    def create_message(self, **kwargs):
+        """Construct `MultiplexerMessage`, see
+        `pymx.client.Client.create_message`. """
+        kwargs.setdefault('id', _rand64())
+        kwargs.setdefault('from', self.instance_id)
+        kwargs.setdefault('timestamp', int(time()))
+        return make_message(MultiplexerMessage, **kwargs)
+
+    def call_later(self, delay, callback, *args, **kwargs):
+        return self._io_loop.call_later(delay, callback, *args, **kwargs)
+
+    def connect(self, address, reconnect=RECONNECT_TIME):
+        """Initiate connection to Multiplexer server.
+
+        Returns `Future`, which will be set when Multiplexer connection
+        hand-shake is completed.
+
+        :Parameters:
+            - `address`: an address suitable for ``socket.connect`` call
+              (``host, port`` pair)
+            - `reconnect`: after `reconnect` seconds since losing connection to
+              `address` Client should attempt to reconnect
+        """
+        future = Future()
+        if self._is_closing:
+            future.set_error("Client closed")
+            return future
+        with future:
+            self._channels.add(Channel(address=address, manager=self,
+                connect_future=future, reconnect=reconnect))
+        return future
+
+    def send_message(self, message, connection=ONE):
+        """Send a message. Returns number of channels used to send it (``0``
+        if there are no active connections).
+
+        :Parameters:
+            - `message`: a MultiplexerMessage object (or raw Multiplexer
+              protocol frame as `str` or `pymx.frame.Frame`)
+            - `connection`: ``Client.ONE``, ``Client.ALL`` or channel
+              instance
+        """
+        if isinstance(message, Message):
+            message = Frame.from_message(message)
+        count = 0
+        for channel in select_channels(list(self._channels), connection):
+            channel.enque_outgoing(message)
+            count += 1
+        return count
+
+    send_now = send_message # used by `Query`
+
+    def event(self, message):
+        """Broadcast a message. Equivalent to `send_message` ``(message,
+        Client.ALL)``. """
+        return self.send_message(message, connection=self.ALL)
+
+    def query(self, message, type, timeout, fields=None, skip_resend=False):
+        """Perform a Multiplexer query.
+
+        Returns `Future` set to the response `MultiplexerMessage` or to an
+        `pymx.exc.OperationFailed` error (`pymx.exc.BackendError` when
+        ``BACKEND_ERROR`` is received). Parameters are the same as for
+        `pymx.client.Client.query`.
+        """
+        return Query(self, message=message, type=type, timeout=timeout,
+                fields=fields, skip_resend=skip_resend).start()
+
+    def register_query(self, message_id, query):
+        self._queries[message_id] = query
+
+    def unregister_query(self, message_ids, delay=0):
+        if delay:
+            self._expired_queries.add(delay, message_ids)
+            return
+        for message_id in message_ids:
+            self._queries.pop(message_id, None)
+
+    def receive(self):
+        """Returns `Future` set to a ``(message, channel)`` pair when the next
+        message is received. """
+        future = Future()
+        if self._incoming_messages:
+            future.set(self._incoming_messages.popleft())
+        else:
+            self._receivers.append(future)
+        return future
+
+    def messages(self, timeout=None):
+        """Returns an iterator over incoming ``(message, channel)`` pairs,
+        running the IO loop while waiting for them. The iteration stops when
+        no message is received in `timeout` seconds. """
+        while not self._is_closing:
+            future = self.receive()
+            try:
+                yield self._io_loop.run_until(future, timeout)
+            except FutureTimeout:
+                self._receivers.remove(future)
+                return
+
+    def run_until(self, future, timeout=None):
+        """Shortcut for `IOLoop.run_until`. """
+        return self._io_loop.run_until(future, timeout)
+
+    def close(self):
+        """Close this client."""
+        if self._is_closing:
+            return
+        self._is_closing = True
+        for channel in list(self._channels):
+            channel.close()
+        self._channels.clear()
+        if self._owns_io_loop:
+            self._io_loop.close()
+
+    # Channel callbacks
+
+    def handle_connect(self, channel):
+        assert channel.connected
+        channel.enque_outgoing(self._welcome_frame)
+        self._send_heartbit(channel)
+
+    def _send_heartbit(self, channel):
+        if not channel.connected or self._is_closing:
+            return
+        channel.enque_outgoing(self._heartbit_frame)
+        self.call_later(HEARTBIT_WRITE_INTERVAL, self._send_heartbit, channel)
+
+    def handle_disconnect(self, channel):
+        channel.protocol_initialized = False
+        if channel.reconnect is not None and not self._is_closing:
+            self.call_later(channel.reconnect, self.connect, channel.address,
+                    reconnect=channel.reconnect)
+
+    def handle_channel_closed(self, channel):
+        self._channels.discard(channel)
+
+    def handle_message(self, message, channel):
+        if not self._recent_messages_pool.add(message.id):
+            return
+        if message.type == MessageTypes.CONNECTION_WELCOME:
+            handle_connection_welcome(message, channel,
+                    self._multiplexer_password)
+        elif message.type == MessageTypes.HEARTBIT:
+            pass
+        elif message.references in self._queries:
+            self._queries[message.references].handle_response(message,
+                    channel)
+        else:
+            message = materialize_received(message, channel)
+            if message is None:
+                return
+            if self._receivers:
+                self._receivers.popleft().set((message, channel))
+            else:
+                self._incoming_messages.append((message, channel))
+
+    def __del__(self):
+        self.close()
@@ -0,0 +1,316 @@
+"""Event driven multiplexer backend handling requests concurrently.
+
+Unlike `pymx.backend.MultiplexerBackend`, which handles one message at a time
+and keeps the handled message in the backend instance, `MultiplexerBackend`
+in this module creates a `RequestContext` for every request. Handlers may
+return a `Future` or be generator based coroutines (see
+`pymx.future.run_coroutine`), so many requests can be in progress at the
+same time. Everything runs in the thread driving the backend's
+`pymx.ioloop.IOLoop`.
+
+Example use:
+
+.. python::
+    def handler(context):
+        result = yield lookup(context.message.message) # returns a Future
+        raise Return(result)
+
+    backend = MultiplexerBackend(type=PEER_TYPE, addresses=[address],
+        handler=handler)
+    backend.start()
+"""
+
+from __future__ import absolute_import
+
+import sys
+from types import GeneratorType
+from traceback import print_exc, format_exception
+from functools import partial
+
+from .aio import Client
+from .future import Future, FutureException, run_coroutine
+from .protocol_constants import MessageTypes
+
+DEFAULT_CONCURRENCY = 16
+"""Default maximal number of requests handled at the same time."""
+
+_POLL_TIMEOUT = 1.0
+
+
+class RequestContext(object):
+
+    """A request being handled by `MultiplexerBackend`. """
+
+    def __init__(self, backend, message, channel):
+        object.__init__(self)
+        self.backend = backend
+        self.message = message
+        self.channel = channel
+        self.has_sent_response = False
+
+    @property
+    def references(self):
+        """``references`` of replies (``id`` of the request). """
+        return self.message.id
+
+    @property
+    def workflow(self):
+        return self.message.workflow
+
+    @property
+    def to(self):
+        """``to`` of replies (sender of the request). """
+        return self.message.from_
+
+    def send_message(self, **kwargs):
+        """Send reply message constructed using `kwargs`. Default values of
+        ``to``, ``references``, ``workflow`` and ``connection`` are set like
+        in `pymx.backend.MultiplexerBackend.send_message`. """
+        self.has_sent_response = True
+        connection = kwargs.pop('connection', self.channel)
+        kwargs.setdefault('references', self.references)
+        kwargs.setdefault('workflow', self.workflow)
+        kwargs.setdefault('to', self.to)
+        return self.backend.send_message(connection=connection, **kwargs)
+
+    def notify_started(self):
+        assert not self.has_sent_response, "If you use notify_started(), " \
+                "place it as a first function in your handler code"
+        self.send_message(message="", type=MessageTypes.REQUEST_RECEIVED)
+        self.has_sent_response = False
+
+    def no_response(self):
+        self.has_sent_response = True
+
+    def report_error(self, message="", type=MessageTypes.BACKEND_ERROR,
+            **kwargs):
+        self.send_message(message=message, type=type, **kwargs)
+
+    def send_backend_error(self, exc, trace=None):
+        self.report_error(message=format_exception(type(exc), exc, trace))
+
+    def respond(self, response):
+        """Send `response` returned by a handler (see `MultiplexerBackend`).
+        """
+        if response == ():
+            self.no_response()
+        elif isinstance(response, str):
+            self.send_message(message=response, type=MessageTypes.PING)
+        elif isinstance(response, dict):
+            self.send_message(**response)
+        elif response is None and self.has_sent_response:
+            pass
+        else:
+            raise ValueError("Unsupported handler return type %r" %
+                    type(response))
+
+
+class MultiplexerBackend(object):
+
+    """Multiplexer backend handling up to `concurrency` requests at the same
+    time. """
+
+    def __init__(self, type, addresses=(), handler=None,
+            concurrency=DEFAULT_CONCURRENCY, io_loop=None):
+        """Initialize `MultiplexerBackend`.
+
+        If `handler` is specified, it should be a function taking
+        `RequestContext` as input and returning a response (like the
+        `handler` of `pymx.backend.MultiplexerBackend`), a `Future` set to
+        such response, or a generator (coroutine) yielding futures. A handler
+        may also send replies using the context and return ``None``.
+
+        Any exceptions raised by the `handler` will be converted to
+        ``BACKEND_ERROR`` messages and reported by `exception_occurred`.
+
+        :Parameters:
+            - `type`: peer type of this backend
+            - `addresses`: list of addresses of Multiplexer servers
+            - `handler`: optional handler that will be used if `handle_message`
+              is not overriden by a subclass
+            - `concurrency`: maximal number of requests handled at the same
+              time; further messages wait in the incoming queue
+            - `io_loop`: `pymx.ioloop.IOLoop` to be used (by default a new one
+              is created)
+        """
+        object.__init__(self)
+        assert concurrency > 0
+        self._client = Client(type=type, io_loop=io_loop)
+        self._handler = handler
+        self._concurrency = concurrency
+        self._active_requests = 0
+        self._receiving = None
+        self.__working = True
+
+        # connect
+        for address in addresses:
+            try:
+                self._client.run_until(self._client.connect(address), 5)
+            except FutureException:
+                print_exc()
+
+        self._receive_next()
+
+    @property
+    def instance_id(self):
+        return self._client.instance_id
+
+    @property
+    def io_loop(self):
+        return self._client.io_loop
+
+    @property
+    def active_requests(self):
+        """Number of requests being handled. """
+        return self._active_requests
+
+    def create_message(self, *args, **kwargs):
+        return self._client.create_message(*args, **kwargs)
+
+    def connect(self, *args, **kwargs):
+        """See `pymx.aio.Client.connect`. """
+        return self._client.connect(*args, **kwargs)
+
+    def send_message(self, connection=Client.ONE, **kwargs):
+        """Send message constructed using `kwargs`. To reply to a request use
+        `RequestContext.send_message`. """
+        return self._client.send_message(self.create_message(**kwargs),
+                connection=connection)
+
+    def start(self):
+        self.__working = True
+        self._receive_next()
+        self.loop()
+
+    @property
+    def working(self):
+        return self.__working
+
+    def shutdown(self):
+        """Stop receiving requests. `loop` returns when requests being handled
+        are finished. """
+        self.__working = False
+
+    def loop(self):
+        """Serve until `shutdown` is called."""
+        while self.__working or self._active_requests:
+            self.io_loop.poll(_POLL_TIMEOUT)
+
+    serve_forever = loop
+
+    def _receive_next(self):
+        if self.__working and self._receiving is None and \
+                self._active_requests < self._concurrency:
+            self._receiving = self._client.receive()
+            self._receiving.add_callback(self._received)
+
+    def _received(self, future):
+        self._receiving = None
+        message, channel = future.value
+        if message.type <= MessageTypes.MAX_MULTIPLEXER_META_PACKET:
+            self.__handle_request(RequestContext(self, message, channel),
+                    self.__handle_internal_message)
+        else:
+            self._active_requests += 1
+            self.__handle_request(RequestContext(self, message, channel),
+                    self.handle_message)
+        self._receive_next()
+
+    def __handle_internal_message(self, context):
+        mxmsg = context.message
+        if mxmsg.type == MessageTypes.BACKEND_FOR_PACKET_SEARCH:
+            context.send_message(message="", type=MessageTypes.PING)
+
+        elif mxmsg.type == MessageTypes.PING:
+            if not mxmsg.references:
+                assert mxmsg.id
+                context.send_message(message=mxmsg.message,
+                        type=MessageTypes.PING)
+            else:
+                context.no_response()
+
+        else:
+            print >> sys.stderr, "Backend received unknown meta-packet " \
+                    "(type=%d)" % (mxmsg.type)
+
+    def __handle_request(self, context, handler):
+        try:
+            result = handler(context)
+            if isinstance(result, GeneratorType):
+                result = run_coroutine(result)
+        except Exception, e:
+            self.__request_finished(context, exception=e)
+        else:
+            if isinstance(result, Future):
+                result.add_callback(partial(self.__request_completed,
+                    context))
+            else:
+                self.__request_finished(context)
+
+    def __request_completed(self, context, future):
+        try:
+            future.value
+        except Exception, e:
+            self.__request_finished(context, exception=e)
+        else:
+            self.__request_finished(context)
+
+    def __request_finished(self, context, exception=None):
+        if context.message.type > MessageTypes.MAX_MULTIPLEXER_META_PACKET:
+            self._active_requests -= 1
+            self._receive_next()
+
+        if exception is None:
+            if not context.has_sent_response:
+                print >> sys.stderr, "request #%d handled without " \
+                        "exception and without any response" % \
+                        context.message.id
+            return
+
+        # report exception
+        print >> sys.stderr, "Exception while handling request #%d:" % \
+                context.message.id, repr(exception)
+        if not context.has_sent_response:
+            print >> sys.stderr, "sending BACKEND_ERROR notification " \
+                    "for Exception %s" % exception
+            context.report_error(message=str(exception))
+        handled = self.exception_occurred(exception)
+        if not handled:
+            raise exception
+
+    def handle_message(self, context):
+        """This method should be overriden in child classes if ``handler`` is
+        not provided. It may return ``None`` (request is handled), a `Future`
+        or a generator (request is handled when they finish). """
+        if self._handler is None:
+            raise NotImplementedError()
+
+        context.notify_started()
+        result = self._handler(context)
+        if isinstance(result, GeneratorType):
+            result = run_coroutine(result)
+        if not isinstance(result, Future):
+            context.respond(result)
+            return None
+        responded = Future()
+        def _respond(future):
+            try:
+                context.respond(future.value)
+            except Exception, e:
+                responded.set_exception(e)
+            else:
+                responded.set(None)
+        result.add_callback(_respond)
+        return responded
+
+    def close(self):
+        """In case we ever what to finish."""
+        self.shutdown()
+        self._client.close()
+
+    def exception_occurred(self, exc):
+        """Called when `handle_message` or ``__handle_internal_message`` fails
+        (or the future returned by `handle_message` is set to an exception).
+        Returning non-true value results in exception propagation. """
+        del exc
+        return True # ignore
@@ -10,8 +10,10 @@ __license__ = 'GPLv3'
 
 
 import sys
-from traceback import print_exc, format_exception
-from threading import RLock
+from traceback import print_exc, format_exception, format_exc
+from threading import RLock, Thread, BoundedSemaphore, local
+from Queue import Queue
+from functools import partial
 
 try:
     import cPickle as pickle
@@ -22,13 +24,129 @@ from .client import Client
 from .future import FutureException
 from .protocol_constants import MessageTypes
 from .atomic import synchronized
-from .message import MultiplexerMessage
+from .message import MessageView, materialize_received
+from .exc import BackendWorkerError
+from .stream import pickle_chunks
+
+
+class _Request(object):
+
+    """A message being handled by `MultiplexerBackend`. In worker processes
+    `replies` collects arguments of `MultiplexerBackend.send_message` calls,
+    which are sent by the parent process. """
+
+    __slots__ = ('message', 'source', 'has_sent_response', 'replies')
+
+    def __init__(self, message, source, replies=None):
+        object.__init__(self)
+        self.message = message
+        self.source = source
+        self.has_sent_response = False
+        self.replies = replies
+
+
+class _ThreadPool(object):
+
+    """Runs ``handle(*args)`` for submitted arguments in worker threads. """
+
+    def __init__(self, handle, on_error, threads):
+        object.__init__(self)
+        self._handle = handle
+        self._on_error = on_error
+        # `submit` blocks when all workers are busy
+        self._queue = Queue(threads)
+        self._threads = [Thread(target=self._work,
+            name='MultiplexerBackend worker %d' % i) for i in xrange(threads)]
+        for thread in self._threads:
+            thread.setDaemon(True)
+            thread.start()
+
+    def submit(self, *args):
+        self._queue.put(args)
+
+    def _work(self):
+        while True:
+            args = self._queue.get()
+            if args is None:
+                return
+            try:
+                self._handle(*args)
+            except Exception:
+                self._on_error(sys.exc_info()[1])
+
+    def close(self):
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+_worker_process_backend = None
+
+def _init_worker_process(backend):
+    global _worker_process_backend
+    _worker_process_backend = backend
+
+def _handle_in_worker_process(data):
+    # the pool never calls back if the result cannot be pickled, so it is
+    # pickled here
+    try:
+        return pickle.dumps(
+                _worker_process_backend._handle_in_worker_process(data), 2)
+    except Exception:
+        return pickle.dumps(([], format_exc()), 2)
+
+
+class _ProcessPool(object):
+
+    """Handles messages in worker processes forked from the backend process.
+    Messages are shipped as received (serialized Protocol Buffer data) and
+    replies are sent back to `send_replies`. """
+
+    def __init__(self, backend, send_replies, on_error, processes):
+        object.__init__(self)
+        # import here, so that multiprocessing is needed only when used
+        from multiprocessing import Pool
+        self._send_replies = send_replies
+        self._on_error = on_error
+        self._slots = BoundedSemaphore(processes)
+        self._pool = Pool(processes, initializer=_init_worker_process,
+                initargs=(backend,))
+
+    def submit(self, mxmsg, connection):
+        if isinstance(mxmsg, MessageView):
+            data = mxmsg.contents
+        else:
+            data = mxmsg.SerializeToString()
+        self._slots.acquire()
+        self._pool.apply_async(_handle_in_worker_process, (data,),
+                callback=partial(self._done, connection))
+
+    def _done(self, connection, result):
+        # called by the pool's result handler thread
+        self._slots.release()
+        try:
+            replies, error = pickle.loads(result)
+        except Exception:
+            replies, error = [], format_exc()
+        try:
+            self._send_replies(connection, replies)
+        except Exception, e:
+            print_exc()
+            self._on_error(e)
+        if error is not None:
+            self._on_error(BackendWorkerError(error))
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
 
 
 class MultiplexerBackend(object):
     """Abstract multiplexer backend functionality."""
 
-    def __init__(self, type, addresses=(), handler=None):
+    def __init__(self, type, addresses=(), handler=None, threads=None,
+            processes=None, compression=None):
         """Initialize `MultiplexerBackend`.
 
         If `handler` is specified, it should be a function taking
@@ -46,19 +164,43 @@ class MultiplexerBackend(object):
         Any exceptions raised by the `handler` will be converted to
         ``BACKEND_ERROR`` messages and reported by `exception_occurred`.
 
+        By default messages are handled by the thread calling `loop` (or
+        `handle_one`). If `threads` or `processes` is given, `loop` only
+        receives messages and hands them to a pool of worker threads or
+        (forked) worker processes. In the process mode, messages sent by
+        `send_message` (including `notify_started` and `report_error`) are
+        collected in the worker and sent by the backend process when the
+        handling finishes. If `exception_occurred` does not handle an
+        exception raised in a worker, it is re-raised from `loop` (as
+        `BackendWorkerError` in the process mode).
+
         :Parameters:
             - `type`: peer type of this backend
             - `addresses`: list of addresses of Multiplexer servers
             - `handler`: optional handler that will be used if `handle_message`
               is not overriden by a subclass
+            - `threads`: number of worker threads handling messages
+            - `processes`: number of worker processes handling messages
+            - `compression`: optional `pymx.compression.CompressionPolicy`
+              of the sent messages (see `pymx.client.Client`)
         """
         object.__init__(self)
-        self._client = Client(type=type)
-        self.__handled_message = None
+        if threads and processes:
+            raise ValueError("threads and processes cannot be used together")
         self.__working = True
-        self.__has_sent_response = None
         self._lock = RLock()
         self._handler = handler
+        self._local = local()
+        self._worker_error = None
+        self._workers = None
+        if processes:
+            # fork before the client threads are started
+            self._workers = _ProcessPool(self, self.__send_replies,
+                    self.__worker_failed, processes)
+        elif threads:
+            self._workers = _ThreadPool(self.__handle_message,
+                    self.__worker_failed, threads)
+        self._client = Client(type=type, compression=compression)
 
         # connect
         connect_futures = map(self._client.connect, addresses)
@@ -98,12 +240,25 @@ class MultiplexerBackend(object):
             self.handle_one()
 
     def handle_one(self, read_timeout=None):
+        """Receive and handle one message. When worker threads or processes
+        are used, the message is only handed to a worker. """
+        self.__raise_worker_error()
+        # worker processes get the message as received, see `_ProcessPool`
         mxmsg, connection = self._client.receive(with_channel=True,
-                timeout=read_timeout)
-        self.__handle_message(mxmsg, connection)
+                timeout=read_timeout,
+                parse=not isinstance(self._workers, _ProcessPool))
+        if self._workers is not None:
+            self._workers.submit(mxmsg, connection)
+        else:
+            self.__handle_message(mxmsg, connection)
 
     serve_forever = loop
 
+    @property
+    def _request(self):
+        """`_Request` being handled by the current thread or ``None``. """
+        return getattr(self._local, 'request', None)
+
     def __handle_internal_message(self, mxmsg):
         if mxmsg.type == MessageTypes.BACKEND_FOR_PACKET_SEARCH:
             self.send_message(message="", type=MessageTypes.PING)
@@ -120,30 +275,29 @@ class MultiplexerBackend(object):
             print >> sys.stderr, "Backend received unknown meta-packet " \
                     "(type=%d)" % (mxmsg.type)
 
-    def __handle_message(self, mxmsg, connection):
+    def __handle_message(self, mxmsg, connection, replies=None):
+        request = _Request(mxmsg, connection, replies)
         try:
-            self.__handled_message = mxmsg
-            self.__handled_message_source = connection
+            self._local.request = request
 
-            self.__has_sent_response = False
             if mxmsg.type <= MessageTypes.MAX_MULTIPLEXER_META_PACKET:
                 # internal messages
                 self.__handle_internal_message(mxmsg)
-                if not self.__has_sent_response:
+                if not request.has_sent_response:
                     print >> sys.stderr, "__handle_internal_message() " \
                             "finished without exception and without any " \
                             "response"
             else:
                 # the rest
                 self.handle_message(mxmsg)
-                if not self.__has_sent_response:
+                if not request.has_sent_response:
                     print >> sys.stderr, "handle_message() finished without " \
                             "exception and without any response"
 
         except Exception, e:
             # report exception
             print_exc()
-            if not self.__has_sent_response:
+            if not request.has_sent_response:
                 print >> sys.stderr, "sending BACKEND_ERROR notification " \
                         "for Exception %s" % e
                 self.report_error(message=str(e))
@@ -152,8 +306,36 @@ class MultiplexerBackend(object):
                 raise
 
         finally:
-            self.__handled_message = None
-            self.__handled_message_source = None
+            self._local.request = None
+
+    def _handle_in_worker_process(self, data):
+        """Handles serialized message in a worker process. Returns messages
+        to be sent and the unhandled exception (formatted) if any. """
+        replies = []
+        mxmsg = materialize_received(MessageView(data))
+        if mxmsg is None:
+            return replies, None
+        try:
+            self.__handle_message(mxmsg, None, replies)
+        except Exception:
+            return replies, format_exc()
+        return replies, None
+
+    def __send_replies(self, connection, replies):
+        for kwargs in replies:
+            self._client.send_message(self.create_message(**kwargs),
+                    connection=connection)
+
+    def __worker_failed(self, exc):
+        with self._lock:
+            if self._worker_error is None:
+                self._worker_error = exc
+
+    def __raise_worker_error(self):
+        with self._lock:
+            exc, self._worker_error = self._worker_error, None
+        if exc is not None:
+            raise exc
 
     def handle_message(self, mxmsg):
         """This method should be overriden in child classes if ``handler`` is
@@ -174,10 +356,12 @@ class MultiplexerBackend(object):
                     type(response))
 
     def notify_started(self):
-        assert not self.__has_sent_response, "If you use notify_started(), " \
-                "place it as a first function in your handle_message() code"
+        request = self._request
+        assert not request.has_sent_response, "If you use " \
+                "notify_started(), place it as a first function in your " \
+                "handle_message() code"
         self.send_message(message="", type=MessageTypes.REQUEST_RECEIVED)
-        self.__has_sent_response = False
+        request.has_sent_response = False
 
     def send_message(self, **kwargs):
         """Send reply message constructed using `kwargs`.
@@ -199,31 +383,41 @@ class MultiplexerBackend(object):
         `pymx.client.Client.create_message` for details.
         """
         sending_kwargs = {}
-        if self.__handled_message is not None:
-            self.__has_sent_response = True
+        request = self._request
+        if request is not None:
+            request.has_sent_response = True
+            kwargs.setdefault('references', request.message.id)
+            kwargs.setdefault('workflow', request.message.workflow)
+            kwargs.setdefault('to', request.message.from_)
+            if request.replies is not None:
+                # in a worker process
+                if 'connection' in kwargs:
+                    raise ValueError("connection cannot be specified in a "
+                            "worker process")
+                request.replies.append(kwargs)
+                return
             sending_kwargs['connection'] = kwargs.pop('connection',
-                    self.__handled_message_source)
-            kwargs.setdefault('references', self.__handled_message.id)
-            kwargs.setdefault('workflow', self.__handled_message.workflow)
-            kwargs.setdefault('to', self.__handled_message.from_)
+                    request.source)
         return self._client.send_message(self.create_message(**kwargs),
                 **sending_kwargs)
 
     def send_backend_error(self, exc, trace=None):
-        assert self.__handled_message is not None
+        assert self._request is not None
         self.report_error(message=format_exception(type(exc), exc, trace))
 
     def no_response(self):
-        self.__has_sent_response = True
+        self._request.has_sent_response = True
 
     def report_error(self, message="", type=MessageTypes.BACKEND_ERROR,
             **kwargs):
-        assert self.__handled_message is not None
+        assert self._request is not None
         self.send_message(message=message, type=type, **kwargs)
 
     def close(self):
         """In case we ever what to finish."""
         self.shutdown()
+        if self._workers is not None:
+            self._workers.close()
         self._client.close()
 
     def exception_occurred(self, exc_info):
@@ -239,10 +433,46 @@ class PicklingMultiplexerBackend(MultiplexerBackend):
     """Subclass of `MultiplexerBackend` using Python pickles as message
     payload. """
 
+    def __init__(self, *args, **kwargs):
+        """Initialize `PicklingMultiplexerBackend`. Takes the arguments of
+        `MultiplexerBackend` and optional `streaming`: if true, responses of
+        `send_pickle` are streamed (see `send_pickle_stream`). """
+        self.streaming = kwargs.pop('streaming', False)
+        MultiplexerBackend.__init__(self, *args, **kwargs)
+
     def send_pickle(self, data, type=MessageTypes.PICKLE_RESPONSE, **kwargs):
         """Method for sending data back via Multiplexer. """
+        if self.streaming:
+            return self.send_pickle_stream(data, type=type, **kwargs)
         self.send_message(message=pickle.dumps(data), type=type, **kwargs)
 
+    def send_pickle_stream(self, data, type=MessageTypes.PICKLE_RESPONSE,
+            timeout=60, **kwargs):
+        """Stream pickled `data` as the response to the message being
+        handled (see `pymx.stream.pickle_chunks`): large strings and NumPy
+        arrays are sent in chunks straight from their memory, without
+        pickling them into a single string first. Blocks until the receiver
+        reads the stream.
+
+        The first message of the stream is the response; the receiver gets
+        the data with ``pymx.stream.unpickle_chunks(client.receive_stream(
+        response, timeout))``. `kwargs` are used like in `send_message`,
+        for the first message. Not supported in worker processes.
+        """
+        request = self._request
+        assert request is not None
+        if request.replies is not None:
+            raise ValueError("streams cannot be sent from a worker process")
+        if 'id' in kwargs:
+            raise ValueError("id of a stream message cannot be specified")
+        request.has_sent_response = True
+        connection = kwargs.pop('connection', request.source)
+        fields = dict({'references': request.message.id,
+            'workflow': request.message.workflow}, **kwargs)
+        to = fields.pop('to', request.message.from_)
+        self._client.send_stream(to, type, pickle_chunks(data), timeout,
+                connection=connection, fields=fields)
+
     def process_pickle(self, data):
         """This method should be overriden in child classes if ``handler`` is
         not provided. """
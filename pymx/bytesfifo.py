@@ -1,5 +1,6 @@
 import sys
 from collections import deque
+from itertools import islice
 
 class BytesFIFO(object):
 
@@ -80,3 +81,162 @@ class BytesFIFO(object):
 
         return _get_all()
 
+
+
+class BuffersFIFO(object):
+
+    """A FIFO of outgoing byte buffers.
+
+    Unlike `BytesFIFO`, chunks are never joined nor re-sliced: a partially
+    written chunk is tracked by an offset and is exposed as a ``memoryview``.
+    """
+
+    def __init__(self):
+        object.__init__(self)
+        self._chunks = deque()
+        self._offset = 0
+        self._total_length = 0
+
+    def put(self, chunk):
+        """Appends ``chunk`` to this FIFO contents."""
+        if not chunk:
+            return
+        self._chunks.append(chunk)
+        self._total_length += len(chunk)
+
+    append = put
+
+    def __len__(self):
+        """Returns the number of available bytes in this FIFO."""
+        return self._total_length
+
+    available_bytes = property(__len__)
+
+    def peek(self, max_bytes, max_buffers):
+        """Returns a list of at most ``max_buffers`` buffers from the head of
+        the FIFO without removing them. Buffers are collected until their
+        total length reaches ``max_bytes`` (the last one may exceed it). """
+        buffers = []
+        total = 0
+        for chunk in self._chunks:
+            if len(buffers) >= max_buffers or total >= max_bytes:
+                break
+            if not buffers and self._offset:
+                chunk = memoryview(chunk)[self._offset:]
+            buffers.append(chunk)
+            total += len(chunk)
+        return buffers
+
+    def peek_joined(self, join_upto):
+        """Returns the head of the FIFO without removing it. Adjacent short
+        chunks are joined (copied) if their total length does not exceed
+        ``join_upto``, otherwise the head chunk is returned as is (or as a
+        ``memoryview``, if it has been partially consumed). """
+        chunks = self._chunks
+        head = chunks[0]
+        if self._offset:
+            head = memoryview(head)[self._offset:]
+        if len(head) >= join_upto or len(chunks) == 1:
+            return head
+        collected = [head.tobytes() if self._offset else head]
+        total = len(head)
+        for chunk in islice(chunks, 1, None):
+            total += len(chunk)
+            if total > join_upto:
+                break
+            collected.append(chunk)
+        if len(collected) == 1:
+            return head
+        return ''.join(collected)
+
+    def consume(self, nbytes):
+        """Removes ``nbytes`` bytes from the head of the FIFO. """
+        assert nbytes <= self._total_length, (nbytes, self._total_length)
+        self._total_length -= nbytes
+        chunks = self._chunks
+        nbytes += self._offset
+        while nbytes and nbytes >= len(chunks[0]):
+            nbytes -= len(chunks.popleft())
+        self._offset = nbytes
+
+
+class FramesFIFO(BuffersFIFO):
+
+    """A `BuffersFIFO` keeping track of frame boundaries, so that the number
+    of queued frames is known and whole frames can be dropped. A frame
+    consists of one or more chunks queued with a single `put_frame` (or
+    `put_undroppable_frame`) call.
+    """
+
+    def __init__(self):
+        BuffersFIFO.__init__(self)
+        self._frames = deque()
+        """Numbers of chunks of the queued frames. """
+        self._undroppable = deque()
+        """Whether the queued frames are protected from `drop_oldest`. """
+        self._head_started = False
+
+    def put_frame(self, *chunks):
+        """Appends a frame consisting of ``chunks``. """
+        self._put_frame(chunks, False)
+
+    put = append = put_frame
+
+    def put_undroppable_frame(self, *chunks):
+        """Appends a frame consisting of ``chunks``, which is never removed
+        by `drop_oldest`. """
+        self._put_frame(chunks, True)
+
+    def _put_frame(self, chunks, undroppable):
+        chunks = [chunk for chunk in chunks if chunk]
+        if not chunks:
+            return
+        self._chunks.extend(chunks)
+        self._total_length += sum(len(chunk) for chunk in chunks)
+        self._frames.append(len(chunks))
+        self._undroppable.append(undroppable)
+
+    @property
+    def frames(self):
+        """Returns the number of (possibly partially consumed) frames in this
+        FIFO. """
+        return len(self._frames)
+
+    def consume(self, nbytes):
+        chunks_count = len(self._chunks)
+        BuffersFIFO.consume(self, nbytes)
+        popped = chunks_count - len(self._chunks)
+        frames = self._frames
+        started = bool(self._offset)
+        while popped:
+            if frames[0] <= popped:
+                popped -= frames.popleft()
+                self._undroppable.popleft()
+            else:
+                frames[0] -= popped
+                popped = 0
+                started = True
+        self._head_started = started or (self._head_started and
+                chunks_count == len(self._chunks))
+
+    def drop_oldest(self):
+        """Removes the oldest frame which has not been partially consumed and
+        was not put with `put_undroppable_frame`. Returns number of bytes
+        removed (``0`` if there is no such frame). """
+        frames, undroppable = self._frames, self._undroppable
+        index = self._head_started and 1 or 0
+        first = index and frames[0]
+        while index < len(frames) and undroppable[index]:
+            first += frames[index]
+            index += 1
+        if index >= len(frames):
+            return 0
+        chunks = self._chunks
+        dropped = 0
+        for _ in xrange(frames[index]):
+            dropped += len(chunks[first])
+            del chunks[first]
+        del frames[index]
+        del undroppable[index]
+        self._total_length -= dropped
+        return dropped
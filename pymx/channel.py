@@ -1,28 +1,120 @@
 
 import weakref
 import socket
+from threading import RLock, Condition
+from errno import ECONNRESET, ENOTCONN, ESHUTDOWN
 
 from asyncore import dispatcher
 from google.protobuf.message import Message
 
-from .frame import Deframer, create_frame_header
-from .message import MultiplexerMessage
+from .frame import BufferDeframer, Frame
+from .message import MessageView
 from .protocol import WelcomeMessage
-from .protobuf import parse_message
-from .bytesfifo import BytesFIFO
+from .bytesfifo import FramesFIFO
+from .timeout import Timeout
+from .exc import OperationFailed, OutgoingQueueFull
+
+_DISCONNECTED = (ECONNRESET, ENOTCONN, ESHUTDOWN)
+
+
+class QueueLimits(object):
+
+    """Watermarks of `Channel` outgoing queues and the policy applied to
+    messages sent (by `Channel.send_directly`) while a queue is full.
+
+    A queue becomes *full* when it holds at least `high_bytes` bytes or
+    `high_frames` frames and stays full until it drains to `low_bytes` bytes
+    and `low_frames` frames (by default a half of the high watermarks).
+    ``callback(channel, full)`` is called when a channel becomes full and when
+    it drains. It may be called by any thread and must not block.
+    """
+
+    BLOCK = 'block'
+    """Block the sending thread until the queue drains (for at most
+    `timeout` seconds, then fail like `FAIL`)."""
+
+    FAIL = 'fail'
+    """Fail with `pymx.exc.OutgoingQueueFull`."""
+
+    DROP_OLDEST = 'drop_oldest'
+    """Drop the oldest frames queued by `Channel.send_directly` (which are
+    not being written)."""
+
+    DROP_NEWEST = 'drop_newest'
+    """Drop the message being sent."""
+
+    def __init__(self, high_bytes=None, high_frames=None, low_bytes=None,
+            low_frames=None, policy=BLOCK, timeout=None, callback=None):
+        object.__init__(self)
+        assert policy in (self.BLOCK, self.FAIL, self.DROP_OLDEST,
+                self.DROP_NEWEST), policy
+        self.high_bytes = high_bytes
+        self.high_frames = high_frames
+        self.low_bytes = _default_low_watermark(low_bytes, high_bytes)
+        self.low_frames = _default_low_watermark(low_frames, high_frames)
+        self.policy = policy
+        self.timeout = timeout
+        self.callback = callback
+
+    def is_full(self, queue):
+        """Whether `queue` (a `pymx.bytesfifo.FramesFIFO`) reached the high
+        watermark. """
+        return (self.high_bytes is not None and len(queue) >=
+                self.high_bytes) or (self.high_frames is not None and
+                        queue.frames >= self.high_frames)
+
+    def is_drained(self, queue):
+        """Whether `queue` drained to the low watermark. """
+        return (self.low_bytes is None or len(queue) <= self.low_bytes) and \
+                (self.low_frames is None or queue.frames <= self.low_frames)
+
+def _default_low_watermark(low, high):
+    if low is None and high is not None:
+        return high // 2
+    return low
+
 
 class Channel(dispatcher):
 
     write_buffer = 1024
+    """Short outgoing chunks are joined up to this length before being
+    written (long chunks are written without copying). """
+
+    direct_write_attempts = 4
+    """Number of writes `send_directly` attempts before leaving the rest of
+    the outgoing buffer to the IO thread. """
+
     read_buffer = 8192
     ignore_log_types = ()
 
-    def __init__(self, manager, address, connect_future=None, reconnect=None):
+    reading_paused = False
+    """Whether the channel stopped reading from its socket (see
+    `pause_reading`). """
+
+    def __init__(self, manager, address, connect_future=None, reconnect=None,
+            limits=None):
+        """Initializes new `Channel` and starts connecting to `address`.
+
+        `manager` receives channel events (``handle_connect``,
+        ``handle_disconnect``, ``handle_message``,
+        ``handle_channel_closed``) and provides
+        ``channel_map``. If `limits` (a `QueueLimits`) are given, it also
+        provides ``count(name)``, which is called with ``outgoing_full``,
+        ``outgoing_dropped`` and ``outgoing_rejected`` (see
+        `pymx.connection.ConnectionsManager.stats`).
+        """
         map = manager.channel_map
         self._manager = weakref.ref(manager)
         dispatcher.__init__(self, map=map)
-        self._outgoing_buffer = BytesFIFO(join_upto=self.write_buffer)
-        self._deframer = Deframer()
+        self._outgoing_buffer = FramesFIFO()
+        # guards `_outgoing_buffer` and socket writes: `send_directly` may be
+        # called by any thread
+        self._write_lock = RLock()
+        self._drained = Condition(self._write_lock)
+        self._flush_requested = False
+        self._limits = limits
+        self._full = False
+        self._deframer = BufferDeframer(size=self.read_buffer)
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         self._address = address
         self.protocol_initialized = False
@@ -51,17 +143,58 @@ class Channel(dispatcher):
     def reconnect(self):
         return self._reconnect
 
+    def readable(self):
+        return not self.reading_paused
+
     def writable(self):
         return self._outgoing_buffer or not self.connected
 
+    def pause_reading(self):
+        """Stops reading from the socket (so that TCP flow control pushes
+        back on the sender) until `resume_reading` is called. Must be called
+        by the IO thread. """
+        if not self.reading_paused:
+            self.reading_paused = True
+            self._update_interest()
+
+    def resume_reading(self):
+        if self.reading_paused:
+            self.reading_paused = False
+            self._update_interest()
+
     def handle_connect(self):
+        # Python 2.7 asyncore sets `connected` only after `handle_connect`
+        # returns.
+        self.connected = True
         # send the welcome packet, etc.
         self.manager.handle_connect(self)
 
     def handle_read(self):
-        for contents in self._deframer.push(self.recv(self.read_buffer)):
-            message = parse_message(MultiplexerMessage, contents)
-            self._receive_message(message)
+        if not self._deframer.recv_into(self.recv_into, self.read_buffer):
+            return
+        # messages are parsed lazily, see `MessageView`
+        messages = [MessageView(contents) for contents in
+                self._deframer.pop_frames()]
+        while messages:
+            for message in messages:
+                self._receive_message(message)
+            # a corrupted frame following the received ones raises here
+            messages = len(self._deframer) and [MessageView(contents) for
+                    contents in self._deframer.pop_frames()]
+
+    def recv_into(self, buffer, nbytes):
+        """Like ``dispatcher.recv`` but uses ``socket.recv_into``. Returns
+        number of bytes received. """
+        try:
+            received = self.socket.recv_into(buffer, nbytes)
+        except socket.error, why:
+            if why.args[0] in _DISCONNECTED:
+                self.handle_close()
+                return 0
+            raise
+        if not received:
+            self.handle_close()
+        return received
 
     def handle_close(self):
         self.manager.handle_disconnect(self)
@@ -72,23 +205,163 @@ class Channel(dispatcher):
             self._connect_future.set_error(message="Connection closed")
             self._connect_future = None
         dispatcher.close(self)
+        manager = self._manager()
+        if manager is not None:
+            manager.handle_channel_closed(self)
+        with self._write_lock:
+            # wake up threads blocked in `send_directly`
+            self._drained.notifyAll()
 
     def handle_write(self):
-        if not self._outgoing_buffer:
-            return
-        written = self.send(self._outgoing_buffer.next_chunk)
-        if written:
-            popped = self._outgoing_buffer.get(written)
-            assert len(popped) == written, (popped, written)
+        with self._write_lock:
+            outgoing = self._outgoing_buffer
+            if not outgoing:
+                return
+            written = self.send(outgoing.peek_joined(self.write_buffer))
+            if written:
+                outgoing.consume(written)
+            full_changed = self._update_full()
+        self._notify_full_changed(full_changed)
 
-    def enque_outgoing(self, bytes):
+    def _append_outgoing(self, bytes, undroppable=False):
         if isinstance(bytes, Message):
-            bytes = bytes.SerializeToString()
-            self.enque_outgoing(create_frame_header(bytes))
-        if not bytes:
-            return
-        self._outgoing_buffer.append(bytes)
-        self.handle_write()
+            bytes = Frame.from_message(bytes)
+        if undroppable:
+            put_frame = self._outgoing_buffer.put_undroppable_frame
+        else:
+            put_frame = self._outgoing_buffer.put_frame
+        if isinstance(bytes, Frame):
+            put_frame(bytes.header, bytes.contents)
+        else:
+            put_frame(bytes)
+
+    def enque_outgoing(self, bytes):
+        """Queue a `Message`, a `Frame` or a raw protocol frame (a `str`) for
+        sending. `Frame` contents are queued by reference. Queue limits are
+        not enforced, but the queued frame may make the queue full. The frame
+        is never dropped by the `QueueLimits.DROP_OLDEST` policy (protocol
+        frames, e.g. ``CONNECTION_WELCOME`` and heartbits, are queued by this
+        method). """
+        with self._write_lock:
+            self._append_outgoing(bytes, undroppable=True)
+            full_changed = self._update_full()
+        self._notify_full_changed(full_changed)
+        if self._outgoing_buffer:
+            self.handle_write()
+        if self._outgoing_buffer:
+            self._update_interest()
+
+    def send_directly(self, bytes):
+        """Like `enque_outgoing`, but may be called by any thread. If nothing
+        is queued, `bytes` are written to the socket immediately by the
+        calling thread. Returns ``True`` if the IO thread has to `flush` the
+        unsent remainder (the caller is responsible for scheduling it).
+
+        While the outgoing queue is full, the policy of the channel
+        `QueueLimits` is applied: the call may block, raise
+        `OutgoingQueueFull` or drop frames.
+        """
+        full_changed = None
+        try:
+            with self._write_lock:
+                if self._full and not self._make_room():
+                    return False
+                outgoing = self._outgoing_buffer
+                was_empty = not outgoing
+                self._append_outgoing(bytes)
+                if was_empty:
+                    self._write_directly()
+                full_changed = self._update_full()
+                if not outgoing or self._flush_requested:
+                    return False
+                self._flush_requested = True
+                return True
+        finally:
+            self._notify_full_changed(full_changed)
+
+    def _make_room(self):
+        """Applies the queue limits policy while the queue is full. Returns
+        whether the frame being sent should be queued. Called with the write
+        lock held. """
+        limits, outgoing = self._limits, self._outgoing_buffer
+        if limits.policy == QueueLimits.DROP_NEWEST:
+            self._count('outgoing_dropped')
+            return False
+        if limits.policy == QueueLimits.DROP_OLDEST:
+            while limits.is_full(outgoing) and outgoing.drop_oldest():
+                self._count('outgoing_dropped')
+            return True
+        if limits.policy == QueueLimits.BLOCK:
+            timer = Timeout(limits.timeout)
+            while self._full and self.connected and timer.remaining:
+                self._drained.wait(timer.timeout)
+            if not self.connected:
+                raise OperationFailed("Channel closed")
+            if not self._full:
+                return True
+        self._count('outgoing_rejected')
+        raise OutgoingQueueFull("Outgoing queue of %r is full" % (self,))
+
+    def _update_full(self):
+        """Checks the queue against the watermarks. Returns the new state
+        (``True`` if the queue became full, ``False`` if it has drained) or
+        ``None`` if it did not change. Called with the write lock held. """
+        limits = self._limits
+        if limits is None:
+            return None
+        if self._full:
+            if limits.is_drained(self._outgoing_buffer):
+                self._full = False
+                self._drained.notifyAll()
+                return False
+        elif limits.is_full(self._outgoing_buffer):
+            self._full = True
+            self._count('outgoing_full')
+            return True
+        return None
+
+    def _notify_full_changed(self, full):
+        if full is not None and self._limits.callback is not None:
+            self._limits.callback(self, full)
+
+    def _count(self, name):
+        manager = self._manager()
+        if manager is not None:
+            manager.count(name)
+
+    def _write_directly(self):
+        """Writes the outgoing buffer without blocking and without touching
+        dispatcher state (so that it is safe outside IO thread). Errors are
+        left to be discovered by `handle_write`. """
+        outgoing = self._outgoing_buffer
+        for _ in xrange(self.direct_write_attempts):
+            try:
+                written = self.socket.send(outgoing.peek_joined(
+                    self.write_buffer))
+            except socket.error:
+                return
+            if not written:
+                return
+            outgoing.consume(written)
+            if not outgoing:
+                return
+
+    def flush(self):
+        """Called by the IO thread after `send_directly` left some data
+        unsent. """
+        with self._write_lock:
+            self._flush_requested = False
+        if self._outgoing_buffer:
+            self.handle_write()
+        if self._outgoing_buffer:
+            self._update_interest()
+
+    def _update_interest(self):
+        """Notifies the `pymx.ioloop.IOLoop` (if used as the channel map) that
+        `writable` may have changed. """
+        update_interest = getattr(self._map, 'update_interest', None)
+        if update_interest is not None:
+            update_interest(self)
 
     def _receive_message(self, message):
         self.manager.handle_message(message, self)
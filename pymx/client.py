@@ -7,28 +7,26 @@ from Queue import Empty
 from operator import itemgetter
 
 from .protobuf import make_message
-from .message import MultiplexerMessage
+from .message import MultiplexerMessage, MessageView, Compression
 from .connection import ConnectionsManager
-from .protocol import WelcomeMessage, BackendForPacketSearch, RECONNECT_TIME
+from .protocol import WelcomeMessage, RECONNECT_TIME
 from .protocol_constants import MessageTypes
-from .timeout import Timeout
 from .decorator import parametrizable_decorator
-from .exc import MultiplexerException
+from .future import FutureTimeout
+from .query import wait_timeout
+from . import stream
+from .exc import MultiplexerException, OperationFailed, OperationTimedOut, \
+        BackendError, OutgoingQueueFull
 
 _rand64 = partial(randint, 0, 2**64 - 1)
 
-class OperationFailed(MultiplexerException):
-    """Raised when operation fails for any reason. """
-    pass
-
-class OperationTimedOut(OperationFailed):
-    """Raised when operation times out. """
-    pass
-
-class BackendError(OperationFailed):
-    """Error reported by BACKEND is transformed into `BackendError` exception
-    and re-raised on the client side. """
-    pass
+def create_welcome_message(instance_id, type, multiplexer_password=None):
+    """Returns CONNECTION_WELCOME `MultiplexerMessage` sent by a peer. """
+    welcome = make_message(WelcomeMessage, id=instance_id, type=type,
+            multiplexer_password=multiplexer_password)
+    return make_message(MultiplexerMessage,
+            type=MessageTypes.CONNECTION_WELCOME,
+            message=welcome.SerializeToString(), from_=instance_id)
 
 @parametrizable_decorator
 def transform_message(func, message_getter=lambda x: x):
@@ -36,7 +34,7 @@ def transform_message(func, message_getter=lambda x: x):
         response = func(*args, **kwargs)
         if response is not None:
             message = message_getter(response)
-            assert isinstance(message, MultiplexerMessage)
+            assert isinstance(message, (MultiplexerMessage, MessageView))
             if message.type == MessageTypes.BACKEND_ERROR:
                 raise BackendError(message.message)
         return response
@@ -60,27 +58,57 @@ class Client(object):
     ONE = ConnectionsManager.ONE
     ALL = ConnectionsManager.ALL
 
-    def __init__(self, type, multiplexer_password=None):
+    def __init__(self, type, multiplexer_password=None, reactor=None,
+            outgoing_limits=None, incoming_limits=None,
+            recent_messages=20000, dedup_window=None, dedup_filters=None,
+            compression=None):
         """Construct new `Client` instance.
 
         :Parameters:
             - `type`: peer type of new client
             - `multiplexer_password`: password send to (and optionally
               validated by) Multiplexer server
+            - `reactor`: optional `pymx.reactor.Reactor` shared with other
+              clients (e.g. `pymx.reactor.shared_reactor`\ ``()``); by
+              default the client runs its own IO thread
+            - `outgoing_limits`: optional `pymx.channel.QueueLimits`
+              (watermarks and a policy: block the caller, fail the send with
+              `OutgoingQueueFull` or drop frames) applied to outgoing queues
+              of all connections
+            - `incoming_limits`: optional `pymx.channel.QueueLimits` of the
+              queue of messages waiting for `receive`; when the queue is
+              full, the client stops reading from its connections until the
+              queue drains to the low watermark
+            - `recent_messages`: number of IDs of received messages
+              remembered to drop duplicates delivered by several Multiplexer
+              servers (millions are fine, each takes about 40 bytes)
+            - `dedup_window`: if given, IDs of received messages are
+              remembered for this many seconds instead of `recent_messages`
+              last ones (memory grows with the rate of incoming messages)
+            - `dedup_filters`: optional ``dict`` mapping message types to
+              deduplication sets used for them instead, e.g.
+              ``{EVENT_TYPE: RotatingBloomFilter(10 ** 7)}`` to drop
+              duplicated events approximately in less memory (see
+              `ConnectionsManager`)
+            - `compression`: optional `pymx.compression.CompressionPolicy`
+              applied to messages sent by `send_message`, `publish`, `event`
+              and queries (by the calling thread); received messages are
+              always decompressed transparently (by the receiving thread)
         """
         object.__init__(self)
         self._instance_id = _rand64()
         self._type = type
+        self._compression = compression
 
-        welcome = make_message(WelcomeMessage, id=self.instance_id, type=type,
-                multiplexer_password=multiplexer_password)
-
-        welcome_message = make_message(MultiplexerMessage,
-                type=MessageTypes.CONNECTION_WELCOME,
-                message=welcome.SerializeToString(), from_=self.instance_id)
+        welcome_message = create_welcome_message(self.instance_id, type,
+                multiplexer_password)
 
         self._manager = ConnectionsManager(welcome_message,
-                multiplexer_password=multiplexer_password)
+                multiplexer_password=multiplexer_password, reactor=reactor,
+                outgoing_limits=outgoing_limits,
+                incoming_limits=incoming_limits,
+                recent_messages=recent_messages, dedup_window=dedup_window,
+                dedup_filters=dedup_filters)
 
     @property
     def instance_id(self):
@@ -137,27 +165,44 @@ class Client(object):
     def wait_for_connection(self, connwrap, timeout=10):
         connwrap.wait(timeout)
 
-    def send_message(self, message, connection=ONE):
+    def send_message(self, message, connection=ONE, wait=True):
         """Send a message.
 
         Returns `Future`, which will be set to a number of channels used to
-        send message (this may change without warning).
+        send message (this may change without warning) or to
+        `OutgoingQueueFull`, if the outgoing queue limits reject the message
+        on any of the channels (it may still be sent over the others).
 
         :Parameters:
             - `message`: a MultiplexerMessage object (or raw Multiplexer
-              protocol frame as `str`)
+              protocol frame as `str` or `pymx.frame.Frame`)
             - `connection`: ``ConnectionsManager.ONE``,
               ``ConnectionsManager.ALL`` or channel instance returned by
               `receive`\ ``(with_channel=True)``
+            - `wait`: if false, nothing is returned (see `publish`)
         """
+        message = self._compress(message)
+        if not wait:
+            return self._manager.publish(message, connection=connection)
         return self._manager.send_message(message, connection=connection)
 
+    def publish(self, message, connection=ONE):
+        """Send a message without allocating a `Future` (fire-and-forget).
+        Returns nothing; messages which could not be sent (e.g. when not
+        connected) are counted in `stats`. Parameters are the same as for
+        `send_message`. """
+        self._manager.publish(self._compress(message), connection=connection)
+
+    @property
+    def stats(self):
+        """Client statistics, see `ConnectionsManager.stats`. """
+        return self._manager.stats
+
     def event(self, message):
         """Broadcast a message. Equivalent to `send_message` ``(message,
         ConnectionsManager.ALL)``. """
         return self.send_message(message, connection=self.ALL)
 
-    @transform_message
     def query(self, message, type, timeout, fields=None, skip_resend=False):
         """Perform a Multiplexer query.
 
@@ -173,146 +218,113 @@ class Client(object):
               ``{'workflow': '....'}``
             - `skip_resend`: if present and true, query algorithm will not send
               ``BACKEND_FOR_PACKET_SEARCH`` nor resend the request
+
+        `OperationTimedOut` is raised also if the query does not finish in
+        time at all (e.g. the IO thread has stopped), see
+        `pymx.query.wait_timeout`.
+        """
+        future = self.query_async(message=message, type=type,
+                timeout=timeout, fields=fields, skip_resend=skip_resend)
+        try:
+            return future.wait(wait_timeout(timeout, skip_resend))
+        except FutureTimeout:
+            raise OperationTimedOut("Query has not finished in time")
+
+    def query_async(self, message, type, timeout, fields=None,
+            skip_resend=False):
+        """Perform a Multiplexer query without blocking.
+
+        Returns `Future`, which will be set to the response
+        `MultiplexerMessage` (or to an `OperationFailed` exception, see
+        `query`). The query is driven by the IO thread: responses are routed
+        to it by ``references`` and its phases are timed out by IO loop
+        timers. Parameters are the same as for `query`.
         """
         assert not isinstance(message, MultiplexerMessage)
-        fields = dict(fields or {}, message=message, type=type)
-        workflow = fields.get('workflow')
-
-        with self._manager.query_context_manager() as query_manager:
-            # First phase - normal send & receive.
-            first_request_delivery_errored = False
-            query = self.create_message(**fields)
-            query_manager.register_id(query.id)
-            self.send_message(message=query)
-            response = query_manager.receive(timeout,
-                    ignore_types=(MessageTypes.REQUEST_RECEIVED,))
-            backend_error = None
-            if response is not None:
-                if response.type == MessageTypes.DELIVERY_ERROR:
-                    if skip_resend:
-                        raise OperationFailed("Delivery Error response for "
-                                "query #%d" % query.id)
-                    else:
-                        first_request_delivery_errored = True
-                elif response.type == MessageTypes.BACKEND_ERROR:
-                    backend_error = response
-                else:
-                    return response
-            elif skip_resend:
-                raise OperationTimedOut("No response received for query #%d",
-                        query.id)
-
-            # Second phase - searching for a working backend.
-            search = self.create_message(message=
-                    make_message(BackendForPacketSearch,
-                        packet_type=type).SerializeToString(),
-                    type=MessageTypes.BACKEND_FOR_PACKET_SEARCH,
-                    workflow=workflow)
-            query_manager.register_id(search.id)
-            searches_count = self.event(search)
-            if not searches_count:
-                if backend_error is not None:
-                    return backend_error
-                raise OperationFailed("Could not broadcast backend search")
-            searches_timeout = Timeout(timeout)
-            while searches_timeout.remaining:
-                response = query_manager.receive(
-                        searches_timeout.timeout, with_channel=True,
-                        ignore_types=(MessageTypes.REQUEST_RECEIVED,))
-                if response is None:
-                    if backend_error is not None:
-                        return backend_error
-                    raise OperationTimedOut("No response to query #%d and "
-                            "backend search #%d" % (query.id, search.id))
-                response, channel = response
-
-                if response.type in (MessageTypes.DELIVERY_ERROR,
-                        MessageTypes.BACKEND_ERROR):
-                    if response.type == MessageTypes.BACKEND_ERROR and \
-                            backend_error is None:
-                        backend_error = response
-                    if response.references == query.id:
-                        first_request_delivery_errored = True
-                        continue
-                    else:
-                        # No backend for packet search responses
-                        assert response.references == search.id
-                        searches_count -= 1
-                        if searches_count:
-                            continue
-                        if first_request_delivery_errored:
-                            if backend_error is not None:
-                                return backend_error
-                            raise OperationFailed("Delivery Error responses "
-                                    "for query #%d and backend search #%d" %
-                                    (query.id, search.id))
-                        else:
-                            query_manager.unregister_id(search.id)
-                            response = query_manager.receive(timeout=timeout)
-                            if response is None:
-                                if backend_error is not None:
-                                    return backend_error
-                                raise OperationTimedOut("No response received "
-                                        "for query #%d and backend search #%d "
-                                        "errored" % (query.id, search.id))
-                            assert response.references == query.id
-                            if response.type == MessageTypes.DELIVERY_ERROR:
-                                if backend_error is not None:
-                                    # second response to query received...
-                                    return backend_error
-                                raise OperationFailed("Delivery Error "
-                                        "responses for query #%d and backend "
-                                        "search #%d" % (query.id, search.id))
-                            return response
-
-                elif response.references == query.id:
-                    return response
-
-                elif response.type == MessageTypes.PING:
-                    # Found alive backend!
-                    assert response.references == search.id
-                    query_manager.unregister_id(search.id)
-                    retransmitted = self.create_message(**fields)
-                    query_manager.register_id(retransmitted.id)
-                    self.send_message(retransmitted, connection=channel)
-                    break
-                else:
-                    raise OperationFailed("Unrecognized message returned from "
-                            "multiplexer", response)
-
-            # Third phase - waiting for response from proved-alive backend (or
-            # from backend handling initial query).
-            timer = Timeout(timeout)
-            while timer.remaining:
-                response = query_manager.receive(timeout,
-                        ignore_types=(MessageTypes.REQUEST_RECEIVED,))
-
-                if response is None:
-                    break
-
-                if response.type == MessageTypes.BACKEND_ERROR:
-                    if backend_error is None:
-                        backend_error = response
-
-                if response.type == MessageTypes.DELIVERY_ERROR:
-                    if response.references == retransmitted.id:
-                        if backend_error is not None:
-                            return backend_error
-                        raise OperationFailed("Retransmitted query #%d could "
-                                "not be delivered" % retransmitted.id)
-                    else:
-                        assert response.references == query.id
-                        first_request_delivery_errored = True
-                        continue
-
-                return response
-
-            if backend_error is not None:
-                return backend_error
-            raise OperationTimedOut("No response received for query #%d and "
-                    "retransmitted query #%d" % (query.id, retransmitted.id))
-
-    def receive(self, timeout=None, with_channel=False):
+        return self._manager.query(self.create_message,
+                **self._compress_query({'message': message, 'type': type,
+                    'timeout': timeout, 'fields': fields,
+                    'skip_resend': skip_resend}))
+
+    def query_many(self, queries, **defaults):
+        """Perform many Multiplexer queries at once.
+
+        Returns list of futures, like `query_async`.
+
+        :Parameters:
+            - `queries`: iterable of ``dict`` objects with `query_async`
+              arguments
+            - `defaults`: (keyword-only) default `query_async` arguments
+
+        Example:
+
+        .. python::
+            futures = client.query_many([{'message': a}, {'message': b}],
+                type=QUERY_TYPE, timeout=1)
+            responses = wait_all(*futures)
+        """
+        queries = [dict(defaults, **query) for query in queries]
+        for query in queries:
+            assert not isinstance(query['message'], MultiplexerMessage)
+        return self._manager.query_many(self.create_message,
+                map(self._compress_query, queries))
+
+    def send_stream(self, to, type, source, timeout,
+            chunk_size=stream.CHUNK_SIZE, connection=ONE, fields=None):
+        """Send `source` to the peer `to` as a stream of messages of `type`,
+        blocking while the consumer is behind (see `pymx.stream`).
+
+        Returns the stream ID once the consumer has received all chunks.
+        Raises `OperationTimedOut` if the consumer does not acknowledge
+        chunks and `OperationFailed` if it aborts the stream.
+
+        :Parameters:
+            - `to`: ID of the consuming peer
+            - `type`: type of the stream messages
+            - `source`: file-like object or an iterable of strings
+            - `timeout`: maximal time of waiting for the consumer (in
+              seconds)
+            - `chunk_size`: maximal length of data sent in one message
+            - `connection`: see `send_message`
+            - `fields`: optional `dict` with additional fields of the first
+              message (e.g. ``references`` to make it a query response)
+        """
+        return stream.send_stream(self, self._manager.query_context_manager(),
+                to, type, source, timeout, chunk_size=chunk_size,
+                connection=connection, fields=fields)
+
+    def receive_stream(self, message, timeout, window=stream.WINDOW):
+        """Receive the stream started by `message` (the first message of a
+        stream, returned by `receive`).
+
+        Returns an iterator of strings (chunks of data in order). Iteration
+        raises `OperationTimedOut` if no chunk arrives for `timeout`
+        seconds and `OperationFailed` if the producer aborts the stream;
+        closing the iterator early aborts it. The producer may send at most
+        `window` chunks not consumed yet.
+        """
+        return stream.receive_stream(self,
+                self._manager.query_context_manager(), message, timeout,
+                window=window)
+
+    def _compress(self, message):
+        if self._compression is None or not isinstance(message,
+                MultiplexerMessage):
+            return message
+        return self._compression.compress(message)
+
+    def _compress_query(self, query):
+        # the request is created by the IO thread, so it is compressed here
+        if self._compression is None:
+            return query
+        payload = self._compression.compress_payload(query['message'],
+                query['type'])
+        if payload is None:
+            return query
+        return dict(query, message=payload, fields=dict(query.get('fields')
+            or {}, compression=Compression.GZIP))
+
+    def receive(self, timeout=None, with_channel=False, parse=True):
         """Receive a message from Multiplexer server. If optional parameter
         `timeout` is specified and not ``None``, receive will block for at most
         `timeout` seconds.
@@ -320,13 +332,26 @@ class Client(object):
         Returns `MultiplexerMessage` if `with_channel` is not specified else
         ``(message, channel)`` pair. If the received message is a
         ``BACKEND_ERROR`` message, it will be converted into `BackendError`
-        exception.
+        exception. If `parse` is false, the message may be returned as
+        received: a `pymx.message.MessageView` not parsed yet.
         """
-        message, connection = self._receive(timeout=timeout)
+        message, connection = self._receive(timeout=timeout, parse=parse)
         if with_channel:
             return message, connection
         return message
 
+    def receive_many(self, max_count, timeout=None):
+        """Receive up to `max_count` messages at once.
+
+        Returns a list of ``(message, channel)`` pairs, waiting at most
+        `timeout` seconds (forever if ``None``) for the first one; the list
+        is empty if no message is received in time. All messages already
+        queued (up to `max_count`) are taken with a single lock acquisition.
+        Unlike `receive`, ``BACKEND_ERROR`` messages are returned as they
+        are.
+        """
+        return self._manager.receive_many(max_count, timeout=timeout)
+
     @deprecated("Use `receive`.")
     def receive_message(self, timeout=-1):
         assert timeout == -1 or timeout > 0
@@ -335,9 +360,9 @@ class Client(object):
         return self.receive(timeout=timeout)
 
     @transform_message(message_getter=itemgetter(0))
-    def _receive(self, timeout=None):
+    def _receive(self, timeout=None, parse=True):
         response = self._manager.receive(timeout=timeout,
-                with_channel=True)
+                with_channel=True, parse=parse)
         if response is None:
             raise OperationTimedOut
         return response
@@ -0,0 +1,93 @@
+"""Compression of `MultiplexerMessage` payloads (the ``message`` field, as
+indicated by the ``compression`` field). """
+
+import zlib
+
+from .Multiplexer_pb2 import MultiplexerMessage, Compression
+from .protobuf import DecodeError
+
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+"""``zlib`` window bits selecting the gzip format (as written by
+``java.util.zip.GZIPOutputStream``). """
+
+MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+"""Received payloads decompressing to more bytes are rejected by
+`decompress_message`. """
+
+
+class CompressionPolicy(object):
+
+    """Specifies which outgoing messages are compressed (with ``GZIP``).
+
+    A message is compressed when its payload has at least `threshold` bytes;
+    `types` may map message types to their own thresholds (``None`` disables
+    compression of the type). Messages whose payload would not shrink are
+    sent uncompressed.
+    """
+
+    def __init__(self, threshold=64 * 1024, level=1, types=None):
+        object.__init__(self)
+        assert 0 <= level <= 9, level
+        self.threshold = threshold
+        self.level = level
+        self.types = dict(types or ())
+
+    def compress_payload(self, payload, type):
+        """Returns `payload` of a message of `type` compressed with ``GZIP``
+        or ``None`` if it should be sent uncompressed. """
+        threshold = self.types.get(type, self.threshold)
+        if threshold is None or len(payload) < threshold:
+            return None
+        compressed = gzip_compress(payload, self.level)
+        if len(compressed) >= len(payload):
+            return None
+        return compressed
+
+    def compress(self, message):
+        """Returns `message` (a `MultiplexerMessage`) or its copy with the
+        payload compressed. """
+        if message.compression:
+            return message
+        payload = self.compress_payload(message.message, message.type)
+        if payload is None:
+            return message
+        compressed = MultiplexerMessage()
+        compressed.CopyFrom(message)
+        compressed.message = payload
+        compressed.compression = Compression.GZIP
+        return compressed
+
+def gzip_compress(data, level=1):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def gzip_decompress(data, max_size):
+    """Returns `data` decompressed. Raises ``DecodeError`` if `data` is not
+    a complete ``GZIP`` stream or decompresses to more than `max_size`
+    bytes (without decompressing the excess). """
+    decompressor = zlib.decompressobj(_GZIP_WBITS)
+    try:
+        payload = decompressor.decompress(data, max_size + 1)
+        if len(payload) > max_size:
+            raise DecodeError("Compressed payload exceeds %d bytes"
+                    % max_size)
+        # there is no ``eof`` in Python 2: a byte fed after the end of the
+        # stream is left unused
+        decompressor.decompress('\0')
+    except zlib.error, e:
+        raise DecodeError("Invalid compressed payload: %s" % (e,))
+    if not decompressor.unused_data:
+        raise DecodeError("Truncated compressed payload")
+    return payload
+
+def decompress_message(message, max_size=None):
+    """Decompresses the payload of `message` in place (if it is compressed).
+    Returns `message`. Raises ``DecodeError`` if the payload is invalid or
+    longer than `max_size` (`MAX_DECOMPRESSED_SIZE` by default) when
+    decompressed. """
+    if message.compression == Compression.GZIP:
+        if max_size is None:
+            max_size = MAX_DECOMPRESSED_SIZE
+        message.message = gzip_decompress(message.message, max_size)
+        message.ClearField('compression')
+    return message
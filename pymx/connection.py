@@ -1,38 +1,31 @@
 
 from __future__ import absolute_import, with_statement
 
-import os
 import sys
 from random import choice
-from threading import RLock, Thread, currentThread
+from threading import Lock, RLock, currentThread
 from functools import wraps, partial
 from itertools import chain
 from collections import deque
 from Queue import Queue, Empty
-from functools import partial
-import asyncore
 from google.protobuf.message import Message
 from .channel import Channel
-from .message import MultiplexerMessage
-from .frame import create_frame_header
+from .message import MultiplexerMessage, materialize_received, \
+        serialized_size
+from .frame import Frame
 # TODO require heartbits
 from .protocol import HEARTBIT_WRITE_INTERVAL, HEARTBIT_READ_INTERVAL, \
         WelcomeMessage
 from .protocol_constants import MessageTypes, PeerTypes
 from .protobuf import make_message, DecodeError, parse_message
-from .scheduler import Scheduler
-from .atomic import Atomic, synchronized
+from .atomic import Atomic
 from .timeout import Timeout
 from .future import Future
-from .limitedset import LimitedSet
-
-try:
-    file_dispatcher = asyncore.file_dispatcher
-    assert file_dispatcher
-except AttributeError:
-    # e.g. we are on windows
-    file_dispatcher = None
-    from .hacks.socket_pipe import socket_pipe
+from .limitedset import MessageIdSet, TimedMessageIdSet
+from .reactor import Reactor
+from .scheduler import ExpiryBatcher, Timer
+from .query import Query
+from .exc import OperationFailed
 
 
 def _listify(seq):
@@ -42,6 +35,12 @@ def _listify(seq):
         return seq
     return list(seq)
 
+def _fire_timer(timer):
+    """Calls the callback of `timer` unless it has been cancelled. """
+    callback, timer.callback = timer.callback, None
+    if callback is not None:
+        callback()
+
 def _schedule_in_io_thread(method):
     @wraps(method)
     def schedule_in_io_thread_wrapper(self, *args, **kwargs):
@@ -61,6 +60,50 @@ def _in_io_thread_only(method):
         return method(self, *args, **kwargs)
     return in_io_thread_wrapper
 
+def all_channels(dispatchers):
+    """Returns iterable over initialized channels among `dispatchers`. """
+    return (ch for ch in dispatchers
+            if isinstance(ch, Channel) and ch.protocol_initialized)
+
+def select_channels(dispatchers, connection):
+    """Returns channels from `dispatchers` selected by `connection`
+    (``ConnectionsManager.ONE``, ``ConnectionsManager.ALL`` or a `Channel`).
+    """
+    if connection is ConnectionsManager.ALL:
+        return all_channels(dispatchers)
+    if connection is ConnectionsManager.ONE:
+        channels = _listify(all_channels(dispatchers))
+        return channels and (choice(channels),)
+    if isinstance(connection, Channel):
+        return (connection,)
+    raise ValueError("Could not select channel for connection", connection)
+
+def handle_connection_welcome(message, channel, multiplexer_password):
+    """Validates CONNECTION_WELCOME received from a Multiplexer server and
+    marks `channel` as initialized (or closes it if validation fails). """
+    if channel.protocol_initialized:
+        # TODO use logging
+        print >> sys.stderr, "CONNECTION_WELCOME received on an already " \
+                "initialized channel", channel
+    else:
+        try:
+            welcome = parse_message(WelcomeMessage, message.message)
+        except DecodeError:
+            print >> sys.stderr, "received invalid CONNECTION_WELCOME", \
+                    repr(message.message), "on", channel
+        else:
+            if welcome.type != PeerTypes.MULTIPLEXER:
+                print >> sys.stderr, "received CONNECTION_WELCOME not " \
+                        "from MULTIPLEXER on", channel
+            elif multiplexer_password != welcome.multiplexer_password:
+                print >> sys.stderr, "received CONNECTION_WELCOME with " \
+                        "wrong multiplexer_password on", channel
+            else:
+                channel.protocol_initialized = True
+                return
+    channel.close()
+
+
 class ConnectionsManager(object):
 
     __creation_counter = Atomic(0)
@@ -71,131 +114,181 @@ class ConnectionsManager(object):
     _lock = None
     """A lock for shared data structures accessed by 2+ threads."""
 
-    _channel_map = None
-    """A dictionary of dispatchers used by ``asyncore``. Accessed only by IO
-    thread (and in __init__). """
+    _reactor = None
+    """The `pymx.reactor.Reactor` running IO thread (possibly shared with
+    other managers). """
 
-    _tasks = None
-    """A list of tasks scheduled for IO thread."""
+    _owns_reactor = False
 
-    _task_notifier_pipe = None
-    """A file-like object that can be used to wake up IO thread (or None if
-    this functionality is not available). Never accessed from IO thread. """
+    _channel_map = None
+    """An `pymx.ioloop.IOLoop` (a dictionary of ``asyncore`` dispatchers) of
+    the reactor. Accessed only by IO thread (and in __init__). """
 
     _io_thread = None
-    """An IO thread object. Never accessed from IO thread. """
+    """An IO thread object. """
 
     _is_closing = False
     """Specifies close order has already been issued. """
 
     _incoming_messages = None
-    """Queue of incoming messages not yet consumed by the client."""
+    """Queue of incoming messages not yet consumed by the client (an
+    `_IncomingQueue`). """
 
     _query_responses = None
-    """Dictionary of queues with respones to multiplexer queries."""
+    """Dictionary of queues with respones to multiplexer queries. Read by IO
+    thread without locking, modified with `_routes_lock` held. """
 
-    _recent_messages_pool = None
-    """Deduplication leaking set."""
+    _routes_lock = None
+    """A lock serializing modifications of `_query_responses`."""
 
-    def __init__(self, welcome_message, multiplexer_password=''):
+    _recent_messages_pool = None
+    """IDs of recently received messages, used for deduplication (a
+    `pymx.limitedset.MessageIdSet` or a
+    `pymx.limitedset.TimedMessageIdSet`). """
+
+    _dedup_filters = None
+    """Dictionary of deduplication sets (e.g.
+    `pymx.limitedset.RotatingBloomFilter`) used instead of
+    `_recent_messages_pool` by message types. """
+
+    _timed_pools = None
+    """`pymx.limitedset.TimedMessageIdSet` instances among deduplication
+    sets, expired periodically by IO thread. """
+
+    _queries = None
+    """Dictionary of `pymx.query.Query` objects by IDs of their messages.
+    Accessed only by IO thread. """
+
+    _stats = None
+    """Dictionary of `Atomic` counters, see `stats`."""
+
+    def __init__(self, welcome_message, multiplexer_password='',
+            io_backend=None, reactor=None, outgoing_limits=None,
+            incoming_limits=None, recent_messages=20000, dedup_window=None,
+            dedup_filters=None):
+        """Initializes new `ConnectionsManager` and starts its IO thread
+        (unless `reactor` is given).
+
+        :Parameters:
+            - `welcome_message`: CONNECTION_WELCOME message sent after
+              connecting
+            - `multiplexer_password`: password expected from Multiplexer
+              servers
+            - `io_backend`: one of `pymx.ioloop.backends` (by default the
+              best one available)
+            - `reactor`: a `pymx.reactor.Reactor` (e.g.
+              `pymx.reactor.shared_reactor`\ ``()``) to be used instead of a
+              private one; it is not closed by `close`
+            - `outgoing_limits`: `pymx.channel.QueueLimits` of outgoing
+              queues of the channels
+            - `incoming_limits`: `pymx.channel.QueueLimits` of the queue of
+              incoming messages (bytes are counted as lengths of serialized
+              messages); when it is full, channels stop reading until it
+              drains (``policy``, ``timeout`` and ``callback`` are not used)
+            - `recent_messages`: number of IDs of received messages
+              remembered to drop duplicates
+            - `dedup_window`: if given, IDs of received messages are
+              remembered for this many seconds instead (`recent_messages`
+              is not used)
+            - `dedup_filters`: optional ``dict`` mapping message types to
+              objects used to deduplicate messages of these types instead
+              of `recent_messages` or `dedup_window` (e.g. a
+              `pymx.limitedset.RotatingBloomFilter` for high volume
+              telemetry that tolerates occasional false duplicates); their
+              ``add(message_id)`` returns ``False`` for duplicates and
+              ``duplicates`` counts them. Messages referencing other messages
+              (e.g. query responses) are always deduplicated exactly
+        """
         object.__init__(self)
         self._lock = RLock()
-        self._channel_map = {}
-        self._tasks = []
-        self._incoming_messages = Queue()
+        if reactor is None:
+            reactor = Reactor(io_backend=io_backend,
+                    name='ConnectionsManager-IO-Thread-#' +
+                    str(ConnectionsManager.__creation_counter.inc()))
+            self._owns_reactor = True
+        elif io_backend is not None:
+            raise ValueError("io_backend cannot be used with a reactor")
+        self._reactor = reactor
+        self._channel_map = reactor.io_loop
+        self._io_thread = reactor.thread
+        self._own_channels = frozenset()
+        self._incoming_messages = _IncomingQueue(incoming_limits,
+                self._incoming_full_changed)
         self._query_responses = {}
-        self._recent_messages_pool = LimitedSet()
+        self._routes_lock = Lock()
+        self._queries = {}
+        # routes and queries are removed in batches by IO thread
+        self._expired_routes = ExpiryBatcher(self._channel_map.call_later,
+                lambda message_ids: self.unset_queue_for_message(
+                    message_ids=message_ids))
+        self._expired_queries = ExpiryBatcher(self._channel_map.call_later,
+                self.unregister_query)
+        if dedup_window is None:
+            self._recent_messages_pool = MessageIdSet(recent_messages)
+        else:
+            self._recent_messages_pool = TimedMessageIdSet(dedup_window)
+        self._dedup_filters = dict(dedup_filters or ())
+        self._timed_pools = [pool for pool in set(chain(
+            self._dedup_filters.itervalues(), [self._recent_messages_pool]))
+            if isinstance(pool, TimedMessageIdSet)]
+        if self._timed_pools:
+            self.call_later(0, self._expire_timed_pools)
+        self._stats = dict((name, Atomic(0)) for name in ('not_connected',
+            'outgoing_full', 'outgoing_dropped', 'outgoing_rejected',
+            'incoming_full'))
+        self._outgoing_limits = outgoing_limits
 
         assert isinstance(welcome_message, MultiplexerMessage)
-        welcome_message = welcome_message.SerializeToString()
-        self._welcome_frame = create_frame_header(welcome_message) + \
-                welcome_message
+        self._welcome_frame = Frame.from_message(welcome_message)
+        self._heartbit_frame = Frame.from_message(make_message(
+            MultiplexerMessage, type=MessageTypes.HEARTBIT))
         self._multiplexer_password = multiplexer_password or ''
 
-        self._task_notifier_pipe = None
-        self._create_task_notifier()
-
-        self._scheduler = Scheduler()
-
-        self._io_thread = None
-        self._start_io_thread()
-
-    def _create_task_notifier(self):
-        """Create ``self._task_notifier_pipe`` and register appropriate
-        read-end in the ``self._channel_map``. """
-
-        if file_dispatcher is not None:
-            # create pipe-based task notifier
-            read_end, write_end = os.pipe()
-            try:
-                writer = os.fdopen(write_end, 'w', 0)
-                _TaskNotifier(fd=read_end, map=self._channel_map)
-            except Exception:
-                try:
-                    os.close(write_end)
-                except Exception:
-                    pass
-                raise
-            finally:
-                os.close(read_end)
-            self._task_notifier_pipe = writer
-
-        else:
-            # create socket-based task notifier
-            read_end, write_end = socket_pipe()
-            _TaskNotifier(sock=read_end, map=self._channel_map)
-            self._task_notifier_pipe = write_end.makefile('w', 0)
-
-    def _start_io_thread(self):
-        self._io_thread = Thread(target=self._io_main,
-                name='ConnectionsManager-IO-Thread-#' +
-                str(ConnectionsManager.__creation_counter.inc()))
-        self._io_thread.setDaemon(True)
-        self._io_thread.start()
-
-    def _io_main(self):
-        while self._channel_map:
-            asyncore.loop(count=1, map=self.channel_map)
-            with self._lock:
-                tasks, self._tasks[:] = self._tasks[:], ()
-            for task in tasks:
-                task()
-
     @property
     def channel_map(self):
         return self._channel_map
 
+    @property
+    def reactor(self):
+        return self._reactor
+
+    @property
+    def _channels(self):
+        """Channels of this manager (the reactor may be shared). The set is
+        replaced, not modified, by IO thread, so any thread may iterate it.
+        """
+        return self._own_channels
+
     @property
     def _all_channels(self):
-        return (ch for ch in self.channel_map.itervalues()
-                if isinstance(ch, Channel) and ch.protocol_initialized)
+        return all_channels(self._channels)
 
     def _enque_io_task(self, *args, **kwargs):
-        task = partial(*args, **kwargs)
         assert currentThread() is not self._io_thread
-        with self._lock:
-            self._tasks.append(task)
-        try:
-            self._task_notifier_pipe.write('t')
-        except IOError:
+        if not self._reactor.submit(*args, **kwargs):
             with self._lock:
-                assert self._is_closing
+                assert self._is_closing or self._reactor.is_closing
 
     def close(self, timeout=10):
         with self._lock:
             if self._is_closing:
                 return
             self._is_closing = True
-        self._shutdown()
-        self._scheduler.close(complete=False)
-        self._io_thread.join(timeout=timeout)
-        if self._io_thread.isAlive():
-            raise RuntimeError("IO thread is still alive")
+        shutdown = self._shutdown()
+        if self._owns_reactor:
+            self._reactor.close(timeout=timeout)
+        elif currentThread() is not self._io_thread:
+            shutdown.wait(timeout)
 
     @_schedule_in_io_thread
     def _shutdown(self, future):
         with future:
-            asyncore.close_all(map=self.channel_map)
+            for channel in list(self._channels):
+                channel.close()
+            queries = set(self._queries.itervalues())
+            self._queries.clear()
+            for query in queries:
+                query.abort(OperationFailed("Client closed"))
             future.set(True)
 
     @_schedule_in_io_thread
@@ -205,7 +298,10 @@ class ConnectionsManager(object):
             assert currentThread() is self._io_thread, \
                     "this code must be called by IO thread only"
             ch = Channel(address=address, manager=self, connect_future=future,
-                    reconnect=reconnect)
+                    reconnect=reconnect, limits=self._outgoing_limits)
+            self._own_channels = self._own_channels | frozenset((ch,))
+            if self._incoming_messages.is_over_limit:
+                ch.pause_reading()
             with self._lock:
                 if self._is_closing:
                     ch.close()
@@ -222,96 +318,269 @@ class ConnectionsManager(object):
     def handle_disconnect(self, channel):
         channel.protocol_initialized = False
         if channel.reconnect is not None:
-            self._scheduler.schedule(channel.reconnect, self.connect,
+            self._channel_map.call_later(channel.reconnect, self.connect,
                     channel.address, reconnect=channel.reconnect)
 
+    def handle_channel_closed(self, channel):
+        # called by IO thread (when it closes the channel)
+        self._own_channels = self._own_channels - frozenset((channel,))
+
+    @_in_io_thread_only
+    def _expire_timed_pools(self):
+        # IDs are released even if no messages are received
+        if self._is_closing:
+            return
+        for pool in self._timed_pools:
+            pool.expire()
+        self._channel_map.call_later(min(pool.period for pool in
+            self._timed_pools), self._expire_timed_pools)
+
+    @_in_io_thread_only
     def _send_heartbit(self, channel):
-        with self._lock:
-            if not channel.connected or self._is_closing:
-                return
-            channel.enque_outgoing(make_message(MultiplexerMessage,
-                type=MessageTypes.HEARTBIT))
-            self._scheduler.schedule(HEARTBIT_WRITE_INTERVAL,
+        # `_is_closing` is only ever set, so it's read without locking
+        if not channel.connected or self._is_closing:
+            return
+        channel.enque_outgoing(self._heartbit_frame)
+        self._channel_map.call_later(HEARTBIT_WRITE_INTERVAL,
                 self._send_heartbit, channel)
 
+    def send_message(self, message, connection):
+        """Sends `message` (a `MultiplexerMessage`, a `Frame` or a raw frame)
+        to channels selected by `connection`. Returns `Future` set to the
+        number of channels used.
+
+        When called outside the IO thread, the message is written to the
+        sockets by the calling thread (see `Channel.send_directly`); only an
+        unsent remainder is left for the IO thread. If the outgoing queue
+        limits reject the message on any channel, the `Future` is set to the
+        error, although the other channels may have sent the message.
+        """
+        if currentThread() is self._io_thread:
+            return self._send_message(message, connection)
+        future = Future()
+        with future:
+            try:
+                count = self._send_directly(message, connection)
+            except OperationFailed, e:
+                future.set_exception(e)
+            else:
+                if not count:
+                    future.set_error("Not Connected")
+                else:
+                    future.set(count) # TODO we don't know when it's flushed
+        return future
+
+    def publish(self, message, connection):
+        """Like `send_message`, but returns nothing and allocates no `Future`.
+        Messages that could not be sent are counted in `stats` instead. """
+        if currentThread() is self._io_thread:
+            count = self.send_now(message, connection)
+        else:
+            try:
+                count = self._send_directly(message, connection)
+            except OperationFailed:
+                # counted as ``outgoing_rejected``
+                return
+        if not count:
+            self.count('not_connected')
+
+    @property
+    def stats(self):
+        """A ``dict`` with current values of statistics counters:
+
+            ``not_connected``
+                number of messages passed to `publish` which were not sent
+                because no channel was selected
+            ``outgoing_full``
+                number of times an outgoing queue reached its high watermark
+            ``outgoing_dropped``
+                number of frames dropped because of full outgoing queues
+            ``outgoing_rejected``
+                number of sends failed because of full outgoing queues
+            ``incoming_full``
+                number of times reading was paused because of the full
+                queue of incoming messages
+            ``duplicates``
+                number of received messages dropped as duplicates
+
+        See `pymx.channel.QueueLimits`.
+        """
+        stats = dict((name, counter.get()) for name, counter in
+                self._stats.iteritems())
+        pools = set(self._dedup_filters.itervalues())
+        pools.add(self._recent_messages_pool)
+        stats['duplicates'] = sum(pool.duplicates for pool in pools)
+        return stats
+
+    def count(self, name, how=1):
+        """Increments `stats` counter `name`. """
+        self._stats[name].inc(how)
+
+    def _send_directly(self, message, connection):
+        """Sends `message` from the calling (not IO) thread. Returns number
+        of channels used. If sending over a channel fails, the message is
+        still sent over the other selected channels and then the first
+        error is raised (so a failed ``ALL`` send may be partially
+        delivered). """
+        if isinstance(message, Message):
+            message = Frame.from_message(message)
+        count = 0
+        unflushed = []
+        error = None
+        for channel in self._get_channels(connection):
+            try:
+                if channel.send_directly(message):
+                    unflushed.append(channel)
+            except OperationFailed, e:
+                error = error or e
+            count += 1
+        if unflushed:
+            self._enque_io_task(self._flush_channels, unflushed)
+        if error is not None:
+            raise error
+        return count
+
+    def _incoming_full_changed(self, full):
+        # called with the queue mutex held
+        if full:
+            self.count('incoming_full')
+        if currentThread() is self._io_thread:
+            self._update_reading()
+        else:
+            self._enque_io_task(self._update_reading)
+
+    @_in_io_thread_only
+    def _update_reading(self):
+        if self._incoming_messages.is_over_limit:
+            for channel in self._channels:
+                channel.pause_reading()
+        else:
+            for channel in self._channels:
+                channel.resume_reading()
+
+    @_in_io_thread_only
+    def _flush_channels(self, channels):
+        for channel in channels:
+            channel.flush()
+
     @_schedule_in_io_thread
-    def send_message(self, future, message, connection):
+    def _send_message(self, future, message, connection):
         with future:
-            if isinstance(message, Message):
-                message = message.SerializeToString()
-                message = create_frame_header(message) + message
-            channels = self._get_channels(connection)
-            i = -1
-            for i, channel in enumerate(channels):
-                assert isinstance(channel, Channel), self.channel_map
-                channel.enque_outgoing(message)
-            if i < 0:
+            count = self.send_now(message, connection)
+            if not count:
                 future.set_error("Not Connected")
             else:
-                future.set(i + 1) # TODO we don't know when it's flushed
+                future.set(count) # TODO we don't know when it's flushed
+
+    @_in_io_thread_only
+    def send_now(self, message, connection):
+        """Queue `message` on channels selected by `connection`. Returns number
+        of channels used. """
+        if isinstance(message, Message):
+            # serialize once, queue the same frame on every channel
+            message = Frame.from_message(message)
+        count = 0
+        for channel in self._get_channels(connection):
+            assert isinstance(channel, Channel), self.channel_map
+            channel.enque_outgoing(message)
+            count += 1
+        return count
+
+    def query(self, create_message, message, type, timeout, fields=None,
+            skip_resend=False):
+        """Starts a `pymx.query.Query` in the IO thread. Returns `Future` set
+        to its outcome. """
+        return self.query_many(create_message, [{'message': message,
+            'type': type, 'timeout': timeout, 'fields': fields,
+            'skip_resend': skip_resend}])[0]
+
+    def query_many(self, create_message, queries):
+        """Starts a `pymx.query.Query` for every ``dict`` of arguments in
+        `queries` (in a single IO task). Returns list of futures. """
+        client = _QueryClient(self, create_message)
+        queries = [Query(client, **query) for query in queries]
+        with self._lock:
+            if self._is_closing:
+                for query in queries:
+                    query.abort(OperationFailed("Client closed"))
+                return [query.future for query in queries]
+        if currentThread() is self._io_thread:
+            self._start_queries(queries)
+        else:
+            self._enque_io_task(self._start_queries, queries)
+        return [query.future for query in queries]
+
+    @_in_io_thread_only
+    def _start_queries(self, queries):
+        for query in queries:
+            query.start()
+
+    @_in_io_thread_only
+    def register_query(self, message_id, query):
+        self._queries[message_id] = query
+
+    @_in_io_thread_only
+    def unregister_query(self, message_ids, delay=0):
+        if delay:
+            self._expired_queries.add(delay, message_ids)
+            return
+        for message_id in message_ids:
+            self._queries.pop(message_id, None)
 
     def _get_channels(self, connection):
-        if connection is ConnectionsManager.ALL:
-            return self._all_channels
-        if connection is ConnectionsManager.ONE:
-            channels = _listify(self._all_channels)
-            return channels and (choice(channels),)
-        if isinstance(connection, Channel):
-            return (connection,)
-        raise ValueError("Could not select channel for connection", connection)
+        return select_channels(self._channels, connection)
 
     def __handle_connection_welcome(self, message, channel):
-        if channel.protocol_initialized:
-            # TODO use logging
-            print >> sys.stderr, "CONNECTION_WELCOME received on an already " \
-                    "initialized channel", channel
-        else:
-            try:
-                welcome = parse_message(WelcomeMessage, message.message)
-            except DecodeError:
-                print >> sys.stderr, "received invalid CONNECTION_WELCOME", \
-                        repr(message.message), "on", channel
-            else:
-                if welcome.type != PeerTypes.MULTIPLEXER:
-                    print >> sys.stderr, "received CONNECTION_WELCOME not " \
-                            "from MULTIPLEXER on", channel
-                elif self._multiplexer_password != \
-                        welcome.multiplexer_password:
-                    print >> sys.stderr, "received CONNECTION_WELCOME with " \
-                            "wrong multiplexer_password on", channel
-                else:
-                    channel.protocol_initialized = True
-                    return
-        channel.close()
+        handle_connection_welcome(message, channel,
+                self._multiplexer_password)
 
     def __handle_heartbit(self, message, channel):
         pass
 
-    @synchronized
     def __get_queue_for_message(self, message):
+        # No lock: a single ``dict.get`` is atomic and the writers never
+        # leave the dictionary in an intermediate state.
         return self._query_responses.get(message.references,
                 self._incoming_messages)
 
-    @synchronized
     def set_queue_for_message(self, references, queue):
-        if queue is None:
-            old = self._query_responses.pop(references, None)
-        else:
-            old = self._query_responses.get(references)
-            self._query_responses[references] = queue
-        return old
+        with self._routes_lock:
+            if queue is None:
+                old = self._query_responses.pop(references, None)
+            else:
+                old = self._query_responses.get(references)
+                self._query_responses[references] = queue
+            return old
 
-    @synchronized
     def unset_queue_for_message(self, message_id=None, message_ids=()):
         if message_id is not None:
             message_ids = chain(message_ids, (message_id,))
-        for mid in message_ids:
-            self.set_queue_for_message(references=mid, queue=None)
+        with self._routes_lock:
+            for mid in message_ids:
+                self._query_responses.pop(mid, None)
 
     def delayed_unset_queue_for_message(self, delay, message_id=None,
             message_ids=()):
-        self._scheduler.schedule(delay, self.unset_queue_for_message,
-                message_id=message_id, message_ids=message_ids)
+        message_ids = list(message_ids)
+        if message_id is not None:
+            message_ids.append(message_id)
+        if currentThread() is self._io_thread:
+            self._expired_routes.add(delay, message_ids)
+        else:
+            self._enque_io_task(self._expired_routes.add, delay, message_ids)
+
+    def call_later(self, delay, callback, *args, **kwargs):
+        """Schedules ``callback(*args, **kwargs)`` to be called by IO thread
+        after `delay` seconds. Can be called from any thread. Returns a
+        `pymx.scheduler.Timer`, whose ``cancel()`` prevents the call (unless
+        the callback is already running). """
+        if currentThread() is self._io_thread:
+            return self._channel_map.call_later(delay, callback, *args,
+                    **kwargs)
+        timer = Timer(None, partial(callback, *args, **kwargs))
+        self._enque_io_task(self._channel_map.call_later, delay, _fire_timer,
+                timer)
+        return timer
 
     @staticmethod # this function is called with explicit 'self'
     def __default_message_handler(self, message, channel):
@@ -325,7 +594,14 @@ class ConnectionsManager(object):
 
     @_in_io_thread_only
     def handle_message(self, message, channel):
-        if not self._recent_messages_pool.add(message.id):
+        pool = self._recent_messages_pool
+        if self._dedup_filters and not message.references:
+            pool = self._dedup_filters.get(message.type, pool)
+        if not pool.add(message.id):
+            return
+        query = self._queries.get(message.references)
+        if query is not None:
+            query.handle_response(message, channel)
             return
         handler = self.__message_handlers.get(message.type,
                 self.__default_message_handler)
@@ -337,10 +613,86 @@ class ConnectionsManager(object):
     def receive(self, *args, **kwargs):
         return receive(self._incoming_messages, *args, **kwargs)
 
+    def receive_many(self, max_count, timeout=None):
+        """See `_IncomingQueue.get_many`. """
+        return self._incoming_messages.get_many(max_count, timeout)
+
+
+class _IncomingQueue(Queue):
+
+    """A `Queue` of incoming messages (``dict`` objects with a ``message``)
+    bounded by `pymx.channel.QueueLimits`. Watermark crossings are reported
+    by ``full_changed(full)`` calls (with the queue mutex held). Nothing is
+    ever rejected: the producer is expected to stop when the queue is
+    full. """
+
+    def __init__(self, limits, full_changed):
+        Queue.__init__(self)
+        self._limits = limits
+        self._full_changed = full_changed
+        self._bytes = 0
+        self.is_over_limit = False
+        """Whether the queue reached the high watermark and has not drained
+        to the low watermark since. """
+
+    # `len` and `frames` are used by `QueueLimits`
+
+    def __len__(self):
+        return self._bytes
+
+    @property
+    def frames(self):
+        return len(self.queue)
+
+    def _put(self, item):
+        Queue._put(self, item)
+        self._bytes += serialized_size(item['message'])
+        if not self.is_over_limit and self._limits is not None and \
+                self._limits.is_full(self):
+            self.is_over_limit = True
+            self._full_changed(True)
+
+    def _get(self):
+        item = Queue._get(self)
+        self._bytes -= serialized_size(item['message'])
+        if self.is_over_limit and self._limits.is_drained(self):
+            self.is_over_limit = False
+            self._full_changed(False)
+        return item
+
+    def get_many(self, max_count, timeout=None):
+        """Removes and returns up to `max_count` ``(message, channel)``
+        pairs, acquiring the queue mutex once (messages are parsed after
+        releasing it, see `pymx.message.MessageView`; invalid ones are
+        dropped). Waits at most `timeout` seconds (forever if ``None``) for
+        the first item; returns an empty list if none arrives. """
+        self.not_empty.acquire()
+        try:
+            if timeout is None:
+                while not self._qsize():
+                    self.not_empty.wait()
+            else:
+                timer = Timeout(timeout)
+                while not self._qsize():
+                    if not timer.remaining:
+                        return []
+                    self.not_empty.wait(timer.timeout)
+            get = self._get
+            items = [get() for _ in xrange(min(max_count, self._qsize()))]
+            self.not_full.notify()
+        finally:
+            self.not_empty.release()
+        received = []
+        for item in items:
+            message = materialize_received(item['message'], item['channel'])
+            if message is not None:
+                received.append((message, item['channel']))
+        return received
+
 
 #def receive(queue, timeout, ignore_types=(), filter=None):
 def receive(queue, timeout, ignore_types=(), with_channel=False,
-        message_acceptor=lambda received: True):
+        message_acceptor=lambda received: True, parse=True):
     timer = Timeout(timeout)
     #filter = (filter or {}).items()
     while timer.remaining:
@@ -353,6 +705,11 @@ def receive(queue, timeout, ignore_types=(), with_channel=False,
         # check if it's not an ignored type
         if received.type in ignore_types:
             continue
+        # parse in the receiving thread, see `pymx.message.MessageView`
+        if parse:
+            received = materialize_received(received, channel)
+            if received is None:
+                continue
 
         ## check if it's not excluded by the filter
         #try:
@@ -434,14 +791,17 @@ class _QueryContextManager(object):
         self._message_ids = []
 
 
-class _TaskNotifier(file_dispatcher or asyncore.dispatcher):
+class _QueryClient(object):
 
-    ignore_log_types = ()
-
-    def handle_read(self):
-        self.recv(512)
-
-    def writable(self):
-        return False
+    """Interface of `ConnectionsManager` required by `pymx.query.Query`. """
 
+    ONE = ConnectionsManager.ONE
+    ALL = ConnectionsManager.ALL
 
+    def __init__(self, manager, create_message):
+        object.__init__(self)
+        self.create_message = create_message
+        self.send_now = manager.send_now
+        self.call_later = manager.channel_map.call_later
+        self.register_query = manager.register_query
+        self.unregister_query = manager.unregister_query
@@ -3,3 +3,26 @@ class MultiplexerException(Exception):
     """All exception riased by pyMX library should inherit from
     `MultiplexerException`. """
     pass
+
+class OperationFailed(MultiplexerException):
+    """Raised when operation fails for any reason. """
+    pass
+
+class OperationTimedOut(OperationFailed):
+    """Raised when operation times out. """
+    pass
+
+class OutgoingQueueFull(OperationFailed):
+    """Raised when a message is sent while the outgoing queue of a channel is
+    full (see `pymx.channel.QueueLimits`). """
+    pass
+
+class BackendError(OperationFailed):
+    """Error reported by BACKEND is transformed into `BackendError` exception
+    and re-raised on the client side. """
+    pass
+
+class BackendWorkerError(MultiplexerException):
+    """Raised by `pymx.backend.MultiplexerBackend.loop` when a message handler
+    failed in a worker process and the exception was not handled. """
+    pass
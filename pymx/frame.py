@@ -29,6 +29,30 @@ def create_frame_header(contents):
 def create_frame(contents):
     return create_frame_header(contents) + contents
 
+class Frame(object):
+
+    """An immutable, ready to send frame. The header (with CRC) is computed
+    once, so the same `Frame` can be queued on many channels without copying
+    nor re-serializing its contents. """
+
+    __slots__ = ('header', 'contents')
+
+    def __init__(self, contents):
+        object.__init__(self)
+        self.header = create_frame_header(contents)
+        self.contents = contents
+
+    @classmethod
+    def from_message(cls, message):
+        """Creates a `Frame` with serialized ``message`` as contents. """
+        return cls(message.SerializeToString())
+
+    def __len__(self):
+        return len(self.header) + len(self.contents)
+
+    def __str__(self):
+        return self.header + self.contents
+
 def unpack_frame_header(header):
     return struct.unpack(_frame_header_format, header)
 
@@ -114,3 +138,183 @@ class Deframer(object):
 
     def _get_data(self, data_length):
         return self._bytes_fifo.get_all(data_length)
+
+
+class BufferDeframer(object):
+
+    """A zero-copy variant of `Deframer`.
+
+    Received data is stored in a single growable ``bytearray``. Use
+    `recv_into` to read from a socket directly into the buffer (or `push` to
+    copy already received chunk). Frame headers are parsed in place and frame
+    contents are checked and returned without intermediate copies: either as
+    read-only views of the internal buffer (valid only until the next call to
+    `recv_into` or `push`) or as a single ``str`` copy.
+    """
+
+    def __init__(self, size=8192, copy=True):
+        """Initializes new `BufferDeframer` instance.
+
+        :Parameters:
+            - `size`: initial size of the internal buffer (it grows when a
+              frame does not fit)
+            - `copy`: if true, frame contents are returned as ``str``
+              instances, otherwise as ``buffer`` views
+        """
+        object.__init__(self)
+        self._buffer = bytearray(max(size, _frame_header_length))
+        self._start = self._end = 0
+        self._copy = copy
+
+    def __len__(self):
+        """Returns the number of received but not yet deframed bytes."""
+        return self._end - self._start
+
+    available_bytes = property(__len__)
+
+    def _missing_bytes(self):
+        """Returns the number of bytes required to complete the next frame
+        (or the next frame header). """
+        available = self._end - self._start
+        if available < _frame_header_length:
+            return _frame_header_length - available
+        length, _ = struct.unpack_from(_frame_header_format, self._buffer,
+                self._start)
+        return max(_frame_header_length + length - available, 0)
+
+    def _reserve(self, nbytes):
+        """Makes room for at least ``nbytes`` after the received data,
+        compacting or growing the buffer if needed. """
+        buffer_ = self._buffer
+        if len(buffer_) - self._end >= nbytes:
+            return
+        pending = self._end - self._start
+        size = len(buffer_)
+        while size - pending < nbytes:
+            size *= 2
+        if size > len(buffer_):
+            self._buffer = bytearray(size)
+            self._buffer[:pending] = buffer(buffer_, self._start, pending)
+        else:
+            buffer_[:pending] = buffer_[self._start:self._end]
+        self._start, self._end = 0, pending
+
+    def recv_into(self, recv_into, nbytes):
+        """Receive data directly into the internal buffer.
+
+        Returns the number of bytes received (``0`` on end of stream).
+
+        :Parameters:
+            - `recv_into`: a function with ``socket.recv_into`` signature
+            - `nbytes`: preferred number of bytes to receive; more is
+              requested if the pending frame is longer
+        """
+        nbytes = max(nbytes, self._missing_bytes())
+        self._reserve(nbytes)
+        view = memoryview(self._buffer)[self._end:self._end + nbytes]
+        try:
+            received = recv_into(view, nbytes)
+        finally:
+            del view
+        self._end += received
+        return received
+
+    def _put(self, chunk):
+        if chunk:
+            # Reserving room for the whole pending frame lets the buffer be
+            # compacted while the frame is still short.
+            self._reserve(max(len(chunk), self._missing_bytes()))
+            self._buffer[self._end:self._end + len(chunk)] = chunk
+            self._end += len(chunk)
+
+    def push(self, chunk):
+        """Returns iterator over zero or more unpacked frame contents
+        available after receiving additional ``chunk``. Same as
+        `Deframer.push`. """
+        self._put(chunk)
+        return self.frames()
+
+    def push_many(self, chunk):
+        """Same as `push`, but returns a list of all unpacked frame contents
+        available after receiving ``chunk``. """
+        self._put(chunk)
+        return self.pop_frames()
+
+    def pop_frames(self):
+        """Returns a list of unpacked contents of all complete frames available
+        in the buffer. """
+        buffer_ = self._buffer
+        if self._copy:
+            return [str(buffer(buffer_, offset, length)) for offset, length in
+                    self.pop_frame_offsets()]
+        else:
+            return [buffer(buffer_, offset, length) for offset, length in
+                    self.pop_frame_offsets()]
+
+    def pop_frame_offsets(self):
+        """Removes all complete frames from the buffer and returns a list of
+        ``(offset, length)`` pairs locating their (already validated)
+        contents in `buffer`. The offsets are valid until the next call to
+        `recv_into` or `push`. Raises `FrameCorruptedError` on a frame with
+        invalid CRC, but only if no frame precedes it (otherwise the
+        preceding frames are returned and the next call raises). """
+        buffer_ = self._buffer
+        unpack_from = struct.unpack_from
+        crc32 = zlib.crc32
+        start, end = self._start, self._end
+        offsets = []
+        while end - start >= _frame_header_length:
+            length, crc = unpack_from(_frame_header_format, buffer_, start)
+            offset = start + _frame_header_length
+            if end - offset < length:
+                break
+            if crc32(buffer(buffer_, offset, length)) != crc:
+                if offsets:
+                    # deliver the valid frames first
+                    break
+                self._start = offset + length
+                raise FrameCorruptedError((buffer(buffer_, offset, length),
+                    crc))
+            start = offset + length
+            offsets.append((offset, length))
+        if start == end:
+            # Nothing pending, the next data can be placed at the beginning.
+            # Contents pointed by `offsets` are not overwritten until the next
+            # `recv_into` or `push`.
+            start = end = 0
+        self._start, self._end = start, end
+        return offsets
+
+    @property
+    def buffer(self):
+        """The internal buffer (as ``bytearray``). """
+        return self._buffer
+
+    def frames(self):
+        """Returns iterator over unpacked contents of the complete frames
+        available in the buffer. More data may be received (with `push` or
+        `recv_into`) while the iterator is suspended; the frames it yields
+        later come from the current buffer. """
+        while True:
+            # the buffer may have been compacted or replaced since the last
+            # step
+            buffer_, start = self._buffer, self._start
+            available = self._end - start
+            if available < _frame_header_length:
+                break
+            length, crc = struct.unpack_from(_frame_header_format, buffer_,
+                    start)
+            if available < _frame_header_length + length:
+                break
+            offset = start + _frame_header_length
+            contents = buffer(buffer_, offset, length)
+            try:
+                check_contents_crc(contents, crc)
+                if self._copy:
+                    contents = str(contents)
+            finally:
+                # a corrupted frame is skipped
+                self._start = offset + length
+                if self._start == self._end:
+                    self._start = self._end = 0
+            yield contents
@@ -1,6 +1,6 @@
 
 from sys import exc_info
-from threading import Event
+from threading import Event, Lock
 from traceback import format_exception
 
 from .timeout import Timeout
@@ -14,16 +14,26 @@ class FutureError(FutureException):
 class FutureTimeout(FutureException):
     pass
 
+class _ExceptionFutureError(FutureError):
+    """An error carrying an exception to be re-raised by `Future.value`. """
+    def __init__(self, exception):
+        FutureError.__init__(self, exception)
+        self.exception = exception
+
 class Future(object):
 
     """Future is a placeholder for a function result calculated presumably in
     another thread. """
 
+    _callbacks = None
+
     def __init__(self):
         object.__init__(self)
         self._has_value = Event()
         assert not self._has_value.isSet()
         self._value = None
+        # guards `_callbacks` and setting the value
+        self._callbacks_lock = Lock()
 
     def set(self, value):
         """Set internal value. Not safe to call after `set` or `set_error` have
@@ -33,8 +43,24 @@ class Future(object):
         self._set(value)
 
     def _set(self, value):
-        self._value = value
-        self._has_value.set()
+        with self._callbacks_lock:
+            self._value = value
+            self._has_value.set()
+            callbacks, self._callbacks = self._callbacks, None
+        for callback in callbacks or ():
+            callback(self)
+
+    def add_callback(self, callback):
+        """Call ``callback(future)`` when the internal value is set (or
+        immediately, if it has already been set). Callbacks are run by the
+        thread setting the value. """
+        with self._callbacks_lock:
+            if not self._has_value.isSet():
+                if self._callbacks is None:
+                    self._callbacks = []
+                self._callbacks.append(callback)
+                return
+        callback(self)
 
     def set_error(self, message=None, exc=None):
         """Set internal value to an error. Not safe to call after `set` or
@@ -50,6 +76,12 @@ class Future(object):
         finally:
             exc = None
 
+    def set_exception(self, exception):
+        """Set internal value to an error, which will be raised as
+        ``exception`` by `value` and `wait`. Not safe to call after `set` or
+        `set_error` have been called. Not thread-safe. """
+        self._set(_ExceptionFutureError(exception))
+
     @property
     def has_value(self):
         return self._has_value.isSet()
@@ -64,6 +96,8 @@ class Future(object):
         """Get value or raise exception if an error occurred. Not safe to
         called before `wait` has been called. """
         value = self._value
+        if isinstance(value, _ExceptionFutureError):
+            raise value.exception
         if isinstance(value, FutureError):
             raise value
         return value
@@ -87,6 +121,62 @@ class Future(object):
             exc_info = None
 
 
+class Return(Exception):
+    """Raised by a coroutine run with `run_coroutine` to finish with a value.
+    """
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+def run_coroutine(generator):
+    """Runs a generator based coroutine. The generator yields `Future`
+    objects; when a yielded future is set, its value is sent back into the
+    generator (or its exception is thrown into it). Nothing blocks: the
+    coroutine is resumed by the thread setting the future.
+
+    Returns `Future` set to the value of `Return` raised by the coroutine
+    (``None`` if it simply finishes) or to the exception it raises. """
+    result = Future()
+
+    def _step(value=None, exception=None):
+        while True:
+            try:
+                if exception is not None:
+                    yielded = generator.throw(exception)
+                else:
+                    yielded = generator.send(value)
+            except StopIteration:
+                result.set(None)
+                return
+            except Return, r:
+                result.set(r.value)
+                return
+            except Exception, e:
+                result.set_exception(e)
+                return
+            if not isinstance(yielded, Future):
+                generator.close()
+                result.set_exception(TypeError("Coroutine yielded %r, "
+                    "Future expected" % (yielded,)))
+                return
+            if not yielded.has_value:
+                yielded.add_callback(_resume)
+                return
+            value, exception = _outcome(yielded)
+
+    def _resume(future):
+        _step(*_outcome(future))
+
+    _step()
+    return result
+
+def _outcome(future):
+    try:
+        return future.value, None
+    except Exception, e:
+        return None, e
+
+
 def wait_all(*futures, **options):
     timeout = options.pop('timeout', None)
     assert not options, "redundant arguments passed"
@@ -0,0 +1,39 @@
+"""
+Provides ``eventfd(initval=0, flags=EFD_CLOEXEC | EFD_NONBLOCK)``, a wrapper
+of Linux ``eventfd(2)`` (called through ``ctypes``). ``eventfd`` is ``None``
+on platforms where it is not available.
+"""
+
+from __future__ import absolute_import
+
+import os
+import sys
+
+EFD_CLOEXEC = 02000000
+EFD_NONBLOCK = 04000
+
+
+def _load_eventfd():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                use_errno=True)
+        libc_eventfd = libc.eventfd
+    except (ImportError, EnvironmentError, AttributeError, TypeError):
+        return None
+    libc_eventfd.argtypes = (ctypes.c_uint, ctypes.c_int)
+    libc_eventfd.restype = ctypes.c_int
+
+    def eventfd(initval=0, flags=EFD_CLOEXEC | EFD_NONBLOCK):
+        fd = libc_eventfd(initval, flags)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return fd
+
+    return eventfd
+
+eventfd = _load_eventfd()
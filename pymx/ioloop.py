@@ -0,0 +1,247 @@
+"""An ``asyncore`` compatible IO loop with persistent poller registrations.
+
+`IOLoop` is a socket map (a ``dict`` mapping file descriptors to
+dispatchers), so it can be passed as ``map`` to any ``asyncore.dispatcher``.
+Dispatchers are registered in the underlying poller (``epoll``, ``poll`` or
+``select``) when added to the map and unregistered when removed, instead of
+rebuilding the descriptor sets on every iteration. Read/write interest is
+re-evaluated only after an event is dispatched to a dispatcher or when
+`IOLoop.update_interest` is called (e.g. when an outgoing buffer becomes
+non-empty).
+
+`IOLoop` also runs timers (see `IOLoop.call_later`), so a single thread
+calling `IOLoop.poll` (or `IOLoop.run_until`) can drive both IO and timeouts.
+"""
+
+from __future__ import absolute_import
+
+import select
+import asyncore
+from errno import EINTR
+
+from .timeout import Timeout
+from .scheduler import TimerWheel
+
+_READ = select.POLLIN | select.POLLPRI
+_WRITE = select.POLLOUT
+
+
+def _interest(obj):
+    """Returns poll event mask ``obj`` is interested in (same rules as
+    ``asyncore.poll2``). """
+    mask = 0
+    if obj.readable():
+        mask |= _READ
+    if obj.writable() and not obj.accepting:
+        mask |= _WRITE
+    return mask
+
+def _is_eintr(exc):
+    return getattr(exc, 'errno', None) == EINTR or \
+            (exc.args and exc.args[0] == EINTR)
+
+
+class _EpollPoller(object):
+
+    def __init__(self):
+        object.__init__(self)
+        self._epoll = select.epoll()
+
+    def register(self, fd, mask):
+        self._epoll.register(fd, mask)
+
+    def modify(self, fd, mask):
+        self._epoll.modify(fd, mask)
+
+    def unregister(self, fd):
+        self._epoll.unregister(fd)
+
+    def poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        return self._epoll.poll(timeout)
+
+    def close(self):
+        self._epoll.close()
+
+
+class _PollPoller(object):
+
+    def __init__(self):
+        object.__init__(self)
+        self._poll = select.poll()
+
+    def register(self, fd, mask):
+        self._poll.register(fd, mask)
+
+    modify = register
+
+    def unregister(self, fd):
+        self._poll.unregister(fd)
+
+    def poll(self, timeout):
+        if timeout is not None:
+            timeout = int(timeout * 1000)
+        return self._poll.poll(timeout)
+
+    def close(self):
+        pass
+
+
+class _SelectPoller(object):
+
+    def __init__(self):
+        object.__init__(self)
+        self._readers = set()
+        self._writers = set()
+
+    def register(self, fd, mask):
+        for fds, events in ((self._readers, _READ), (self._writers, _WRITE)):
+            if mask & events:
+                fds.add(fd)
+            else:
+                fds.discard(fd)
+
+    modify = register
+
+    def unregister(self, fd):
+        self._readers.discard(fd)
+        self._writers.discard(fd)
+
+    def poll(self, timeout):
+        readers, writers = list(self._readers), list(self._writers)
+        readable, writable, exceptional = select.select(readers, writers,
+                set(readers) | set(writers), timeout)
+        events = dict.fromkeys(readable, select.POLLIN)
+        for fd in writable:
+            events[fd] = events.get(fd, 0) | select.POLLOUT
+        for fd in exceptional:
+            events[fd] = events.get(fd, 0) | select.POLLPRI
+        return events.items()
+
+    def close(self):
+        pass
+
+
+_pollers = {}
+if hasattr(select, 'epoll'):
+    _pollers['epoll'] = _EpollPoller
+if hasattr(select, 'poll'):
+    _pollers['poll'] = _PollPoller
+_pollers['select'] = _SelectPoller
+
+backends = tuple(name for name in ('epoll', 'poll', 'select')
+        if name in _pollers)
+"""Names of IO loop backends available on this platform, best first."""
+
+
+class IOLoop(dict):
+
+    """A socket map with persistent registrations in a poller. """
+
+    def __init__(self, backend=None):
+        """Initializes new `IOLoop` instance.
+
+        :Parameters:
+            - `backend`: one of `backends` (by default the first one)
+        """
+        dict.__init__(self)
+        self._backend = backend or backends[0]
+        if self._backend not in _pollers:
+            raise ValueError("IO loop backend %r is not available" %
+                    (backend,))
+        self._poller = _pollers[self._backend]()
+        self._interests = {}
+        self._timers = TimerWheel()
+
+    @property
+    def backend(self):
+        return self._backend
+
+    def __setitem__(self, fd, obj):
+        dict.__setitem__(self, fd, obj)
+        mask = _interest(obj)
+        if fd in self._interests:
+            self._poller.modify(fd, mask)
+        else:
+            self._poller.register(fd, mask)
+        self._interests[fd] = mask
+
+    def __delitem__(self, fd):
+        dict.__delitem__(self, fd)
+        if self._interests.pop(fd, None) is not None:
+            try:
+                self._poller.unregister(fd)
+            except (EnvironmentError, ValueError, KeyError):
+                # the descriptor may have been closed already
+                pass
+
+    def pop(self, fd, *default):
+        if fd in self:
+            obj = self[fd]
+            del self[fd]
+            return obj
+        return dict.pop(self, fd, *default)
+
+    def clear(self):
+        for fd in self.keys():
+            del self[fd]
+
+    def update_interest(self, obj):
+        """Re-evaluates ``obj.readable()`` and ``obj.writable()`` and updates
+        the poller registration if they have changed. """
+        fd = obj._fileno
+        mask = self._interests.get(fd)
+        if mask is None or self.get(fd) is not obj:
+            return
+        new_mask = _interest(obj)
+        if new_mask != mask:
+            self._poller.modify(fd, new_mask)
+            self._interests[fd] = new_mask
+
+    def call_later(self, delay, callback, *args, **kwargs):
+        """Schedules ``callback(*args, **kwargs)`` to be called by `poll`
+        after `delay` seconds. Returns a `pymx.scheduler.Timer`. Not
+        thread-safe. """
+        return self._timers.schedule(delay, callback, *args, **kwargs)
+
+    def _next_timeout(self, timeout):
+        """Returns `timeout` shortened so that `poll` wakes up for the next
+        timer. """
+        remaining = self._timers.next_timeout()
+        if remaining is None:
+            return timeout
+        if timeout is None:
+            return remaining
+        return min(timeout, remaining)
+
+    def poll(self, timeout=None):
+        """Waits at most `timeout` seconds (forever if ``None``) for IO events
+        and dispatches them to the registered dispatchers. Calls due timers.
+        """
+        try:
+            events = self._poller.poll(self._next_timeout(timeout))
+        except (EnvironmentError, select.error), e:
+            if _is_eintr(e):
+                return
+            raise
+        for fd, flags in events:
+            obj = self.get(fd)
+            if obj is None:
+                continue
+            asyncore.readwrite(obj, flags)
+            self.update_interest(obj)
+        self._timers.run()
+
+    def run_until(self, future, timeout=None):
+        """Runs `poll` until `future` is set and returns its value. Raises
+        ``FutureTimeout`` if `timeout` seconds elapse first. """
+        timer = Timeout(timeout)
+        while not future.has_value and timer.remaining:
+            self.poll(timer.timeout)
+        return future.wait(0)
+
+    def close(self):
+        """Closes all the registered dispatchers and the poller. """
+        asyncore.close_all(map=self)
+        self._poller.close()
@@ -1,11 +1,28 @@
+from array import array
+from collections import deque
+from math import ceil, log
+from time import time
 
-from collections import defaultdict, deque
+def _uint64_typecode():
+    # 'Q' is available since Python 3.3, 'L' is 64 bits wide on LP64 systems
+    for typecode in ('Q', 'L'):
+        try:
+            if array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            pass
+    return None
+
+_UINT64 = _uint64_typecode()
 
 class LimitedSet(object):
 
     """A set remebering only ``capacity`` recently added elements and no
     explicit removals. """
 
+    duplicates = 0
+    """Number of `add` calls with an element already in the set. """
+
     def __init__(self, capacity=20000):
         object.__init__(self)
         self._capacity = max(capacity, 1)
@@ -22,9 +39,9 @@ class LimitedSet(object):
         return len(self)
 
     def _shrink(self, capacity):
-        while self.size > capacity:
-            rm = self._recent.popleft()
-            self._elements.remove(rm)
+        recent, elements = self._recent, self._elements
+        while len(recent) > capacity:
+            elements.remove(recent.popleft())
 
     def add(self, element):
         if element not in self._elements:
@@ -32,4 +49,272 @@ class LimitedSet(object):
             self._elements.add(element)
             self._recent.append(element)
             return True
+        self.duplicates += 1
+        return False
+
+
+class CompactLimitedSet(object):
+
+    """A `LimitedSet` of unsigned 64-bit integers (e.g. message IDs) without
+    per-element Python objects.
+
+    Elements are kept in a ring (a 64-bit ``array`` in insertion order, the
+    oldest one is evicted when the set is full) and in an open-addressing
+    hash table (a 64-bit ``array`` with linear probing and backward-shift
+    deletion, at most half full). Both `add` and eviction take O(1) time and
+    the set takes about 24-40 bytes per element, so capacities in millions
+    are practical (`add` is a few times slower than `LimitedSet.add` though,
+    see ``bench/limitedset.py``). Not available if the platform has no
+    64-bit ``array`` type code (see `MessageIdSet`).
+    """
+
+    duplicates = 0
+    """Number of `add` calls with an element already in the set. """
+
+    def __init__(self, capacity=20000):
+        object.__init__(self)
+        if _UINT64 is None:
+            raise RuntimeError("64-bit arrays are not available")
+        self._capacity = max(capacity, 1)
+        size = 2
+        while size < 2 * self._capacity:
+            size <<= 1
+        self._mask = size - 1
+        # 0 marks an empty slot, so element 0 is tracked by `_has_zero`
+        self._table = array(_UINT64, [0]) * size
+        self._ring = array(_UINT64, [0]) * self._capacity
+        self._next = 0
+        self._len = 0
+        self._has_zero = False
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def size(self):
+        return self._len
+
+    def __contains__(self, element):
+        if not element:
+            return self._has_zero
+        table, mask = self._table, self._mask
+        i = (element ^ (element >> 32)) & mask
+        value = table[i]
+        while value:
+            if value == element:
+                return True
+            i = (i + 1) & mask
+            value = table[i]
+        return False
+
+    def add(self, element):
+        """Adds `element` (evicting the oldest one if the set is full).
+        Returns ``False`` if `element` is already in the set. """
+        if not element:
+            if self._has_zero:
+                self.duplicates += 1
+                return False
+            if self._len == self._capacity:
+                self._evict()
+            self._has_zero = True
+        else:
+            table, mask = self._table, self._mask
+            home = (element ^ (element >> 32)) & mask
+            i = home
+            value = table[i]
+            while value:
+                if value == element:
+                    self.duplicates += 1
+                    return False
+                i = (i + 1) & mask
+                value = table[i]
+            if self._len == self._capacity and self._evict():
+                # the deletion could have moved elements, probe again
+                i = home
+                while table[i]:
+                    i = (i + 1) & mask
+            table[i] = element
+        next = self._next
+        self._ring[next] = element
+        next += 1
+        self._next = next if next != self._capacity else 0
+        self._len += 1
+        return True
+
+    def _evict(self):
+        """Removes the oldest element. Returns ``True`` if it was stored in
+        the hash table. """
+        self._len -= 1
+        element = self._ring[self._next]
+        if not element:
+            self._has_zero = False
+            return False
+        table, mask = self._table, self._mask
+        i = (element ^ (element >> 32)) & mask
+        while table[i] != element:
+            i = (i + 1) & mask
+        # backward-shift deletion: move following elements of the cluster
+        # into the hole unless it would put them before their home slot
+        table[i] = 0
+        j = (i + 1) & mask
+        value = table[j]
+        while value:
+            if (j - ((value ^ (value >> 32)) & mask)) & mask >= \
+                    (j - i) & mask:
+                table[i] = value
+                table[j] = 0
+                i = j
+            j = (j + 1) & mask
+            value = table[j]
+        return True
+
+MessageIdSet = _UINT64 and CompactLimitedSet or LimitedSet
+"""`CompactLimitedSet` if available on this platform, `LimitedSet`
+otherwise. """
+
+
+class TimedMessageIdSet(object):
+
+    """A set remembering elements added during the last ``window`` seconds
+    (or a bit longer, up to ``window * (1 + 1 / generations)``).
+
+    Elements are kept in ``generations + 1`` sets, each collecting the
+    elements added during ``window / generations`` seconds; the oldest set
+    is dropped as a whole when a new one is started. Memory is bounded by the
+    rate of `add` calls times the window.
+
+    Sets are started only by `add` (and the other methods) or by `expire`,
+    so `expire` should be called every `period` seconds (e.g. by an IO loop
+    timer) for the elements to be released when nothing is added.
+    """
+
+    duplicates = 0
+    """Number of `add` calls with an element already in the set. """
+
+    def __init__(self, window, generations=4, clock=time):
+        object.__init__(self)
+        if window <= 0 or generations < 1:
+            raise ValueError("window and generations must be positive")
+        self._period = float(window) / generations
+        self._generations = deque([set()], generations + 1)
+        self._clock = clock
+        self._current_end = clock() + self._period
+
+    def __len__(self):
+        self.expire()
+        return sum(len(generation) for generation in self._generations)
+
+    @property
+    def size(self):
+        return len(self)
+
+    def __contains__(self, element):
+        self.expire()
+        for generation in self._generations:
+            if element in generation:
+                return True
         return False
+
+    @property
+    def period(self):
+        """Number of seconds during which a single set collects elements."""
+        return self._period
+
+    def expire(self):
+        """Drops the sets older than the window. """
+        now = self._clock()
+        if now < self._current_end:
+            return
+        generations = self._generations
+        passed = int((now - self._current_end) / self._period) + 1
+        if passed >= generations.maxlen:
+            generations.clear()
+            passed = 1
+            self._current_end = now
+        for _ in xrange(passed):
+            # the deque is bounded, the oldest generation is dropped
+            generations.append(set())
+        self._current_end += passed * self._period
+
+    def add(self, element):
+        """Adds `element`. Returns ``False`` if `element` is already in the
+        set. """
+        self.expire()
+        generations = self._generations
+        for generation in reversed(generations):
+            if element in generation:
+                self.duplicates += 1
+                return False
+        generations[-1].add(element)
+        return True
+
+
+class RotatingBloomFilter(object):
+
+    """An approximate `LimitedSet` of unsigned 64-bit integers (e.g. message
+    IDs) remembering at least ``capacity`` (and at most ``2 * capacity``)
+    recently added elements.
+
+    Elements are added to the current of two Bloom filters (``bytearray``
+    bit sets), each sized for ``capacity`` elements; when the current one is
+    full, the older one is cleared and becomes the current one. An element
+    not in the set is reported as present (so `add` returns ``False``) with
+    probability of at most ``error_rate``. The set takes about 4 bytes per
+    element for ``error_rate=0.001`` (and 0.6 more for each 10 times lower
+    rate).
+    """
+
+    duplicates = 0
+    """Number of `add` calls with an element (apparently) already in the
+    set. """
+
+    def __init__(self, capacity=1000000, error_rate=0.001):
+        object.__init__(self)
+        if not 0 < error_rate < 1:
+            raise ValueError("error_rate must be between 0 and 1")
+        self._capacity = max(capacity, 1)
+        # the error rates of both filters add up
+        bits = int(ceil(-self._capacity * log(error_rate / 2) / log(2) ** 2))
+        self._bits = (bits + 7) & ~7
+        self._hashes = max(int(round(float(self._bits) / self._capacity *
+            log(2))), 1)
+        self._current = bytearray(self._bits >> 3)
+        self._previous = bytearray(self._bits >> 3)
+        self._len = 0
+
+    def _indexes(self, element):
+        # double hashing of a multiplicative hash of the element
+        h = (element * 0x9e3779b97f4a7c15) & 0xffffffffffffffff
+        h1, h2, bits = h & 0xffffffff, (h >> 32) | 1, self._bits
+        return [(h1 + i * h2) % bits for i in xrange(self._hashes)]
+
+    @staticmethod
+    def _lookup(bitset, indexes):
+        for i in indexes:
+            if not bitset[i >> 3] & (1 << (i & 7)):
+                return False
+        return True
+
+    def __contains__(self, element):
+        indexes = self._indexes(element)
+        return self._lookup(self._current, indexes) or \
+                self._lookup(self._previous, indexes)
+
+    def add(self, element):
+        """Adds `element` (forgetting the oldest elements if the set is
+        full). Returns ``False`` if `element` is (apparently) already in the
+        set. """
+        indexes = self._indexes(element)
+        lookup = self._lookup
+        if lookup(self._current, indexes) or lookup(self._previous, indexes):
+            self.duplicates += 1
+            return False
+        if self._len == self._capacity:
+            self._previous, self._current = self._current, self._previous
+            self._current[:] = bytearray(len(self._current))
+            self._len = 0
+        current = self._current
+        for i in indexes:
+            current[i >> 3] |= 1 << (i & 7)
+        self._len += 1
+        return True
@@ -1,4 +1,6 @@
 
+import sys
+
 from .Multiplexer_pb2 import MultiplexerMessage, Compression, \
         MultiplexerMessageDescription, LoggingMethod
 
@@ -12,3 +14,138 @@ def _del_from(self):
     delattr(self, 'from')
 
 MultiplexerMessage.from_ = property(_get_from, _set_from, _del_from)
+
+from .protobuf import parse_message, DecodeError
+from .compression import decompress_message
+
+_HEADER_FIELDS = {1: 'id', 2: 'from', 3: 'to', 4: 'type', 7: 'references'}
+"""Varint fields of `MultiplexerMessage` exposed by `MessageView`."""
+
+def _decode_varint(data, pos):
+    result = shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+        if shift >= 64:
+            raise DecodeError("Too many bytes when decoding varint.")
+
+def _scan_header(data):
+    """Returns ``dict`` with values of `_HEADER_FIELDS` found in serialized
+    `MultiplexerMessage` ``data``. Other fields are skipped. """
+    fields = {}
+    pos, end = 0, len(data)
+    try:
+        while pos < end:
+            key, pos = _decode_varint(data, pos)
+            wire_type = key & 7
+            if wire_type == 0:
+                value, pos = _decode_varint(data, pos)
+                name = _HEADER_FIELDS.get(key >> 3)
+                if name is not None:
+                    fields[name] = value
+            elif wire_type == 2:
+                length, pos = _decode_varint(data, pos)
+                pos += length
+            elif wire_type == 1:
+                pos += 8
+            elif wire_type == 5:
+                pos += 4
+            else:
+                raise DecodeError("Unexpected wire type %d." % wire_type)
+    except IndexError:
+        raise DecodeError("Truncated message.")
+    if pos > end:
+        raise DecodeError("Truncated message.")
+    if 'type' not in fields:
+        raise DecodeError("Message is missing required fields: type")
+    return fields
+
+
+class MessageView(object):
+
+    """A received, serialized `MultiplexerMessage`.
+
+    ``id``, ``from_``, ``to``, ``type`` and ``references`` are read directly
+    from the wire bytes (in a single pass, on first access), which is enough
+    to deduplicate and route messages. The full message is parsed (once) by
+    `parse` or on the first access to any other attribute, so the parsing
+    (and decompression of the payload, see `pymx.compression`) may be done
+    by the thread consuming the message rather than the IO thread.
+    ``DecodeError`` may be raised by both (the header, including the required
+    ``type``, is checked by the IO thread when routing the message, see
+    `materialize_received` for the rest).
+    """
+
+    __slots__ = ('contents', '_header', '_message')
+
+    def __init__(self, contents):
+        object.__init__(self)
+        self.contents = contents
+        self._header = None
+        self._message = None
+
+    def _get(self, name):
+        header = self._header
+        if header is None:
+            header = self._header = _scan_header(self.contents)
+        return header.get(name, 0)
+
+    id = property(lambda self: self._get('id'))
+    from_ = property(lambda self: self._get('from'))
+    to = property(lambda self: self._get('to'))
+    type = property(lambda self: self._get('type'))
+    references = property(lambda self: self._get('references'))
+
+    @property
+    def size(self):
+        """Length of the serialized message. """
+        return len(self.contents)
+
+    def parse(self):
+        """Returns the parsed (and decompressed) `MultiplexerMessage`. """
+        message = self._message
+        if message is None:
+            message = self._message = decompress_message(parse_message(
+                MultiplexerMessage, self.contents))
+        return message
+
+    def __getattr__(self, name):
+        return getattr(self.parse(), name)
+
+    def __repr__(self):
+        try:
+            return '<MessageView id=%d type=%d>' % (self.id, self.type)
+        except DecodeError:
+            return '<MessageView (invalid) %r>' % (self.contents,)
+
+def materialize(message):
+    """Returns `message` (or its copy with the payload decompressed) or, if
+    it is a `MessageView`, the parsed message. """
+    if isinstance(message, MessageView):
+        return message.parse()
+    if message.compression:
+        decompressed = MultiplexerMessage()
+        decompressed.CopyFrom(message)
+        message = decompressed
+    return decompress_message(message)
+
+def materialize_received(message, channel=None):
+    """Like `materialize`, but an invalid `message` (received on `channel`)
+    is reported and ``None`` is returned instead. """
+    try:
+        return materialize(message)
+    except DecodeError, e:
+        print >> sys.stderr, "dropped invalid message", repr(message), \
+                "received on", channel, "(%s)" % (e,)
+        return None
+
+def serialized_size(message):
+    """Returns length of serialized `message` (a `MultiplexerMessage` or a
+    `MessageView`). """
+    if isinstance(message, MessageView):
+        return message.size
+    return message.ByteSize()
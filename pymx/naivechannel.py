@@ -1,7 +1,7 @@
 
 from socket import socket as socket_
 
-from .frame import create_frame_header, Deframer
+from .frame import create_frame_header, BufferDeframer
 from .protobuf import parse_message
 from .message import MultiplexerMessage
 
@@ -23,7 +23,7 @@ class Channel(object):
         assert isinstance(socket, socket_)
         self._socket = socket
         self._receive_iter = iter(())
-        self._deframer = Deframer()
+        self._deframer = BufferDeframer(size=self.receive_bufsize)
 
     def close(self):
         self._socket.close()
@@ -40,9 +40,9 @@ class Channel(object):
             try:
                 message_bytes = self._receive_iter.next()
             except StopIteration:
-                received_bytes = self._socket.recv(self.receive_bufsize)
-                if received_bytes:
-                    self._receive_iter = self._deframer.push(received_bytes)
+                if self._deframer.recv_into(self._socket.recv_into,
+                        self.receive_bufsize):
+                    self._receive_iter = self._deframer.frames()
                     continue
                 else:
                     self._socket = None
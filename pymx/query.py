@@ -0,0 +1,303 @@
+"""Callback driven implementation of the Multiplexer query algorithm. """
+
+from .message import MultiplexerMessage, materialize
+from .protobuf import make_message, DecodeError
+from .protocol import BackendForPacketSearch
+from .protocol_constants import MessageTypes
+from .future import Future
+from .exc import OperationFailed, OperationTimedOut, BackendError
+
+QUERY_CLEANUP_DELAY = 5
+"""Responses to finished queries are dropped for this many seconds."""
+
+QUERY_WAIT_MARGIN = 5
+"""Slack added by `wait_timeout` to the longest possible query duration."""
+
+def wait_timeout(timeout, skip_resend=False):
+    """Returns for how long a query with the given parameters may run:
+    each of its (up to three) phases times out after `timeout` seconds. """
+    return (1 if skip_resend else 3) * timeout + QUERY_WAIT_MARGIN
+
+
+class ResponseFuture(Future):
+
+    """`Future` of a query response. The response is received (as a
+    `pymx.message.MessageView`) by the IO thread and parsed by the thread
+    getting the `value` (`OperationFailed` is raised if it is invalid). """
+
+    @property
+    def value(self):
+        return _materialize_response(Future.value.fget(self))
+
+def _materialize_response(response):
+    try:
+        return materialize(response)
+    except DecodeError, e:
+        raise OperationFailed("Invalid response %r: %s" % (response, e))
+
+
+class Query(object):
+
+    """A single Multiplexer query, performed in three phases like
+    `pymx.client.Client.query`:
+
+        1. the request is sent and a response is awaited,
+        2. if it fails, ``BACKEND_FOR_PACKET_SEARCH`` is broadcast and the
+           first backend responding with ``PING`` is chosen,
+        3. the request is retransmitted to the chosen backend.
+
+    Instead of blocking, `Query` is driven by `handle_response` (called for
+    every message referencing one of the query's message IDs) and by timers.
+    The outcome is available from `future` (a `ResponseFuture`): the
+    response `MultiplexerMessage` or an `OperationFailed` exception
+    (`BackendError` for ``BACKEND_ERROR`` responses).
+
+    The `client` object must provide
+
+        ``ONE``, ``ALL``
+            connection selectors (like `pymx.client.Client.ONE`)
+        ``create_message(**fields)``
+            see `pymx.client.Client.create_message`
+        ``send_now(message, connection)``
+            send a message and return number of channels used
+        ``call_later(delay, callback)``
+            schedule a callback, returning a handle with ``cancel()``
+        ``register_query(message_id, query)``
+            route messages referencing ``message_id`` to
+            `handle_response`
+        ``unregister_query(message_ids, delay)``
+            stop routing messages referencing any of ``message_ids`` after
+            ``delay`` seconds
+
+    All these are called (and `handle_response` must be called) from a
+    single thread.
+    """
+
+    def __init__(self, client, message, type, timeout, fields=None,
+            skip_resend=False, future=None):
+        object.__init__(self)
+        assert not isinstance(message, MultiplexerMessage)
+        self._client = client
+        self._fields = dict(fields or {}, message=message, type=type)
+        self._type = type
+        self._timeout = timeout
+        self._skip_resend = skip_resend
+        self.future = future or ResponseFuture()
+
+        self._message_ids = []
+        self._active_ids = set()
+        self._timer = None
+        self._handler = None
+        self._query = self._search = self._retransmitted = None
+        self._first_request_delivery_errored = False
+        self._backend_error = None
+        self._searches_count = 0
+
+    def start(self):
+        """Sends the request. Returns `future`. """
+        try:
+            self._query = self._send(self._fields,
+                    connection=self._client.ONE)
+            self._enter(self._first_phase)
+        except Exception, e:
+            self._finish(exception=e)
+        return self.future
+
+    def abort(self, exception):
+        """Finishes the query with `exception` (e.g. when the client is
+        closed). """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self.future.has_value:
+            self.future.set_exception(exception)
+
+    def handle_response(self, message, channel):
+        """Processes a message referencing one of the query's messages. """
+        if self.future.has_value or message.references not in \
+                self._active_ids:
+            # the query has finished or the referenced message is no
+            # longer awaited
+            return
+        try:
+            self._handler(message, channel)
+        except Exception, e:
+            self._finish(exception=e)
+
+    # helpers
+
+    def _register(self, message_id):
+        self._message_ids.append(message_id)
+        self._active_ids.add(message_id)
+        self._client.register_query(message_id, self)
+
+    def _unregister(self, message_id):
+        self._active_ids.discard(message_id)
+
+    def _send(self, fields, connection):
+        message = self._client.create_message(**fields)
+        self._register(message.id)
+        self._client.send_now(message, connection)
+        return message
+
+    def _enter(self, handler):
+        """Starts a new phase (or sub-phase) handled by `handler`, with its
+        own timeout. """
+        if self._timer is not None:
+            self._timer.cancel()
+        self._handler = handler
+        self._timer = self._client.call_later(self._timeout, self._timed_out)
+
+    def _timed_out(self):
+        if self.future.has_value:
+            return
+        try:
+            self._handler(None, None)
+        except Exception, e:
+            self._finish(exception=e)
+
+    def _finish(self, response=None, exception=None):
+        if self.future.has_value:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._handler = None
+        message_ids, self._message_ids = self._message_ids, []
+        self._client.unregister_query(message_ids, QUERY_CLEANUP_DELAY)
+        # only the header is read here, see `ResponseFuture`
+        if exception is None and response.type == MessageTypes.BACKEND_ERROR:
+            try:
+                exception = BackendError(_materialize_response(
+                    response).message)
+            except OperationFailed, e:
+                exception = e
+        if exception is not None:
+            self.future.set_exception(exception)
+        else:
+            self.future.set(response)
+
+    def _fail_with_backend_error(self, exception):
+        """Finishes with the recorded ``BACKEND_ERROR`` response if any,
+        otherwise with `exception`. """
+        if self._backend_error is not None:
+            self._finish(self._backend_error)
+        else:
+            self._finish(exception=exception)
+
+    # phases
+
+    def _first_phase(self, response, channel):
+        if response is None:
+            if self._skip_resend:
+                raise OperationTimedOut("No response received for query #%d"
+                        % self._query.id)
+        elif response.type == MessageTypes.REQUEST_RECEIVED:
+            return
+        elif response.type == MessageTypes.DELIVERY_ERROR:
+            if self._skip_resend:
+                raise OperationFailed("Delivery Error response for query #%d"
+                        % self._query.id)
+            self._first_request_delivery_errored = True
+        elif response.type == MessageTypes.BACKEND_ERROR:
+            self._backend_error = response
+        else:
+            return self._finish(response)
+        self._start_second_phase()
+
+    def _start_second_phase(self):
+        search_fields = {'message': make_message(BackendForPacketSearch,
+                    packet_type=self._type).SerializeToString(),
+                'type': MessageTypes.BACKEND_FOR_PACKET_SEARCH,
+                'workflow': self._fields.get('workflow')}
+        message = self._client.create_message(**search_fields)
+        self._register(message.id)
+        self._search = message
+        self._searches_count = self._client.send_now(message,
+                self._client.ALL)
+        if not self._searches_count:
+            return self._fail_with_backend_error(OperationFailed(
+                "Could not broadcast backend search"))
+        self._enter(self._second_phase)
+
+    def _second_phase(self, response, channel):
+        query, search = self._query, self._search
+        if response is None:
+            return self._fail_with_backend_error(OperationTimedOut("No "
+                "response to query #%d and backend search #%d" % (query.id,
+                    search.id)))
+
+        if response.type == MessageTypes.REQUEST_RECEIVED:
+            return
+
+        if response.type in (MessageTypes.DELIVERY_ERROR,
+                MessageTypes.BACKEND_ERROR):
+            if response.type == MessageTypes.BACKEND_ERROR and \
+                    self._backend_error is None:
+                self._backend_error = response
+            if response.references == query.id:
+                self._first_request_delivery_errored = True
+                return
+            # No backend for packet search responses
+            assert response.references == search.id
+            self._searches_count -= 1
+            if self._searches_count:
+                return
+            if self._first_request_delivery_errored:
+                return self._fail_with_backend_error(OperationFailed(
+                    "Delivery Error responses for query #%d and backend "
+                    "search #%d" % (query.id, search.id)))
+            # wait for a response to the original request
+            self._unregister(search.id)
+            self._enter(self._second_phase_query_response)
+
+        elif response.references == query.id:
+            self._finish(response)
+
+        elif response.type == MessageTypes.PING:
+            # Found alive backend!
+            assert response.references == search.id
+            self._unregister(search.id)
+            self._retransmitted = self._send(self._fields, connection=channel)
+            self._enter(self._third_phase)
+
+        else:
+            raise OperationFailed("Unrecognized message returned from "
+                    "multiplexer", response)
+
+    def _second_phase_query_response(self, response, channel):
+        query, search = self._query, self._search
+        if response is None:
+            return self._fail_with_backend_error(OperationTimedOut("No "
+                "response received for query #%d and backend search #%d "
+                "errored" % (query.id, search.id)))
+        if response.type == MessageTypes.REQUEST_RECEIVED:
+            return
+        assert response.references == query.id
+        if response.type == MessageTypes.DELIVERY_ERROR:
+            # second response to query received...
+            return self._fail_with_backend_error(OperationFailed("Delivery "
+                "Error responses for query #%d and backend search #%d" %
+                (query.id, search.id)))
+        self._finish(response)
+
+    def _third_phase(self, response, channel):
+        query, retransmitted = self._query, self._retransmitted
+        if response is None:
+            return self._fail_with_backend_error(OperationTimedOut("No "
+                "response received for query #%d and retransmitted query #%d"
+                % (query.id, retransmitted.id)))
+
+        if response.type == MessageTypes.REQUEST_RECEIVED:
+            return
+
+        if response.type == MessageTypes.DELIVERY_ERROR:
+            if response.references == retransmitted.id:
+                return self._fail_with_backend_error(OperationFailed(
+                    "Retransmitted query #%d could not be delivered" %
+                    retransmitted.id))
+            assert response.references == query.id
+            self._first_request_delivery_errored = True
+            return
+
+        self._finish(response)
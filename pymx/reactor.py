@@ -0,0 +1,217 @@
+"""An IO thread running an `pymx.ioloop.IOLoop` on behalf of other threads.
+
+`Reactor` owns an `IOLoop` (with its timers), a thread polling it and a
+wakeup descriptor used to pass tasks to that thread (an ``eventfd`` on Linux,
+a pipe or a socket pair elsewhere). Wakeups are coalesced: the descriptor is
+written only by the first task submitted since the IO thread last collected
+its tasks, so a burst of submissions costs a single syscall. Every
+`pymx.connection.ConnectionsManager` creates a private `Reactor` by default;
+many of them may share one instead (see `shared_reactor`), so that a
+process with many clients runs a single IO thread.
+"""
+
+from __future__ import absolute_import, with_statement
+
+import os
+import struct
+import asyncore
+from threading import Lock, Thread, currentThread
+from functools import partial
+from traceback import print_exc
+
+from .atomic import Atomic
+from .ioloop import IOLoop
+from .hacks.eventfd import eventfd
+
+try:
+    file_dispatcher = asyncore.file_dispatcher
+    assert file_dispatcher
+except AttributeError:
+    # e.g. we are on windows
+    file_dispatcher = None
+    from .hacks.socket_pipe import socket_pipe
+
+
+class Reactor(object):
+
+    """An IO thread driving an `IOLoop` and running tasks submitted by other
+    threads. """
+
+    __creation_counter = Atomic(0)
+
+    _tasks = None
+    """A list of tasks scheduled for IO thread."""
+
+    _wakeup = None
+    """A function waking up IO thread (writes to the wakeup descriptor).
+    Called with ``self._lock`` held. """
+
+    _close_wakeup = None
+
+    _wakeup_pending = False
+    """Whether IO thread was woken up and has not collected `_tasks` yet.
+    Guarded by ``self._lock``. """
+
+    _is_closing = False
+
+    def __init__(self, io_backend=None, name=None):
+        """Initializes new `Reactor` and starts its IO thread.
+
+        :Parameters:
+            - `io_backend`: one of `pymx.ioloop.backends` (by default the best
+              one available)
+            - `name`: name of the IO thread
+        """
+        object.__init__(self)
+        self._lock = Lock()
+        self._io_loop = IOLoop(backend=io_backend)
+        self._tasks = []
+        self._create_task_notifier()
+        self._thread = Thread(target=self._io_main, name=name or
+                'Reactor-IO-Thread-#%d' % Reactor.__creation_counter.inc())
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    @property
+    def io_loop(self):
+        """The `IOLoop` (a socket map with timers). Accessed only by IO
+        thread. """
+        return self._io_loop
+
+    @property
+    def thread(self):
+        return self._thread
+
+    @property
+    def is_closing(self):
+        return self._is_closing
+
+    def _create_task_notifier(self):
+        """Create the wakeup descriptor, register its read-end in
+        ``self._io_loop`` and set ``self._wakeup`` and
+        ``self._close_wakeup``. """
+
+        if file_dispatcher is not None and eventfd is not None:
+            try:
+                fd = eventfd()
+            except EnvironmentError:
+                pass
+            else:
+                # eventfd is both the read- and the write-end
+                try:
+                    _TaskNotifier(fd=fd, map=self._io_loop)
+                except Exception:
+                    os.close(fd)
+                    raise
+                self._wakeup = partial(os.write, fd, _EVENTFD_INCREMENT)
+                self._close_wakeup = partial(os.close, fd)
+                return
+
+        if file_dispatcher is not None:
+            # create pipe-based task notifier
+            read_end, write_end = os.pipe()
+            try:
+                _TaskNotifier(fd=read_end, map=self._io_loop)
+            except Exception:
+                os.close(write_end)
+                raise
+            finally:
+                os.close(read_end)
+            self._wakeup = partial(os.write, write_end, 't')
+            self._close_wakeup = partial(os.close, write_end)
+
+        else:
+            # create socket-based task notifier
+            read_end, write_end = socket_pipe()
+            _TaskNotifier(sock=read_end, map=self._io_loop)
+            self._wakeup = partial(write_end.send, 't')
+            self._close_wakeup = write_end.close
+
+    def _io_main(self):
+        try:
+            while not self._is_closing:
+                # errors are reported like asyncore's `handle_error` does, so
+                # that a failing client does not stop the IO thread of the
+                # others sharing the reactor
+                try:
+                    self._io_loop.poll(30.0)
+                except Exception:
+                    print_exc()
+                self._run_tasks()
+        finally:
+            with self._lock:
+                # no wakeups are written once closing
+                self._is_closing = True
+                self._close_wakeup()
+            self._io_loop.close()
+
+    def _run_tasks(self):
+        # tasks submitted by IO thread itself (which does not wake itself
+        # up) are run in the same pass, not after the next `poll`
+        while True:
+            with self._lock:
+                tasks, self._tasks = self._tasks, []
+                self._wakeup_pending = False
+            if not tasks:
+                return
+            for task in tasks:
+                try:
+                    task()
+                except Exception:
+                    print_exc()
+
+    def submit(self, *args, **kwargs):
+        """Schedules ``partial(*args, **kwargs)`` to be called by IO thread.
+        Returns ``False`` if the reactor is closed (and the task will never
+        be called). """
+        task = partial(*args, **kwargs)
+        with self._lock:
+            if self._is_closing:
+                return False
+            self._tasks.append(task)
+            if not self._wakeup_pending and \
+                    currentThread() is not self._thread:
+                self._wakeup_pending = True
+                self._wakeup()
+        return True
+
+    def close(self, timeout=10):
+        """Stops the IO thread (after running already submitted tasks) and
+        closes all the dispatchers. """
+        if not self.submit(self._stop):
+            return
+        if currentThread() is not self._thread:
+            self._thread.join(timeout=timeout)
+            if self._thread.isAlive():
+                raise RuntimeError("IO thread is still alive")
+
+    def _stop(self):
+        with self._lock:
+            self._is_closing = True
+
+
+_EVENTFD_INCREMENT = struct.pack('=Q', 1)
+
+
+_shared_reactor = None
+_shared_reactor_lock = Lock()
+
+def shared_reactor():
+    """Returns the process-wide `Reactor` (created on first use). It should
+    not be closed by its users. """
+    global _shared_reactor
+    with _shared_reactor_lock:
+        if _shared_reactor is None or _shared_reactor.is_closing:
+            _shared_reactor = Reactor(name='Shared-Reactor-IO-Thread')
+        return _shared_reactor
+
+
+class _TaskNotifier(file_dispatcher or asyncore.dispatcher):
+
+    ignore_log_types = ()
+
+    def handle_read(self):
+        self.recv(512)
+
+    def writable(self):
+        return False
@@ -3,11 +3,216 @@ from __future__ import absolute_import, with_statement
 from time import time
 from functools import partial
 from Queue import Queue
-from heapq import heappush, heappop
+from heapq import heappush, heappop, heapify
+from itertools import count
 from threading import Condition, Thread, RLock
+from traceback import print_exc
 
 from .atomic import Atomic
 
+_WHEEL_BITS = 6
+_WHEEL_SLOTS = 1 << _WHEEL_BITS
+_WHEEL_MASK = _WHEEL_SLOTS - 1
+
+
+class Timer(object):
+
+    """A handle of a callback scheduled with `TimerWheel.schedule` (or
+    `Scheduler.schedule`, `pymx.connection.ConnectionsManager.call_later`).
+    """
+
+    __slots__ = ('tick', 'callback')
+
+    def __init__(self, tick, callback):
+        object.__init__(self)
+        self.tick = tick
+        self.callback = callback
+
+    def cancel(self):
+        """Prevents the callback from being called. """
+        self.callback = None
+
+    @property
+    def cancelled(self):
+        return self.callback is None
+
+
+class _SchedulerTimer(Timer):
+
+    """A `Timer` of `Scheduler`, which counts cancelled tasks. """
+
+    __slots__ = ('_scheduler',)
+
+    def __init__(self, callback, scheduler):
+        Timer.__init__(self, None, callback)
+        self._scheduler = scheduler
+
+    def cancel(self):
+        self._scheduler._cancel(self)
+
+
+class TimerWheel(object):
+
+    """Hierarchical timing wheel: timers with O(1) `schedule` and
+    `Timer.cancel`.
+
+    Time is divided into ticks of `resolution` seconds. Level ``0`` has a slot
+    for each of the next 64 ticks, level ``1`` a slot for each of the next 64
+    runs of 64 ticks and so on; when level ``0`` wraps, the current slot of
+    the level above is cascaded (redistributed) to lower levels. Timers never
+    fire early, but may fire up to `resolution` seconds late.
+
+    `TimerWheel` has no thread: `run` must be called (e.g. by an IO loop,
+    which waits at most `next_timeout` seconds for IO). Not thread-safe.
+    """
+
+    def __init__(self, resolution=0.01, levels=4, clock=time):
+        """Initializes new `TimerWheel`.
+
+        :Parameters:
+            - `resolution`: length of a tick (in seconds)
+            - `levels`: number of wheels; timers scheduled further than
+              ``64 ** levels`` ticks ahead are kept in an overflow list
+            - `clock`: a function returning current time
+        """
+        object.__init__(self)
+        self._resolution = resolution
+        self._clock = clock
+        self._wheels = [[[] for _ in xrange(_WHEEL_SLOTS)]
+                for _ in xrange(levels)]
+        self._overflow = []
+        self._count = 0
+        self._tick = self._current_tick()
+        """The next tick to be processed by `run`."""
+
+    def __len__(self):
+        """Returns number of stored timers (including cancelled ones not yet
+        dropped). """
+        return self._count
+
+    def _current_tick(self):
+        return int(self._clock() / self._resolution)
+
+    def schedule(self, delay, callback, *args, **kwargs):
+        """Schedules ``callback(*args, **kwargs)`` to be called by `run` after
+        `delay` seconds. Returns a `Timer`. """
+        if args or kwargs:
+            callback = partial(callback, *args, **kwargs)
+        # round up, so that the timer never fires early
+        tick = -int(-(self._clock() + delay) // self._resolution)
+        timer = Timer(tick, callback)
+        self._insert(timer)
+        self._count += 1
+        return timer
+
+    def _insert(self, timer):
+        tick = max(timer.tick, self._tick)
+        delta = tick - self._tick
+        shift = 0
+        for wheel in self._wheels:
+            if delta >> shift < _WHEEL_SLOTS:
+                wheel[(tick >> shift) & _WHEEL_MASK].append(timer)
+                return
+            shift += _WHEEL_BITS
+        self._overflow.append(timer)
+
+    def _cascade(self, tick):
+        shift = 0
+        for wheel in self._wheels[1:]:
+            shift += _WHEEL_BITS
+            index = (tick >> shift) & _WHEEL_MASK
+            timers, wheel[index] = wheel[index], []
+            for timer in timers:
+                if timer.callback is None:
+                    self._count -= 1
+                else:
+                    self._insert(timer)
+            if index:
+                return
+        timers, self._overflow = self._overflow, []
+        for timer in timers:
+            self._insert(timer)
+
+    def run(self):
+        """Calls callbacks of due timers. Exceptions raised by callbacks are
+        printed, so they do not prevent other callbacks from being called. """
+        now = self._current_tick()
+        first_wheel = self._wheels[0]
+        while self._tick <= now:
+            if not self._count:
+                self._tick = now + 1
+                return
+            tick = self._tick
+            index = tick & _WHEEL_MASK
+            if not index:
+                self._cascade(tick)
+            # timers scheduled by callbacks go to the next ticks
+            self._tick = tick + 1
+            timers = first_wheel[index]
+            if timers:
+                first_wheel[index] = []
+                self._count -= len(timers)
+                for timer in timers:
+                    callback, timer.callback = timer.callback, None
+                    if callback is not None:
+                        try:
+                            callback()
+                        except Exception:
+                            print_exc()
+
+    def next_timeout(self):
+        """Returns number of seconds until `run` should be called next time,
+        or ``None`` if no timers are scheduled. """
+        if not self._count:
+            return None
+        first_wheel = self._wheels[0]
+        for tick in xrange(self._tick, self._tick + _WHEEL_SLOTS):
+            index = tick & _WHEEL_MASK
+            if first_wheel[index] or not index:
+                # a timer or the cascade of higher levels
+                break
+        return max(tick * self._resolution - self._clock(), 0)
+
+
+class ExpiryBatcher(object):
+
+    """Collects items to be passed to `callback` after a delay. Items expiring
+    within the same `granularity` seconds are passed in one batch (with one
+    timer), at most `granularity` seconds late. Not thread-safe. """
+
+    def __init__(self, call_later, callback, granularity=0.5, clock=time):
+        """Initializes new `ExpiryBatcher`.
+
+        :Parameters:
+            - `call_later`: a ``call_later(delay, callback, *args)`` function
+              (e.g. `TimerWheel.schedule`)
+            - `callback`: function called with a list of expired items
+            - `granularity`: length of a batch (in seconds)
+            - `clock`: a function returning current time
+        """
+        object.__init__(self)
+        self._call_later = call_later
+        self._callback = callback
+        self._granularity = granularity
+        self._clock = clock
+        self._batches = {}
+
+    def add(self, delay, items):
+        """Adds `items` to be passed to `callback` after at least `delay`
+        seconds. """
+        now = self._clock()
+        batch_id = -int(-(now + delay) // self._granularity)
+        batch = self._batches.get(batch_id)
+        if batch is None:
+            batch = self._batches[batch_id] = []
+            self._call_later(batch_id * self._granularity - now,
+                    self._expire, batch_id)
+        batch.extend(items)
+
+    def _expire(self, batch_id):
+        self._callback(self._batches.pop(batch_id))
+
+
 class Scheduler(object):
 
     __creation_counter = Atomic(0)
@@ -15,6 +220,8 @@ class Scheduler(object):
     def __init__(self):
         object.__init__(self)
         self._tasks = []
+        self._tasks_counter = count()
+        self._cancelled = 0
         self._lock = RLock()
         self._task_waiter = Condition(self._lock)
         self._is_closing = False
@@ -63,8 +270,12 @@ class Scheduler(object):
                     continue # infinite unless broken
 
                 assert remaining == 0
-                when, callback = heappop(self._tasks)
+                when, _, timer = heappop(self._tasks)
                 assert time() >= when
+                callback, timer.callback = timer.callback, None
+                if callback is None:
+                    self._cancelled -= 1
+                    continue
 
             callback()
 
@@ -73,11 +284,37 @@ class Scheduler(object):
                 self._tasks)
 
     def schedule(self, delay, callback, *args, **kwargs):
+        """Schedules ``callback(*args, **kwargs)`` to be called by the
+        scheduler thread after `delay` seconds. Returns a `Timer`; its
+        ``cancel()`` prevents the call unless it has already started. """
         if args or kwargs:
             callback = partial(callback, *args, **kwargs)
         when = time() + delay
+        timer = _SchedulerTimer(callback, self)
         with self._lock:
             if self._is_closing:
                 raise RuntimeError("Scheduler already closing")
-            heappush(self._tasks, (when, callback))
+            heappush(self._tasks, (when, self._tasks_counter.next(), timer))
             self._task_waiter.notify()
+        return timer
+
+    def _cancel(self, timer):
+        with self._lock:
+            if timer.callback is None:
+                return
+            timer.callback = None
+            # Cancelled tasks stay in the heap until popped, unless they
+            # make up more than a half of it: then the heap is rebuilt,
+            # which is amortized O(1) per `cancel`.
+            self._cancelled += 1
+            if self._cancelled * 2 > len(self._tasks):
+                self._tasks = [task for task in self._tasks
+                        if task[2].callback is not None]
+                heapify(self._tasks)
+                self._cancelled = 0
+                self._task_waiter.notify()
+
+    def __len__(self):
+        """Returns number of scheduled (not cancelled) tasks. """
+        with self._lock:
+            return len(self._tasks) - self._cancelled
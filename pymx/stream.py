@@ -0,0 +1,306 @@
+"""Streaming of large payloads as sequences of chunk messages.
+
+A stream is a sequence of messages of a single ``type`` sent directly
+(``to``) from a producer to a consumer. The first message starts the stream
+and its ``id`` is the stream ID; all other messages (in both directions)
+``reference`` it. The payload of every message starts with a header
+(`HEADER`: a sequence number and flags) followed by the chunk data:
+
+    - the producer sends data chunks numbered from 0 and then an empty
+      chunk with the `END` flag,
+    - the consumer sends `ACK` messages whose sequence number tells how many
+      chunks the producer may send (the producer sends only the first chunk
+      before the first `ACK`, so that the consumer can route the following
+      ones to the stream),
+    - the consumer confirms receiving the `END` chunk with a message with
+      both `ACK` and `END` flags; the producer waits for it, so that no
+      message of the stream arrives after the producer stops routing them,
+    - any side may stop the stream sending a message with the `ABORT` flag.
+
+The consumer allows the producer to send at most ``window`` chunks it has not
+consumed yet, so both sides hold only a few chunks of a stream in memory.
+Chunks may be sent over different connections, the consumer puts them back
+in order.
+
+Streams are sent and received with `pymx.client.Client.send_stream` and
+`pymx.client.Client.receive_stream`. Python objects may be streamed with
+`pickle_chunks` and `unpickle_chunks`.
+"""
+
+from __future__ import with_statement
+
+import sys
+from cStringIO import StringIO
+from functools import partial
+from random import getrandbits
+from struct import Struct
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from .exc import OperationFailed, OperationTimedOut
+
+HEADER = Struct('!IB')
+"""Chunk header: sequence number and flags. """
+
+END = 1
+"""Flag of the (empty) chunk ending a stream. """
+
+ACK = 2
+"""Flag of a consumer's message allowing the producer to send the chunks
+with sequence numbers lower than the one in the header (or, with `END`,
+confirming the end of the stream). """
+
+ABORT = 4
+"""Flag of a message stopping the stream. """
+
+CHUNK_SIZE = 256 * 1024
+"""Default length of chunk data. """
+
+WINDOW = 4
+"""Default number of chunks a producer may send ahead of the consumer. """
+
+def pack_chunk(seq, flags=0, data=''):
+    return HEADER.pack(seq, flags) + data
+
+def unpack_chunk(message):
+    """Returns ``(seq, flags, data)`` of a stream message. """
+    payload = message.message
+    if len(payload) < HEADER.size:
+        raise OperationFailed("Invalid stream message %r" % (message,))
+    seq, flags = HEADER.unpack_from(payload)
+    return seq, flags, payload[HEADER.size:]
+
+def iter_chunks(source, chunk_size=CHUNK_SIZE):
+    """Yields non-empty strings of at most `chunk_size` bytes read from
+    `source`: a file-like object or an iterable of strings. """
+    if hasattr(source, 'read'):
+        source = iter(partial(source.read, chunk_size), '')
+    for data in source:
+        if len(data) <= chunk_size:
+            if data:
+                yield data
+            continue
+        for start in xrange(0, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+
+
+def send_stream(client, routes, to, type, source, timeout,
+        chunk_size=CHUNK_SIZE, connection=None, fields=None):
+    """Sends a stream of chunks of `source` to the peer `to`, see
+    `pymx.client.Client.send_stream`. `routes` is a
+    ``ConnectionsManager.query_context_manager()`` used to receive the
+    consumer's messages. """
+    if connection is None:
+        connection = client.ONE
+    stream_id = getrandbits(64)
+    # the first message has the stream ID, the others reference it
+    first_fields = dict(fields or {}, id=stream_id)
+    fields = lambda seq: seq and {'references': stream_id} or first_fields
+    with routes:
+        routes.register_id(stream_id)
+        seq, allowed = 0, 1
+        try:
+            for data in iter_chunks(source, chunk_size):
+                while seq >= allowed:
+                    allowed = max(allowed, _receive_ack(routes, timeout)[0])
+                _send(client, to, type, seq, 0, connection, data,
+                        **fields(seq))
+                seq += 1
+        except Exception:
+            if seq:
+                _send(client, to, type, seq, ABORT, connection,
+                        **fields(seq))
+            raise
+        _send(client, to, type, seq, END, connection, **fields(seq))
+        if seq:
+            # the consumer's messages are routed here until it confirms the
+            # end (a stream of the `END` chunk alone is not acknowledged)
+            while not _receive_ack(routes, timeout)[1] & END:
+                pass
+    return stream_id
+
+def _receive_ack(routes, timeout):
+    """Returns ``(seq, flags)`` of the next consumer's message. """
+    message = routes.receive(timeout=timeout)
+    if message is None:
+        raise OperationTimedOut("No stream acknowledgement received")
+    seq, flags, _ = unpack_chunk(message)
+    if flags & ABORT:
+        raise OperationFailed("Stream aborted by the consumer")
+    return seq, flags
+
+def _send(client, to, type, seq, flags, connection, data='', **fields):
+    client.send_message(client.create_message(to=to, type=type,
+        message=pack_chunk(seq, flags, data), **fields),
+        connection=connection)
+
+
+def receive_stream(client, routes, message, timeout, window=WINDOW):
+    """Yields data of chunks of the stream started by `message`, see
+    `pymx.client.Client.receive_stream`. `routes` is a
+    ``ConnectionsManager.query_context_manager()`` used to receive the
+    following chunks. """
+    window = max(window, 1)
+    seq, flags, data = unpack_chunk(message)
+    if seq != 0 or flags & ~END:
+        raise OperationFailed("Not a start of a stream %r" % (message,))
+    if flags & END:
+        return
+    producer, type, stream_id = message.from_, message.type, message.id
+    connection = client.ONE
+    pending = {0: (flags, data)}
+    consumed = acknowledged = 0
+    finished = False
+    with routes:
+        routes.register_id(stream_id)
+        try:
+            _send(client, producer, type, window, ACK, connection,
+                    references=stream_id)
+            while True:
+                while consumed not in pending:
+                    chunk = routes.receive(timeout=timeout)
+                    if chunk is None:
+                        raise OperationTimedOut("No stream chunk received")
+                    seq, flags, data = unpack_chunk(chunk)
+                    if flags & ABORT:
+                        finished = True
+                        raise OperationFailed("Stream aborted by the "
+                                "producer")
+                    if seq >= consumed:
+                        pending[seq] = (flags, data)
+                flags, data = pending.pop(consumed)
+                if flags & END:
+                    finished = True
+                    _send(client, producer, type, consumed + 1, ACK | END,
+                            connection, references=stream_id)
+                    return
+                yield data
+                consumed += 1
+                if consumed - acknowledged >= (window + 1) // 2:
+                    _send(client, producer, type, consumed + window, ACK,
+                            connection, references=stream_id)
+                    acknowledged = consumed
+        finally:
+            if not finished:
+                _send(client, producer, type, consumed, ABORT, connection,
+                        references=stream_id)
+
+
+OUT_OF_BAND_THRESHOLD = 64 * 1024
+"""Default minimal size of strings and arrays sent out-of-band by
+`pickle_chunks`. """
+
+_LENGTH = Struct('!Q')
+
+def pickle_chunks(obj, chunk_size=CHUNK_SIZE,
+        threshold=OUT_OF_BAND_THRESHOLD):
+    """Yields strings (to be sent as a stream) carrying pickled `obj`.
+
+    Strings and C-contiguous NumPy arrays (of simple types) of at least
+    `threshold` bytes are not copied into the pickle. They are replaced by
+    persistent IDs and their data is sent after the pickle, read straight
+    from them in chunks of `chunk_size` bytes (much like out-of-band buffers
+    of pickle protocol 5), so no more than one copy of a chunk is made.
+    """
+    numpy = sys.modules.get('numpy')
+    buffers, indexes = [], {}
+
+    def persistent_id(obj):
+        if type(obj) is str:
+            if len(obj) < threshold:
+                return None
+            data, description = obj, ('str', len(obj))
+        elif numpy is not None and type(obj) is numpy.ndarray:
+            if obj.nbytes < threshold or not obj.flags.c_contiguous or \
+                    obj.dtype.hasobject or obj.dtype.fields is not None:
+                return None
+            data = buffer(obj)
+            description = ('ndarray', len(data), obj.dtype.str, obj.shape)
+        else:
+            return None
+        index = indexes.get(id(obj))
+        if index is None:
+            index = indexes[id(obj)] = len(buffers)
+            buffers.append(data)
+        return (index,) + description
+
+    output = StringIO()
+    pickler = pickle.Pickler(output, 2)
+    pickler.persistent_id = persistent_id
+    pickler.dump(obj)
+    head = output.getvalue()
+    del output, pickler
+    yield _LENGTH.pack(len(head)) + head
+    del head
+    for data in buffers:
+        for start in xrange(0, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+
+def unpickle_chunks(chunks):
+    """Returns the object pickled by `pickle_chunks` from the iterable of
+    received `chunks` (e.g. `pymx.client.Client.receive_stream`). Arrays
+    are filled chunk by chunk. """
+    chunks = _ChunksReader(chunks)
+    length, = _LENGTH.unpack(chunks.read(_LENGTH.size))
+    unpickler = pickle.Unpickler(StringIO(chunks.read(length)))
+    loaded = []
+
+    def persistent_load(pid):
+        index, kind, length = pid[:3]
+        if index < len(loaded):
+            return loaded[index]
+        if index != len(loaded):
+            raise OperationFailed("Invalid persistent ID %r" % (pid,))
+        if kind == 'str':
+            obj = chunks.read(length)
+        elif kind == 'ndarray':
+            import numpy
+            obj = numpy.empty(pid[4], pid[3])
+            target = obj.reshape(-1).view(numpy.uint8)
+            position = 0
+            for data in chunks.pieces(length):
+                target[position:position + len(data)] = numpy.frombuffer(
+                        data, numpy.uint8)
+                position += len(data)
+        else:
+            raise OperationFailed("Invalid persistent ID %r" % (pid,))
+        loaded.append(obj)
+        return obj
+
+    unpickler.persistent_load = persistent_load
+    return unpickler.load()
+
+
+class _ChunksReader(object):
+
+    """Reads given numbers of bytes from an iterable of strings. """
+
+    def __init__(self, chunks):
+        object.__init__(self)
+        self._chunks = iter(chunks)
+        self._chunk = ''
+        self._position = 0
+
+    def pieces(self, length):
+        """Yields strings of `length` bytes in total. """
+        while length:
+            if self._position == len(self._chunk):
+                try:
+                    self._chunk = self._chunks.next()
+                except StopIteration:
+                    raise OperationFailed("Stream ended unexpectedly")
+                self._position = 0
+            start = self._position
+            end = min(start + length, len(self._chunk))
+            self._position = end
+            length -= end - start
+            if start == 0 and end == len(self._chunk):
+                yield self._chunk
+            else:
+                yield self._chunk[start:end]
+
+    def read(self, length):
+        return ''.join(self.pieces(length))
@@ -0,0 +1,132 @@
+from __future__ import absolute_import, with_statement
+
+import threading
+from contextlib import closing, nested
+
+from nose.tools import eq_, raises
+
+from pymx.aio import Client
+from pymx.ioloop import IOLoop
+from pymx.exc import OperationFailed, OperationTimedOut, BackendError
+from pymx.protocol_constants import MessageTypes
+
+from .testlib_mxserver import StandInMxServerThread, \
+        create_mx_server_context
+from .testlib_threads import check_threads
+
+BACKEND_TYPE = 380
+QUERY_TYPE = 1136
+
+def _create_server():
+    return create_mx_server_context(impl=StandInMxServerThread,
+            routes={QUERY_TYPE: BACKEND_TYPE})
+
+def _serve(backend, handler):
+    """Make `backend` respond to incoming messages using `handler`, which
+    returns reply fields (or ``None``). """
+    def _handle(future):
+        message, channel = future.value
+        if message.type == MessageTypes.BACKEND_FOR_PACKET_SEARCH:
+            reply = {'type': MessageTypes.PING, 'message': ''}
+        else:
+            reply = handler(message)
+        if reply is not None:
+            backend.send_message(backend.create_message(to=message.from_,
+                references=message.id, **reply), connection=channel)
+        backend.receive().add_callback(_handle)
+    backend.receive().add_callback(_handle)
+
+def _echo(message):
+    return {'type': message.type, 'message': message.message}
+
+@check_threads
+def test_no_threads():
+    with _create_server() as server:
+        threads = threading.activeCount()
+        with closing(Client(type=317)) as client:
+            client.run_until(client.connect(server.server_address), 1)
+            eq_(threading.activeCount(), threads)
+
+@check_threads
+def test_send_receive():
+    with _create_server() as server:
+        with closing(Client(type=317)) as client:
+            client.run_until(client.connect(server.server_address), 1)
+            msg = client.create_message(to=client.instance_id, type=0)
+            eq_(client.send_message(msg), 1)
+            eq_([message for message, _ in client.messages(timeout=0.3)],
+                    [msg])
+
+@check_threads
+def test_query():
+    io_loop = IOLoop()
+    with nested(_create_server(), closing(io_loop)) as (server, _):
+        with nested(closing(Client(type=317, io_loop=io_loop)),
+                closing(Client(type=BACKEND_TYPE, io_loop=io_loop))) as (
+                        client, backend):
+            io_loop.run_until(client.connect(server.server_address), 1)
+            io_loop.run_until(backend.connect(server.server_address), 1)
+            _serve(backend, _echo)
+
+            response = io_loop.run_until(client.query(message='nictuniema',
+                type=QUERY_TYPE, timeout=1), 2)
+            eq_(response.type, QUERY_TYPE)
+            eq_(response.message, 'nictuniema')
+            eq_(response.from_, backend.instance_id)
+
+            response = io_loop.run_until(client.query(message='x', type=0,
+                timeout=1, fields={'to': backend.instance_id}), 2)
+            eq_((response.type, response.message), (0, 'x'))
+
+@check_threads
+def test_query_retransmitted():
+    ignored = []
+    def _ignore_first(message):
+        if not ignored:
+            ignored.append(message)
+            return None
+        return _echo(message)
+
+    io_loop = IOLoop()
+    with nested(_create_server(), closing(io_loop)) as (server, _):
+        with nested(closing(Client(type=317, io_loop=io_loop)),
+                closing(Client(type=BACKEND_TYPE, io_loop=io_loop))) as (
+                        client, backend):
+            io_loop.run_until(client.connect(server.server_address), 1)
+            io_loop.run_until(backend.connect(server.server_address), 1)
+            _serve(backend, _ignore_first)
+
+            response = io_loop.run_until(client.query(message='abc',
+                type=QUERY_TYPE, timeout=0.2), 2)
+            eq_(response.message, 'abc')
+            eq_(len(ignored), 1)
+            assert response.references != ignored[0].id
+
+@check_threads
+def test_query_backend_error():
+    io_loop = IOLoop()
+    with nested(_create_server(), closing(io_loop)) as (server, _):
+        with nested(closing(Client(type=317, io_loop=io_loop)),
+                closing(Client(type=BACKEND_TYPE, io_loop=io_loop))) as (
+                        client, backend):
+            io_loop.run_until(client.connect(server.server_address), 1)
+            io_loop.run_until(backend.connect(server.server_address), 1)
+            _serve(backend, lambda message: {'message': 'failed',
+                'type': MessageTypes.BACKEND_ERROR})
+            raises(BackendError)(lambda: io_loop.run_until(client.query(
+                message='abc', type=QUERY_TYPE, timeout=0.2), 2))()
+
+@check_threads
+def test_query_failures():
+    with _create_server() as server:
+        with closing(Client(type=317)) as client:
+            client.run_until(client.connect(server.server_address), 1)
+            # no backend connected
+            raises(OperationFailed)(lambda: client.run_until(client.query(
+                message='abc', type=QUERY_TYPE, timeout=0.2), 2))()
+            raises(OperationFailed)(lambda: client.run_until(client.query(
+                message='abc', type=QUERY_TYPE, timeout=0.2,
+                skip_resend=True), 2))()
+            # not routed message
+            raises(OperationTimedOut)(lambda: client.run_until(client.query(
+                message='abc', type=0, timeout=0.1, skip_resend=True), 2))()
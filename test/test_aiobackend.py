@@ -0,0 +1,151 @@
+from __future__ import absolute_import, with_statement
+
+import time
+from contextlib import closing, nested
+
+from nose.tools import eq_, raises
+
+from pymx.aio import Client
+from pymx.aiobackend import MultiplexerBackend
+from pymx.exc import BackendError, OperationTimedOut
+from pymx.future import Future, Return
+from pymx.ioloop import IOLoop
+from pymx.protocol_constants import MessageTypes
+
+from .testlib_mxserver import StandInMxServerThread
+from .testlib_threads import check_threads
+
+BACKEND_TYPE = 380
+QUERY_TYPE = 1136
+
+def _sleep(io_loop, delay, value=None):
+    future = Future()
+    io_loop.call_later(delay, future.set, value)
+    return future
+
+def _create_context(impl=MultiplexerBackend, **backend_kwargs):
+    io_loop = IOLoop()
+    server = StandInMxServerThread.run_threaded(routes={QUERY_TYPE:
+        BACKEND_TYPE})
+    backend_kwargs.setdefault('type', BACKEND_TYPE)
+    client = Client(type=317, io_loop=io_loop)
+    backend = impl(addresses=[server.server_address],
+            io_loop=io_loop, **backend_kwargs)
+    io_loop.run_until(client.connect(server.server_address), 1)
+    return nested(closing(server), closing(io_loop), closing(client),
+            closing(backend))
+
+def _query_all(client, count, timeout=1):
+    io_loop = client.io_loop
+    futures = [client.query(message=str(i), type=QUERY_TYPE,
+        timeout=timeout, fields={'workflow': 'w%d' % i})
+        for i in xrange(count)]
+    return [io_loop.run_until(future, 5) for future in futures]
+
+def _check_responses(responses, backend, client):
+    eq_([response.message for response in responses],
+            [str(i) for i in xrange(len(responses))])
+    eq_([response.workflow for response in responses],
+            ['w%d' % i for i in xrange(len(responses))])
+    for response in responses:
+        eq_(response.from_, backend.instance_id)
+        eq_(response.to, client.instance_id)
+
+def test_concurrent_handlers():
+    yield check_concurrent_handlers, 4, 0.15
+    yield check_concurrent_handlers, 1, 0.6
+
+@check_threads
+def check_concurrent_handlers(concurrency, min_duration):
+    active = []
+    def handler(context):
+        io_loop = context.backend.io_loop
+        active.append(context.backend.active_requests)
+        message = yield _sleep(io_loop, 0.15, context.message.message)
+        raise Return({'message': message, 'type': QUERY_TYPE + 1})
+
+    with _create_context(handler=handler, concurrency=concurrency) as (
+            server, io_loop, client, backend):
+        start = time.time()
+        responses = _query_all(client, 4)
+        duration = time.time() - start
+        _check_responses(responses, backend, client)
+        eq_(max(active), concurrency)
+        assert min_duration <= duration < min_duration + 0.3, duration
+        eq_(backend.active_requests, 0)
+
+@check_threads
+def test_handler_responses():
+    def handler(context):
+        kind = int(context.message.message) % 4
+        if kind == 0:
+            return context.message.message
+        elif kind == 1:
+            return _sleep(context.backend.io_loop, 0.01,
+                    context.message.message)
+        elif kind == 2:
+            return {'message': context.message.message, 'type': QUERY_TYPE}
+        context.send_message(message=context.message.message,
+                type=QUERY_TYPE)
+
+    with _create_context(handler=handler) as (server, io_loop, client,
+            backend):
+        _check_responses(_query_all(client, 8), backend, client)
+
+def test_handler_errors():
+    def failing(context):
+        raise ValueError("failed")
+
+    def failing_coroutine(context):
+        yield _sleep(context.backend.io_loop, 0.01)
+        raise ValueError("failed")
+
+    def failing_future(context):
+        future = Future()
+        future.set_exception(ValueError("failed"))
+        return future
+
+    yield check_handler_error, failing
+    yield check_handler_error, failing_coroutine
+    yield check_handler_error, failing_future
+
+@check_threads
+def check_handler_error(handler):
+    with _create_context(handler=handler) as (server, io_loop, client,
+            backend):
+        raises(BackendError)(_query_all)(client, 1)
+        eq_(backend.active_requests, 0)
+
+@check_threads
+def test_notify_started_and_no_response():
+    class Backend(MultiplexerBackend):
+        def handle_message(self, context):
+            context.notify_started()
+            if context.message.message == 'skip':
+                context.no_response()
+            else:
+                context.send_message(message='ok', type=QUERY_TYPE)
+
+    with _create_context(impl=Backend) as (server, io_loop, client,
+            backend):
+        response = io_loop.run_until(client.query(message='',
+            type=QUERY_TYPE, timeout=0.5), 2)
+        eq_((response.type, response.message), (QUERY_TYPE, 'ok'))
+
+        raises(OperationTimedOut)(io_loop.run_until)(client.query(
+            message='skip', type=QUERY_TYPE, timeout=0.1,
+            skip_resend=True), 2)
+
+@check_threads
+def test_shutdown():
+    def handler(context):
+        context.backend.shutdown()
+        return _sleep(context.backend.io_loop, 0.1, 'bye')
+
+    with _create_context(handler=handler) as (server, io_loop, client,
+            backend):
+        future = client.query(message='', type=QUERY_TYPE, timeout=1)
+        backend.loop()
+        assert not backend.working
+        eq_(backend.active_requests, 0)
+        eq_(io_loop.run_until(future, 1).message, 'bye')
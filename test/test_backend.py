@@ -1,5 +1,7 @@
 from __future__ import with_statement
 
+import os
+import time
 from contextlib import closing, nested
 
 from pymx.backend import MultiplexerBackend, PicklingMultiplexerBackend
@@ -8,6 +10,9 @@ from pymx.future import wait_all
 from pymx.backend import pickle
 from pymx.protocol_constants import MessageTypes
 from pymx.client import BackendError, OperationTimedOut, OperationFailed
+from pymx.compression import CompressionPolicy
+from pymx.exc import BackendWorkerError
+from pymx.stream import unpickle_chunks
 
 from nose.tools import eq_, nottest, raises
 
@@ -29,8 +34,9 @@ def teardown_module():
 
 @nottest
 def create_test_backend(addresses=(), impl=MultiplexerBackend, handler=None,
-        type=380):
-    return closing(impl(addresses=addresses, type=type, handler=handler))
+        type=380, **kwargs):
+    return closing(impl(addresses=addresses, type=type, handler=handler,
+        **kwargs))
 
 def _backend_echo(mxmsg):
     return dict((field, getattr(mxmsg, field)) for field in ('message',
@@ -86,6 +92,41 @@ def check_query(backend_factory, backend_kwargs={}):
 
             th.join()
 
+def test_query_streaming():
+    yield check_query_streaming, PicklingMultiplexerBackend, {}
+
+    class FieldsBackend(PicklingMultiplexerBackend):
+        def process_pickle(self, data):
+            self.send_pickle(data, workflow='streamed')
+
+    yield check_query_streaming, FieldsBackend, {'workflow': 'streamed'}
+
+@check_threads
+def check_query_streaming(backend_factory, expected_fields):
+    data = {'large': 'x' * 10 ** 6, 'small': 'y'}
+
+    with nested(create_test_client(), create_test_backend(
+        impl=backend_factory, handler=lambda x: x,
+        streaming=True)) as (client, backend):
+
+        with timedcontext(4):
+            wait_all(client.connect(server.server_address),
+                    backend.connect(server.server_address), timeout=1)
+
+            th = TestThread(target=backend.handle_one)
+            th.setDaemon(True)
+            th.start()
+
+            response = client.query(fields={'to': backend.instance_id},
+                    message=pickle.dumps(data), type=1136, timeout=1)
+            eq_(response.type, MessageTypes.PICKLE_RESPONSE)
+            for field, value in expected_fields.iteritems():
+                eq_(getattr(response, field), value)
+            eq_(unpickle_chunks(client.receive_stream(response, timeout=1)),
+                    data)
+
+            th.join()
+
 def test_query_retransmission():
     for notify in (False, True):
         yield check_query_retransmission, '_be_nice', notify
@@ -189,3 +230,121 @@ def check_query_retransmission(how, notify):
             eq_(response.workflow, 'some workflow')
 
         th.join()
+
+def test_workers():
+    yield check_workers, {'threads': 4}
+    yield check_workers, {'processes': 4}
+
+@check_threads
+def check_workers(workers_kwargs):
+    def handler(mxmsg):
+        time.sleep(0.3)
+        return {'message': '%s:%d' % (mxmsg.message, os.getpid()),
+                'type': TestMessageTypes.TEST_RESPONSE}
+
+    backend_kwargs = dict(workers_kwargs, type=TestPeerTypes.TEST_SERVER,
+            handler=handler)
+    with nested(create_test_client(), create_test_backend(**backend_kwargs)
+            ) as (client, backend):
+
+        wait_all(client.connect(server.server_address),
+                backend.connect(server.server_address), timeout=0.5)
+
+        th = TestThread(target=backend.start)
+        th.setDaemon(True)
+        th.start()
+
+        responses = {}
+        def query(i):
+            responses[i] = client.query(fields={'workflow': str(i)},
+                    message=str(i), type=TestMessageTypes.TEST_REQUEST,
+                    timeout=1)
+
+        query_threads = [TestThread(target=query, args=(i,))
+                for i in xrange(4)]
+        with timedcontext(0.6):
+            for query_thread in query_threads:
+                query_thread.setDaemon(True)
+                query_thread.start()
+            for query_thread in query_threads:
+                query_thread.join()
+
+        pids = set()
+        for i, response in responses.iteritems():
+            message, pid = response.message.split(':')
+            eq_(message, str(i))
+            eq_(response.workflow, str(i))
+            eq_(response.from_, backend.instance_id)
+            eq_(response.to, client.instance_id)
+            pids.add(int(pid))
+        if 'processes' in workers_kwargs:
+            assert os.getpid() not in pids
+            eq_(len(pids), 4)
+        else:
+            eq_(pids, set([os.getpid()]))
+
+        backend.shutdown()
+        # wake up the backend
+        client.event(client.create_message(to=backend.instance_id,
+            type=MessageTypes.PING, message=''))
+        th.join()
+
+def test_workers_errors():
+    yield check_workers_errors, {'threads': 2}
+    yield check_workers_errors, {'processes': 2}
+
+@check_threads
+def check_workers_errors(workers_kwargs):
+    class Backend(MultiplexerBackend):
+        def handle_message(self, mxmsg):
+            self.notify_started()
+            raise ValueError(mxmsg.message)
+
+        def exception_occurred(self, exc):
+            return False
+
+    backend_kwargs = dict(workers_kwargs, type=TestPeerTypes.TEST_SERVER,
+            impl=Backend)
+    with nested(create_test_client(), create_test_backend(**backend_kwargs)
+            ) as (client, backend):
+
+        wait_all(client.connect(server.server_address),
+                backend.connect(server.server_address), timeout=0.5)
+
+        th = TestThread(target=backend.handle_one)
+        th.setDaemon(True)
+        th.start()
+        raises(BackendError)(lambda: client.query(message='some error',
+            type=TestMessageTypes.TEST_REQUEST, timeout=0.5,
+            skip_resend=True))()
+        th.join()
+        time.sleep(0.1)
+        if 'processes' in workers_kwargs:
+            raises(BackendWorkerError)(backend.handle_one)(0.1)
+        else:
+            raises(ValueError)(backend.handle_one)(0.1)
+
+@check_threads
+def test_process_workers_unpicklable_replies():
+    class Backend(MultiplexerBackend):
+        def handle_message(self, mxmsg):
+            self.send_message(message=mxmsg.message, type=TestMessageTypes.
+                    TEST_RESPONSE, workflow=lambda: 'not picklable')
+
+    with nested(create_test_client(compression=CompressionPolicy(
+        threshold=100)), create_test_backend(processes=1, impl=Backend,
+            type=TestPeerTypes.TEST_SERVER)) as (client, backend):
+
+        wait_all(client.connect(server.server_address),
+                backend.connect(server.server_address), timeout=0.5)
+
+        for i in xrange(3):
+            client.event(client.create_message(to=backend.instance_id,
+                type=TestMessageTypes.TEST_REQUEST, message='x' * 1000))
+            # the worker's slot is released, so the message is handed to it
+            th = TestThread(target=backend.handle_one)
+            th.setDaemon(True)
+            th.start()
+            th.join(timeout=5)
+            time.sleep(0.1)
+            raises(BackendWorkerError)(backend.handle_one)(0.1)
@@ -0,0 +1,92 @@
+
+from nose.tools import eq_
+
+from pymx.bytesfifo import BuffersFIFO, FramesFIFO
+
+def _fifo(*chunks):
+    fifo = BuffersFIFO()
+    for chunk in chunks:
+        fifo.put(chunk)
+    return fifo
+
+def _bytes(buffer):
+    if isinstance(buffer, memoryview):
+        return buffer.tobytes()
+    return buffer
+
+def test_buffers_fifo_peek():
+    fifo = _fifo('abc', '', 'de', 'fghi', 'j')
+    eq_(len(fifo), 10)
+    eq_(fifo.peek(100, 100), ['abc', 'de', 'fghi', 'j'])
+    eq_(fifo.peek(100, 2), ['abc', 'de'])
+    eq_(fifo.peek(4, 100), ['abc', 'de'])
+    eq_(fifo.peek(3, 100), ['abc'])
+
+def test_buffers_fifo_consume():
+    fifo = _fifo('abc', 'de', 'fghi', 'j')
+    fifo.consume(4)
+    eq_(len(fifo), 6)
+    eq_(map(_bytes, fifo.peek(100, 100)), ['e', 'fghi', 'j'])
+    fifo.consume(1)
+    eq_(fifo.peek(100, 100), ['fghi', 'j'])
+    fifo.consume(5)
+    eq_(len(fifo), 0)
+    eq_(fifo.peek(100, 100), [])
+
+def test_buffers_fifo_peek_joined():
+    fifo = _fifo('abc', 'de', 'fghi', 'j')
+    eq_(fifo.peek_joined(5), 'abcde')
+    eq_(fifo.peek_joined(1024), 'abcdefghij')
+    eq_(fifo.peek_joined(2), 'abc')
+    fifo.consume(1)
+    eq_(_bytes(fifo.peek_joined(1)), 'bc')
+    eq_(fifo.peek_joined(7), 'bcde')
+    eq_(fifo.peek_joined(8), 'bcdefghi')
+    eq_(len(fifo), 9)
+
+def test_frames_fifo():
+    fifo = FramesFIFO()
+    fifo.put_frame('ab', 'cd')
+    fifo.put_frame('efg')
+    fifo.put_frame('', 'h')
+    fifo.put_frame('')
+    eq_((len(fifo), fifo.frames), (8, 3))
+    fifo.consume(1)
+    eq_((len(fifo), fifo.frames), (7, 3))
+    # the head frame is partially consumed, the next one is dropped
+    eq_(fifo.drop_oldest(), 3)
+    eq_((len(fifo), fifo.frames), (4, 2))
+    eq_(map(_bytes, fifo.peek(100, 100)), ['b', 'cd', 'h'])
+    fifo.consume(3)
+    eq_((len(fifo), fifo.frames), (1, 1))
+    eq_(fifo.drop_oldest(), 1)
+    eq_((len(fifo), fifo.frames), (0, 0))
+    eq_(fifo.drop_oldest(), 0)
+
+def test_frames_fifo_drop_undroppable():
+    fifo = FramesFIFO()
+    fifo.put_frame('ab')
+    fifo.consume(1)
+    fifo.put_undroppable_frame('cd', 'e')
+    fifo.put_frame('fg')
+    fifo.put_undroppable_frame('h')
+    eq_(fifo.drop_oldest(), 2)
+    eq_(map(_bytes, fifo.peek(100, 100)), ['b', 'cd', 'e', 'h'])
+    eq_(fifo.drop_oldest(), 0)
+    fifo.consume(4)
+    eq_(fifo.drop_oldest(), 0)
+    fifo.put_frame('ij')
+    eq_(fifo.drop_oldest(), 2)
+    eq_((len(fifo), fifo.frames), (1, 1))
+
+def test_frames_fifo_drop_partially_consumed():
+    fifo = FramesFIFO()
+    fifo.put_frame('ab', 'cd')
+    fifo.consume(2)
+    eq_(fifo.drop_oldest(), 0)
+    fifo.put_frame('ef')
+    eq_(fifo.drop_oldest(), 2)
+    fifo.consume(2)
+    fifo.put_frame('gh')
+    eq_(fifo.drop_oldest(), 2)
+    eq_(fifo.frames, 0)
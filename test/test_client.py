@@ -7,9 +7,12 @@ from functools import partial
 from nose.tools import eq_, assert_almost_equal, timed, raises
 
 from pymx.protobuf import dict_message
-from pymx.client import Client, OperationTimedOut
+from pymx.client import Client, OperationTimedOut, OperationFailed
+from pymx.channel import QueueLimits
+from pymx.compression import CompressionPolicy
+from pymx.limitedset import RotatingBloomFilter
 from pymx.protocol import HEARTBIT_READ_INTERVAL
-from pymx.future import wait_all, FutureError
+from pymx.future import Future, wait_all, FutureError
 
 from .testlib_threads import TestThread, check_threads
 from .testlib_mxserver import SimpleMxServerThread, JmxServerThread, \
@@ -100,6 +103,75 @@ def test_client_connect_event_self():
         client.connect(server.server_address).wait(0.2)
         _check_ping(client, event=True)
 
+@check_threads
+def test_publish():
+    with create_test_client() as client:
+        msg = client.create_message(to=client.instance_id, type=0)
+        eq_(client.publish(msg), None)
+        eq_(client.send_message(msg, wait=False), None)
+        eq_(client.stats['not_connected'], 2)
+
+        client.connect(server.server_address).wait(0.2)
+        client.publish(msg)
+        eq_(client.receive(timeout=5), msg)
+        eq_(client.stats['not_connected'], 2)
+
+@check_threads
+def test_compression():
+    with create_test_client(compression=CompressionPolicy(threshold=100)) \
+            as client:
+        client.connect(server.server_address).wait(0.2)
+        msg = client.create_message(to=client.instance_id, type=0,
+                message='x' * 1000)
+        client.send_message(msg)
+        eq_(client.receive(timeout=5), msg)
+
+@check_threads
+def test_compression_query_timeout():
+    with create_test_client(compression=CompressionPolicy(threshold=100)) \
+            as client:
+        client.connect(server.server_address).wait(0.2)
+        # not routed message
+        raises(OperationTimedOut)(lambda: client.query(message='x' * 1000,
+            type=0, timeout=0.2, skip_resend=True))()
+        # the IO thread is still working
+        _check_ping(client)
+
+@check_threads
+def test_incoming_limits():
+    limits = QueueLimits(high_frames=100)
+    with nested(create_test_client(), create_test_client(
+        incoming_limits=limits)) as (sender, receiver):
+        wait_all(sender.connect(server.server_address),
+                receiver.connect(server.server_address), timeout=0.5)
+        for i in xrange(5000):
+            sender.publish(sender.create_message(to=receiver.instance_id,
+                type=0, message=str(i)))
+        time.sleep(0.5)
+        eq_(receiver.stats['incoming_full'], 1)
+        # at most one socket read over the limit
+        assert receiver._manager._incoming_messages.qsize() < 1000
+        for i in xrange(5000):
+            eq_(receiver.receive(timeout=1).message, str(i))
+        assert receiver.stats['incoming_full'] > 1
+
+@check_threads
+def test_receive_many():
+    with create_test_client() as client:
+        client.connect(server.server_address).wait(0.2)
+        eq_(client.receive_many(10, timeout=0.1), [])
+        messages = [client.create_message(to=client.instance_id, type=0,
+            message=str(i)) for i in xrange(25)]
+        for msg in messages:
+            client.send_message(msg)
+        received = []
+        while len(received) < len(messages):
+            batch = client.receive_many(10, timeout=1)
+            assert 0 < len(batch) <= 10
+            received.extend(batch)
+        eq_([message for message, channel in received], messages)
+        eq_(client.receive_many(10, timeout=0), [])
+
 @check_threads
 def test_two_clients():
     with nested(create_test_client(), create_test_client()) as (client_a,
@@ -120,10 +192,9 @@ def test_synchronous_connect():
         raises(FutureError)(
                 lambda: client.connect(('localhost', 1), sync=True))()
 
-@check_threads
-def test_deduplication():
-    with nested(create_mx_server_context(), create_test_client()) as (server_b,
-            client):
+def _check_deduplication(**client_kwargs):
+    with nested(create_mx_server_context(),
+            create_test_client(**client_kwargs)) as (server_b, client):
         server_a = server
 
         with timedcontext(2):
@@ -140,6 +211,19 @@ def test_deduplication():
             else:
                 eq_(first, second)
                 assert False, "duplicated message received"
+            eq_(client.stats['duplicates'], 1)
+
+@check_threads
+def test_deduplication():
+    _check_deduplication()
+
+@check_threads
+def test_deduplication_window():
+    _check_deduplication(dedup_window=60)
+
+@check_threads
+def test_deduplication_filters():
+    _check_deduplication(dedup_filters={0: RotatingBloomFilter(1000)})
 
 def _echo(client):
     msg = client.receive(timeout=5)
@@ -171,3 +255,123 @@ def test_query():
 
         with timedcontext(0.5):
             th.join()
+
+def _echo_many(client, count):
+    for i in xrange(count):
+        _echo(client)
+
+def _receive_stream(client, chunks):
+    msg = client.receive(timeout=5)
+    chunks.extend(client.receive_stream(msg, timeout=5, window=2))
+
+@check_threads
+def test_stream():
+    with nested(create_test_client(), create_test_client()) as (client_a,
+            client_b):
+        wait_all(client_a.connect(server.server_address),
+                client_b.connect(server.server_address), timeout=0.5)
+        data = ''.join(map(chr, xrange(256))) * 1000
+        chunks = []
+        th = TestThread(target=partial(_receive_stream, client_b, chunks))
+        th.setDaemon(True)
+        th.start()
+        client_a.send_stream(client_b.instance_id, 1137, [data[:1000],
+            data[1000:]], timeout=5, chunk_size=10000)
+        th.join()
+        eq_(max(map(len, chunks)), 10000)
+        eq_(''.join(chunks), data)
+
+def _receive_stream_slowly(client, chunks, close_after=None):
+    msg = client.receive(timeout=5)
+    stream = client.receive_stream(msg, timeout=5, window=2)
+    for chunk in stream:
+        chunks.append(chunk)
+        if len(chunks) == close_after:
+            stream.close()
+            break
+        time.sleep(0.05)
+
+@check_threads
+def test_stream_slow_consumer():
+    with nested(create_test_client(), create_test_client()) as (client_a,
+            client_b):
+        wait_all(client_a.connect(server.server_address),
+                client_b.connect(server.server_address), timeout=0.5)
+        chunks = []
+        th = TestThread(target=partial(_receive_stream_slowly, client_b,
+            chunks))
+        th.setDaemon(True)
+        th.start()
+        client_a.send_stream(client_b.instance_id, 1137, map(str,
+            xrange(10)), timeout=5)
+        # returns once the consumer has received the end of the stream
+        eq_(len(chunks), 10)
+        th.join()
+        # no stream message is received as a request
+        raises(OperationTimedOut)(lambda: client_a.receive(timeout=0.3))()
+
+        th = TestThread(target=partial(_receive_stream_slowly, client_b,
+            chunks, close_after=12))
+        th.setDaemon(True)
+        th.start()
+        raises(OperationFailed)(lambda: client_a.send_stream(
+            client_b.instance_id, 1137, map(str, xrange(3)), timeout=5))()
+        th.join()
+        raises(OperationTimedOut)(lambda: client_a.receive(timeout=0.3))()
+
+@check_threads
+def test_query_many():
+    with nested(create_test_client(), create_test_client()) as (client_a,
+            client_b):
+
+        with timedcontext(0.5):
+            wait_all(client_a.connect(server.server_address),
+                    client_b.connect(server.server_address), timeout=0.5)
+
+        th = TestThread(target=partial(_echo_many, client_b, 51))
+        th.setDaemon(True)
+        th.start()
+
+        with timedcontext(1.5):
+            future = client_a.query_async(fields={'to':
+                client_b.instance_id}, message='single', type=1136,
+                timeout=1)
+            futures = client_a.query_many([{'message': str(i)}
+                for i in xrange(50)], fields={'to': client_b.instance_id},
+                type=1136, timeout=1)
+            eq_(future.wait(1.5).message, 'single')
+            responses = wait_all(timeout=1.5, *futures)
+
+        eq_([response.message for response in responses],
+                [str(i) for i in xrange(50)])
+        for response in responses:
+            eq_(response.from_, client_b.instance_id)
+            eq_(response.to, client_a.instance_id)
+
+        with timedcontext(0.5):
+            th.join()
+
+@check_threads
+def test_query_async_close():
+    client = Client(type=317)
+    client.connect(server.server_address, sync=True, timeout=0.5)
+    future = client.query_async(message='', type=1136, timeout=5,
+            fields={'to': client.instance_id + 1})
+    client.close()
+    raises(OperationFailed)(future.wait)(0.5)
+    raises(OperationFailed)(client.query)(message='', type=1136, timeout=1)
+
+@check_threads
+def test_query_lost():
+    import pymx.query
+    with create_test_client() as client:
+        # the query is never finished, e.g. the IO thread has stopped
+        client._manager.query = lambda *args, **kwargs: Future()
+        margin, pymx.query.QUERY_WAIT_MARGIN = \
+                pymx.query.QUERY_WAIT_MARGIN, 0.1
+        try:
+            with timedcontext(0.5):
+                raises(OperationTimedOut)(client.query)(message='', type=0,
+                        timeout=0.1, skip_resend=True)
+        finally:
+            pymx.query.QUERY_WAIT_MARGIN = margin
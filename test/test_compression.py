@@ -0,0 +1,62 @@
+
+from nose.tools import eq_, raises
+
+from pymx.compression import CompressionPolicy, decompress_message, \
+        gzip_compress
+from pymx.message import MultiplexerMessage, Compression, MessageView, \
+        materialize
+from pymx.protobuf import make_message, DecodeError
+
+def _message(payload, type=1000):
+    return make_message(MultiplexerMessage, id=1, type=type, message=payload)
+
+def test_compress():
+    policy = CompressionPolicy(threshold=100)
+    msg = _message('x' * 1000)
+    compressed = policy.compress(msg)
+    eq_(compressed.compression, Compression.GZIP)
+    assert len(compressed.message) < 100
+    # the original message is not modified
+    eq_(msg.message, 'x' * 1000)
+    eq_(msg.compression, Compression.NO_COMPRESSION)
+    eq_(decompress_message(compressed), msg)
+
+def test_compress_skipped():
+    policy = CompressionPolicy(threshold=100, types={1001: None, 1002: 10})
+    for msg in (_message('x' * 99), _message('x' * 1000, type=1001),
+            _message(''.join(map(chr, xrange(256))))):
+        assert policy.compress(msg) is msg
+    eq_(policy.compress(_message('x' * 50, type=1002)).compression,
+            Compression.GZIP)
+
+def test_decompress_received():
+    msg = _message('abc' * 1000)
+    encoded = CompressionPolicy(threshold=0).compress(msg).SerializeToString()
+    eq_(MessageView(encoded).parse(), msg)
+    view = MessageView(encoded)
+    eq_(view.message, msg.message)
+    eq_(materialize(view), msg)
+
+def test_materialize_copies():
+    msg = CompressionPolicy(threshold=0).compress(_message('abc' * 1000))
+    eq_(materialize(msg), _message('abc' * 1000))
+    # the original message is not modified
+    eq_(msg.compression, Compression.GZIP)
+    assert len(msg.message) < 100
+
+def test_decompress_limit():
+    payload = gzip_compress('x' * 1001)
+    msg = _message(payload)
+    msg.compression = Compression.GZIP
+    eq_(decompress_message(msg, max_size=1001).message, 'x' * 1001)
+    msg.message = payload
+    msg.compression = Compression.GZIP
+    raises(DecodeError)(decompress_message)(msg, max_size=1000)
+
+def test_decompress_invalid():
+    payload = gzip_compress('x' * 1000)
+    for invalid in ('abc', payload[:len(payload) // 2], payload[:-4]):
+        msg = _message(invalid)
+        msg.compression = Compression.GZIP
+        raises(DecodeError)(decompress_message)(msg)
+        raises(DecodeError)(MessageView(msg.SerializeToString()).parse)()
@@ -5,21 +5,23 @@ import asyncore
 import socket
 from contextlib import closing, nested
 
-from pymx.connection import ConnectionsManager
+from pymx.connection import ConnectionsManager, _IncomingQueue
+from pymx.limitedset import TimedMessageIdSet
 from pymx.hacks.socket_pipe import socket_pipe
 from pymx.protocol import WelcomeMessage
-from pymx.message import MultiplexerMessage
-from pymx.channel import Channel
-from pymx.future import FutureError
+from pymx.message import MultiplexerMessage, Compression
+from pymx.channel import Channel, QueueLimits
+from pymx.exc import OutgoingQueueFull
+from pymx.future import Future, FutureError
 from pymx.protocol_constants import MessageTypes, PeerTypes
-from pymx.protobuf import make_message
-from pymx.frame import create_frame
+from pymx.protobuf import make_message, parse_message
+from pymx.frame import create_frame, BufferDeframer
 
-from nose.tools import raises, timed
+from nose.tools import eq_, raises, timed
 
 from .testlib_mxserver import SimpleMxServerThread, JmxServerThread, \
-        create_mx_server_context
-from .testlib_threads import check_threads
+        StandInMxServerThread, create_mx_server_context
+from .testlib_threads import TestThread, check_threads
 
 @check_threads
 def test_socket_pipe():
@@ -29,7 +31,7 @@ def test_socket_pipe():
     reader.setblocking(True)
     assert reader.makefile('r').read() == 'there is nothing wrong\x00.'
 
-def create_connections_manager(multiplexer_password=None):
+def create_connections_manager(multiplexer_password=None, **kwargs):
     welcome = WelcomeMessage()
     welcome.id = 547
     welcome.type = 115
@@ -40,7 +42,7 @@ def create_connections_manager(multiplexer_password=None):
     welcome_message.message = welcome.SerializeToString()
     welcome_message.type = MessageTypes.CONNECTION_WELCOME
     return ConnectionsManager(welcome_message=welcome_message,
-            multiplexer_password=multiplexer_password)
+            multiplexer_password=multiplexer_password, **kwargs)
 
 @check_threads
 def test_create_connections_manager():
@@ -78,6 +80,16 @@ def check_mx_server_context(kwargs):
         with closing(socket.socket()) as so:
             so.connect(server.server_address)
 
+@check_threads
+def test_standin_mxserver_connect():
+    with create_mx_server_context(impl=StandInMxServerThread) as server:
+        with closing(create_connections_manager()) as manager:
+            manager.connect(server.server_address).wait(timeout=1)
+            msg = make_message(MultiplexerMessage, id=5, to=547, type=0)
+            eq_(manager.send_message(msg, ConnectionsManager.ALL).wait(
+                timeout=1), 1)
+            eq_(manager.receive(timeout=1), msg)
+
 @check_threads
 def test_channel_connect():
 
@@ -90,6 +102,9 @@ def test_channel_connect():
             self.handle_connect_called = True
             channel.close()
 
+        def handle_channel_closed(self, channel):
+            pass
+
     with create_mx_server_context(impl=SimpleMxServerThread) as server:
         manager = Manager()
         Channel(manager=manager, address=server.server_address)
@@ -110,6 +125,35 @@ def test_manager_connect():
                 server.message_counters
         assert server.message_counters[2] == 1
 
+@check_threads
+def test_call_later():
+    with closing(create_connections_manager()) as manager:
+        called = []
+        manager.call_later(0.01, called.append, 1).cancel()
+        manager.call_later(0.01, called.append, 2)
+        done = Future()
+        def schedule_in_io_thread():
+            manager.call_later(0.01, called.append, 3)
+            manager.call_later(0.01, called.append, 4).cancel()
+            done.set(None)
+        manager.call_later(0, schedule_in_io_thread)
+        done.wait(1)
+        time.sleep(0.1)
+        eq_(sorted(called), [2, 3])
+
+@check_threads
+def test_dedup_window_expired():
+    pool = TimedMessageIdSet(0.1)
+    with closing(create_connections_manager(dedup_window=0.1,
+            dedup_filters={1000: pool})) as manager:
+        pools = [pool, manager._recent_messages_pool]
+        for p in pools:
+            manager.call_later(0, p.add, 1)
+        time.sleep(0.3)
+        # the IDs are released without further traffic (`len(p)` would
+        # expire the set itself)
+        eq_([sum(map(len, p._generations)) for p in pools], [0, 0])
+
 @check_threads
 def test_reconnect():
     with closing(socket.socket()) as so:
@@ -203,3 +247,169 @@ def check_channel_active_after_handshake(multiplexer_password=None):
             # so has replies, connect_future returned, connection is active
             client.send_message(msg, connection=ConnectionsManager.ONE).wait(
                     timeout=0.3)
+
+@timed(5)
+@check_threads
+def test_send_directly_keeps_order():
+    with nested(closing(socket.socket()), closing(create_connections_manager())
+            ) as (so, client):
+        so.bind(('localhost', 0))
+        so.listen(1)
+        connect_future = client.connect(so.getsockname())
+        with closing(so.accept()[0]) as so_channel:
+            _send_welcome(so_channel)
+            connect_future.wait(timeout=1)
+
+            # the first message does not fit into socket buffers, the rest is
+            # left for IO thread and following messages are queued after it
+            messages = [make_message(MultiplexerMessage, type=0, id=1,
+                message='x' * (8 * 1024 * 1024))] + [make_message(
+                    MultiplexerMessage, type=0, id=i, message=str(i))
+                    for i in xrange(2, 100)]
+            for msg in messages:
+                eq_(client.send_message(msg,
+                    connection=ConnectionsManager.ONE).wait(timeout=1), 1)
+
+            deframer = BufferDeframer()
+            received = []
+            while len(received) < len(messages):
+                assert deframer.recv_into(so_channel.recv_into, 65536)
+                for contents in deframer.pop_frames():
+                    message = parse_message(MultiplexerMessage, contents)
+                    if message.type == 0:
+                        received.append(message.id)
+            eq_(received, [msg.id for msg in messages])
+
+def _connect_raw(so, client):
+    so.bind(('localhost', 0))
+    so.listen(1)
+    connect_future = client.connect(so.getsockname())
+    so_channel = so.accept()[0]
+    _send_welcome(so_channel)
+    connect_future.wait(timeout=1)
+    return so_channel
+
+def _receive_ids(so_channel, count):
+    deframer = BufferDeframer()
+    received = []
+    while len(received) < count:
+        assert deframer.recv_into(so_channel.recv_into, 65536)
+        for contents in deframer.pop_frames():
+            message = parse_message(MultiplexerMessage, contents)
+            if message.type == 0:
+                received.append(message.id)
+    return received
+
+@timed(5)
+@check_threads
+def test_outgoing_limits_drop_oldest_keeps_io_frames():
+    limits = QueueLimits(high_frames=3, policy=QueueLimits.DROP_OLDEST)
+    with nested(closing(socket.socket()), closing(create_connections_manager(
+        outgoing_limits=limits))) as (so, client):
+        with closing(_connect_raw(so, client)) as so_channel:
+            messages = [make_message(MultiplexerMessage, type=0, id=1,
+                message='x' * (32 * 1024 * 1024))] + [make_message(
+                    MultiplexerMessage, type=0, id=i, message=str(i))
+                    for i in xrange(2, 5)]
+            client.send_message(messages[0], ConnectionsManager.ONE).wait(1)
+            # queued by IO thread, like CONNECTION_WELCOME and heartbits
+            client._send_message(messages[1], ConnectionsManager.ONE).wait(1)
+            for msg in messages[2:]:
+                client.send_message(msg, ConnectionsManager.ONE).wait(1)
+            eq_(client.stats['outgoing_dropped'], 1)
+            eq_(_receive_ids(so_channel, 3), [1, 2, 4])
+
+@timed(5)
+@check_threads
+def test_receive_malformed():
+    with nested(closing(socket.socket()), closing(
+        create_connections_manager())) as (so, client):
+        with closing(_connect_raw(so, client)) as so_channel:
+            # valid frames, the header is valid, `override_rrules` is not
+            malformed = '\x08\x0a \xe8\x07\xa2\x01\x02\x08\xff'
+            valid = [make_message(MultiplexerMessage, type=1000, id=i)
+                    for i in xrange(1, 3)]
+            so_channel.sendall(create_frame(malformed) + ''.join(
+                create_frame(msg.SerializeToString()) for msg in valid))
+            # the malformed message is dropped by the receiving thread
+            eq_(client.receive(timeout=1), valid[0])
+            eq_([msg for msg, _ in client.receive_many(10, timeout=1)],
+                    valid[1:])
+            so_channel.sendall(create_frame(malformed.replace('\x0a',
+                '\x0b', 1)))
+            time.sleep(0.1)
+            eq_(client.receive_many(10, timeout=1), [])
+            # the compressed payload is invalid
+            corrupt = make_message(MultiplexerMessage, type=1000, id=3,
+                    message='abc', compression=Compression.GZIP)
+            after = make_message(MultiplexerMessage, type=1000, id=4)
+            so_channel.sendall(''.join(create_frame(msg.SerializeToString())
+                for msg in (corrupt, after)))
+            eq_(client.receive(timeout=1), after)
+
+def test_incoming_queue_limits():
+    changes = []
+    queue = _IncomingQueue(QueueLimits(high_frames=2), changes.append)
+    for i in xrange(2):
+        queue.put({'message': make_message(MultiplexerMessage, type=0, id=i),
+            'channel': None})
+    assert queue.is_over_limit
+    # the `Queue` is unbounded
+    assert not queue.full()
+    queue.get()
+    queue.get()
+    assert not queue.is_over_limit
+    eq_(changes, [True, False])
+
+def test_outgoing_limits():
+    yield check_outgoing_limits, QueueLimits.DROP_NEWEST, [1, 2, 3, 5]
+    yield check_outgoing_limits, QueueLimits.DROP_OLDEST, [1, 3, 4, 5]
+    yield check_outgoing_limits, QueueLimits.FAIL, [1, 2, 3, 5]
+    yield check_outgoing_limits, QueueLimits.BLOCK, [1, 2, 3, 5]
+
+@timed(5)
+@check_threads
+def check_outgoing_limits(policy, expected_ids):
+    events = []
+    limits = QueueLimits(high_frames=3, low_frames=0, policy=policy,
+            timeout=0.1, callback=lambda channel, full: events.append(full))
+    with nested(closing(socket.socket()), closing(create_connections_manager(
+        outgoing_limits=limits))) as (so, client):
+        with closing(_connect_raw(so, client)) as so_channel:
+            # the first message does not fit into socket buffers
+            messages = [make_message(MultiplexerMessage, type=0, id=1,
+                message='x' * (32 * 1024 * 1024))] + [make_message(
+                    MultiplexerMessage, type=0, id=i, message=str(i))
+                    for i in xrange(2, 5)]
+            for msg in messages[:3]:
+                client.send_message(msg, ConnectionsManager.ONE).wait(1)
+            eq_(events, [True])
+            eq_(client.stats['outgoing_full'], 1)
+
+            send_future = client.send_message(messages[3],
+                    ConnectionsManager.ONE)
+            if policy in (QueueLimits.FAIL, QueueLimits.BLOCK):
+                raises(OutgoingQueueFull)(lambda: send_future.wait(1))()
+                eq_(client.stats['outgoing_rejected'], 1)
+            else:
+                eq_(send_future.wait(1), 1)
+                eq_(client.stats['outgoing_dropped'], 1)
+
+            # still full: nothing was written since
+            events[:] = []
+            blocked = TestThread(target=lambda: client.send_message(
+                make_message(MultiplexerMessage, type=0, id=5, message='5'),
+                ConnectionsManager.ONE).wait(1))
+            if policy == QueueLimits.BLOCK:
+                limits.timeout = None
+                blocked.start()
+                time.sleep(0.1)
+                assert blocked.isAlive()
+            else:
+                # let the last message in
+                limits.policy = QueueLimits.BLOCK
+                limits.timeout = None
+                blocked.start()
+            eq_(_receive_ids(so_channel, len(expected_ids)), expected_ids)
+            blocked.join(1)
+            eq_(events, [False])
@@ -1,8 +1,9 @@
 
 from nose.tools import assert_equal, assert_raises
 
-from pymx.frame import Deframer, create_frame_header, unpack_frame_contents, \
-        FrameTooShortError, FrameTooLongError, FrameCorruptedError
+from pymx.frame import Deframer, BufferDeframer, create_frame_header, \
+        unpack_frame_contents, FrameTooShortError, FrameTooLongError, \
+        FrameCorruptedError
 
 from .testlib_chop_bytes import chop_bytes
 from .testlib_random import get_random
@@ -65,17 +66,20 @@ def _unpack_contents(contents, change_length=False, change_crc=False,
     return unpack_frame_contents(length + crc + contents)
 
 def test_deframer():
-    yield check_deframer, 0, 2
-    yield check_deframer, 0, 9
-    yield check_deframer, 0, 127
-    yield check_deframer, 7, 7
-    yield check_deframer, 8, 8
-    yield check_deframer, 9, 9
-    yield check_deframer, 16, 80
-    yield check_deframer, 80, 80
-    yield check_deframer, 512, 512
-
-def check_deframer(min_chunk_length, max_chunk_length):
+    for deframer_factory in (Deframer, BufferDeframer,
+            lambda: BufferDeframer(size=1)):
+        yield check_deframer, 0, 2, deframer_factory
+        yield check_deframer, 0, 9, deframer_factory
+        yield check_deframer, 0, 127, deframer_factory
+        yield check_deframer, 7, 7, deframer_factory
+        yield check_deframer, 8, 8, deframer_factory
+        yield check_deframer, 9, 9, deframer_factory
+        yield check_deframer, 16, 80, deframer_factory
+        yield check_deframer, 80, 80, deframer_factory
+        yield check_deframer, 512, 512, deframer_factory
+
+def check_deframer(min_chunk_length, max_chunk_length,
+        deframer_factory=Deframer):
     def _genrate_chunks():
         input_bytes = ''.join(
             bytes for contents in frame_contents for bytes in
@@ -88,5 +92,79 @@ def check_deframer(min_chunk_length, max_chunk_length):
             for contents in deframer.push(chunk):
                 yield contents
 
-    deframed_contents = list(_generate_contents(Deframer()))
+    deframed_contents = list(_generate_contents(deframer_factory()))
+    assert_equal(deframed_contents, frame_contents)
+
+def test_buffer_deframer_recv_into():
+    def _genrate_chunks():
+        input_bytes = ''.join(
+            bytes for contents in frame_contents for bytes in
+                (create_frame_header(contents), contents))
+        return chop_bytes(input_bytes, min_length=1, max_length=16)
+
+    chunks = _genrate_chunks()
+    def recv_into(buffer, nbytes):
+        assert len(buffer) >= nbytes
+        chunk = next(chunks, '')
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    deframer = BufferDeframer(size=16, copy=False)
+    deframed_contents = []
+    while deframer.recv_into(recv_into, 16):
+        deframed_contents.extend(str(contents) for contents in
+                deframer.frames())
+    assert_equal(deframed_contents, frame_contents)
+    assert_equal(len(deframer), 0)
+
+def test_buffer_deframer_corrupted():
+    frame = create_frame_header('contents') + 'Contents'
+    assert_raises(FrameCorruptedError, list, BufferDeframer().push(frame))
+
+def test_buffer_deframer_corrupted_after_valid():
+    deframer = BufferDeframer()
+    assert_equal(deframer.push_many(create_frame_header('abc') + 'abc' +
+        create_frame_header('contents') + 'Contents' +
+        create_frame_header('de') + 'de'), ['abc'])
+    assert_raises(FrameCorruptedError, deframer.pop_frames)
+    # the frames following the corrupted one are not lost
+    assert_equal(deframer.pop_frames(), ['de'])
+
+def test_buffer_deframer_push_while_iterating():
+    deframer = BufferDeframer(size=16)
+    frames = deframer.push(create_frame_header('abc') + 'abc' +
+            create_frame_header('de') + 'de')
+    assert_equal(frames.next(), 'abc')
+    # the buffer is replaced with a larger one
+    deframer.push(create_frame_header('f' * 100) + 'f' * 100)
+    assert_equal(list(frames), ['de', 'f' * 100])
+    assert_equal(len(deframer), 0)
+
+def test_buffer_deframer_push_many():
+    yield check_buffer_deframer_push_many, 0, 9
+    yield check_buffer_deframer_push_many, 80, 80
+    yield check_buffer_deframer_push_many, 8192, 8192
+
+def check_buffer_deframer_push_many(min_chunk_length, max_chunk_length):
+    input_bytes = ''.join(
+        bytes for contents in frame_contents for bytes in
+            (create_frame_header(contents), contents))
+    deframer = BufferDeframer()
+    deframed_contents = []
+    for chunk in chop_bytes(input_bytes, min_length=min_chunk_length,
+            max_length=max_chunk_length):
+        deframed_contents.extend(deframer.push_many(chunk))
     assert_equal(deframed_contents, frame_contents)
+
+def test_buffer_deframer_offsets():
+    deframer = BufferDeframer()
+    assert_equal(deframer.push_many(create_frame_header('abc') + 'abc' +
+        create_frame_header('de') + 'de' + create_frame_header('fgh')),
+        ['abc', 'de'])
+    assert_equal(deframer.pop_frame_offsets(), [])
+    deframer.push('fgh') # lazy, does not pop any frame
+    offsets = deframer.pop_frame_offsets()
+    assert_equal(offsets, [(29, 3)])
+    assert_equal([str(deframer.buffer[offset:offset + length])
+        for offset, length in offsets], ['fgh'])
+    assert_equal(len(deframer), 0)
@@ -1,8 +1,9 @@
 from __future__ import with_statement
 
 from time import sleep
+from threading import Event
 
-from pymx.future import Future, FutureError
+from pymx.future import Future, FutureError, Return, run_coroutine
 
 from nose.tools import timed, eq_, raises
 
@@ -44,3 +45,80 @@ def test_future_exception():
         pass
 
     raises(FutureError)(future.wait)()
+
+def test_future_set_exception():
+    class Exc(Exception):
+        pass
+
+    future = Future()
+    future.set_exception(Exc("nic"))
+    assert future.is_error
+    raises(Exc)(future.wait)()
+
+def test_future_callbacks():
+    called = []
+    future = Future()
+    future.add_callback(called.append)
+    eq_(called, [])
+    future.set(5)
+    eq_(called, [future])
+    future.add_callback(lambda f: called.append(f.value))
+    eq_(called, [future, 5])
+
+@timed(1)
+def test_future_callbacks_threaded():
+    future = Future()
+    called = []
+    is_set, checked = future._has_value.isSet, Event()
+    def slow_is_set():
+        value = is_set()
+        checked.set()
+        sleep(0.1)
+        return value
+    # the value is set after `add_callback` checked it is not set yet
+    future._has_value.isSet = slow_is_set
+    th = TestThread(target=future.add_callback, args=(called.append,))
+    th.start()
+    checked.wait(1)
+    future._has_value.isSet = is_set
+    future.set(5)
+    th.join()
+    eq_(called, [future])
+
+def test_run_coroutine():
+    class Exc(Exception):
+        pass
+
+    first, second = Future(), Future()
+    done = Future()
+    done.set(1)
+    def coroutine():
+        eq_((yield done), 1)
+        a = yield first
+        try:
+            yield second
+        except Exc:
+            raise Return(a + 1)
+
+    result = run_coroutine(coroutine())
+    assert not result.has_value
+    first.set(6)
+    assert not result.has_value
+    second.set_exception(Exc())
+    eq_(result.wait(0), 7)
+
+def test_run_coroutine_exception():
+    class Exc(Exception):
+        pass
+
+    def coroutine():
+        yield Future()
+
+    def failing():
+        if False:
+            yield
+        raise Exc()
+
+    raises(Exc)(run_coroutine(failing()).wait)(0)
+    raises(TypeError)(run_coroutine(x for x in [5]).wait)(0)
+    assert not run_coroutine(coroutine()).has_value
@@ -0,0 +1,60 @@
+from __future__ import with_statement
+
+import socket
+from asyncore import dispatcher
+
+from nose.tools import eq_, raises
+
+from pymx.ioloop import IOLoop, backends
+
+class _Dispatcher(dispatcher):
+
+    def __init__(self, sock, map):
+        self.received = []
+        self.outgoing = ''
+        dispatcher.__init__(self, sock=sock, map=map)
+
+    def handle_read(self):
+        self.received.append(self.recv(1024))
+
+    def writable(self):
+        return bool(self.outgoing)
+
+    def handle_write(self):
+        self.outgoing = self.outgoing[self.send(self.outgoing):]
+
+def test_backends():
+    for backend in backends:
+        yield check_io_loop, backend
+
+def check_io_loop(backend):
+    io_loop = IOLoop(backend=backend)
+    eq_(io_loop.backend, backend)
+    a, b = socket.socketpair()
+    reader = _Dispatcher(a, io_loop)
+    writer = _Dispatcher(b, io_loop)
+    eq_(len(io_loop), 2)
+
+    io_loop.poll(0)
+    eq_(reader.received, [])
+
+    writer.outgoing = 'some data'
+    io_loop.poll(0)
+    eq_(writer.outgoing, 'some data') # no write interest yet
+    io_loop.update_interest(writer)
+    io_loop.poll(1)
+    eq_(writer.outgoing, '')
+    io_loop.poll(1)
+    eq_(reader.received, ['some data'])
+
+    writer.close()
+    eq_(len(io_loop), 1)
+    io_loop.poll(1)
+    eq_(reader.received, ['some data', ''])
+
+    io_loop.close()
+    eq_(len(io_loop), 0)
+
+@raises(ValueError)
+def test_unknown_backend():
+    IOLoop(backend='no such backend')
@@ -1,5 +1,10 @@
 
-from pymx.limitedset import LimitedSet
+from random import Random
+
+from nose.tools import eq_
+
+from pymx.limitedset import LimitedSet, CompactLimitedSet, TimedMessageIdSet, \
+        RotatingBloomFilter
 
 def test_limitedset():
     capacity = 10
@@ -10,3 +15,78 @@ def test_limitedset():
         assert ls.add(x), "error adding %d" % x
         assert not ls.add(x), "error adding %d" % x
     assert ls.add(1)
+
+def test_compactlimitedset():
+    capacity = 10
+    ls = CompactLimitedSet(capacity=capacity)
+    # 0 and values colliding in the hash table are stored as well
+    elements = [0, 2**64 - 1, 2**32, 1, 2**32 + 1, 2**33]
+    for x in elements:
+        assert ls.add(x), "error adding %d" % x
+        assert not ls.add(x), "error adding %d" % x
+    for x in xrange(2, 2 + capacity):
+        assert ls.add(x), "error adding %d" % x
+    eq_(len(ls), capacity)
+    for x in elements:
+        assert x not in ls, "%d not evicted" % x
+
+def test_compactlimitedset_as_limitedset():
+    rand = Random(0)
+    for capacity in (1, 2, 7, 100):
+        compact, reference = CompactLimitedSet(capacity), LimitedSet(capacity)
+        for _ in xrange(20 * capacity):
+            x = rand.choice((rand.getrandbits(64), rand.randrange(3 *
+                capacity)))
+            eq_(compact.add(x), reference.add(x))
+        eq_(len(compact), len(reference))
+        for x in xrange(3 * capacity):
+            eq_(x in compact, x in reference._elements)
+
+def test_timedmessageidset():
+    now = [0.0]
+    ts = TimedMessageIdSet(window=4, generations=4, clock=lambda: now[0])
+    assert ts.add(1)
+    now[0] = 3.5
+    assert ts.add(2)
+    assert not ts.add(1)
+    eq_(ts.duplicates, 1)
+    # 1 is forgotten after 4-5 seconds, 2 is still remembered
+    now[0] = 5
+    assert 1 not in ts
+    assert 2 in ts
+    eq_(len(ts), 1)
+    # everything is dropped after a long pause
+    now[0] = 100
+    eq_(len(ts), 0)
+    assert ts.add(2)
+
+def test_timedmessageidset_expire():
+    now = [0.0]
+    ts = TimedMessageIdSet(window=4, generations=4, clock=lambda: now[0])
+    eq_(ts.period, 1)
+    ts.add(1)
+    now[0] = 5
+    ts.expire()
+    eq_(sum(map(len, ts._generations)), 0)
+
+def test_rotatingbloomfilter():
+    rand = Random(0)
+    capacity = 1000
+    bf = RotatingBloomFilter(capacity=capacity, error_rate=0.01)
+    added = [x for x in (rand.getrandbits(64) for _ in xrange(capacity)) if
+            bf.add(x)]
+    assert len(added) > 0.98 * capacity
+    for x in added:
+        assert not bf.add(x), "false negative for %d" % x
+    eq_(bf.duplicates, len(added))
+    # the recent elements are remembered after rotation
+    recent = [x for x in xrange(capacity) if bf.add(x)]
+    for x in recent:
+        assert x in bf, "false negative for %d" % x
+    false_positives = sum(1 for _ in xrange(10000) if rand.getrandbits(64)
+            in bf)
+    assert false_positives < 200, "%d false positives" % false_positives
+    # the oldest elements are forgotten
+    for x in xrange(capacity, 2 * capacity):
+        bf.add(x)
+    assert sum(1 for x in added if x in bf) < 0.02 * capacity
@@ -3,7 +3,8 @@ from google.protobuf.message import DecodeError
 
 from nose.tools import eq_, raises
 
-from pymx.message import MultiplexerMessage
+from pymx.message import MultiplexerMessage, MessageView, materialize, \
+        materialize_received
 from pymx.protobuf import parse_message, dict_message, make_message, \
         message_getattr
 
@@ -109,3 +110,44 @@ def test_from():
 
     # Check hat the deserialized ``from`` can be read via ``from_``.
     assert parse_message(MultiplexerMessage, '\x10\x0f', partial=True).from_ == 15
+
+def test_message_view():
+    for case in encoded_messages:
+        view = MessageView(case['encoded'])
+        fields = case['pythonized']
+        for name in ('id', 'to', 'type', 'references'):
+            eq_(getattr(view, name), fields.get(name, 0))
+        eq_(view.from_, fields.get('from', 0))
+        assert view._message is None, "header access parsed the message"
+        eq_(view.message, fields.get('message', ''))
+        eq_(view.parse(), parse_message(MultiplexerMessage, case['encoded']))
+        assert materialize(view) is view.parse()
+        eq_(view.size, len(case['encoded']))
+
+def test_message_view_large_values():
+    msg = make_message(MultiplexerMessage, id=2**64 - 1, type=2**32 - 1,
+            references=2**63, message='x' * 1000, workflow='w')
+    view = MessageView(msg.SerializeToString())
+    eq_((view.id, view.type, view.references), (msg.id, msg.type,
+        msg.references))
+    eq_(view.workflow, 'w')
+
+def test_message_view_invalid():
+    # `type` is required
+    view = MessageView(make_message(MultiplexerMessage, id=1,
+        message='abc').SerializePartialToString())
+    raises(DecodeError)(lambda: view.id)()
+    eq_(materialize_received(view), None)
+    # only the header is checked before parsing
+    view = MessageView(' \x05\xa2\x01\x02\x08\xff')
+    eq_(view.type, 5)
+    raises(DecodeError)(view.parse)()
+    eq_(materialize_received(view), None)
+
+def test_message_view_truncated():
+    encoded = make_message(MultiplexerMessage, id=2**40, type=1,
+            message='abc').SerializeToString()
+    # inside the ``id`` varint and inside the ``message`` bytes
+    for truncated in (encoded[:2], encoded[:-1]):
+        view = MessageView(truncated)
+        raises(DecodeError)(lambda: view.type)()
@@ -15,10 +15,16 @@ from .testlib_encoded_messages import encoded_messages
 
 class Socket(socket.socket):
     """Dummy ``socket`` implementation -- mox doesn't deal well with built-in
-    types (mocking ``socket.socket.recv`` wasn't possible). """
-    def recv(self, bufsize):
+    types (mocking ``socket.socket.recv_into`` wasn't possible). """
+    def recv_into(self, buffer, nbytes=0):
         raise NotImplementedError
 
+def _write_chunk(chunk):
+    def _side_effect(buffer, nbytes):
+        assert len(chunk) <= nbytes
+        buffer[:len(chunk)] = chunk
+    return _side_effect
+
 def test_read_message():
 
     bufsize = 1024
@@ -32,12 +38,13 @@ def test_read_message():
     collected_chunks = []
     for chunk in chop_bytes(input_bytes, 5):
         collected_chunks.append(chunk)
-        mock_sock.recv(bufsize).AndReturn(chunk)
+        mock_sock.recv_into(mox.IgnoreArg(), bufsize).WithSideEffects(
+                _write_chunk(chunk)).AndReturn(len(chunk))
     else:
         # This does in fact test chop_bytes and nothing more.
         assert input_bytes == ''.join(collected_chunks)
 
-        mock_sock.recv(bufsize).AndReturn('')
+        mock_sock.recv_into(mox.IgnoreArg(), bufsize).AndReturn(0)
 
     mock.ReplayAll()
     channel = Channel(socket=mock_sock)
@@ -0,0 +1,125 @@
+from __future__ import absolute_import, with_statement
+
+import os
+import struct
+import threading
+from contextlib import closing, nested
+
+from nose.plugins.skip import SkipTest
+from nose.tools import eq_, raises
+
+from pymx.client import Client
+from pymx.future import Future
+from pymx.hacks.eventfd import eventfd
+from pymx.reactor import Reactor, shared_reactor
+
+from .testlib_mxserver import StandInMxServerThread, \
+        create_mx_server_context
+from .testlib_threads import check_threads
+
+@check_threads
+def test_reactor_submit():
+    reactor = Reactor()
+    future = Future()
+    assert reactor.submit(lambda: future.set(threading.currentThread()))
+    eq_(future.wait(1), reactor.thread)
+    reactor.close()
+    assert not reactor.thread.isAlive()
+    assert not reactor.submit(future.set, 1)
+    reactor.close()
+
+@check_threads
+def test_reactor_task_error():
+    reactor = Reactor()
+    def fail():
+        raise ValueError("task error")
+    future = Future()
+    reactor.submit(fail)
+    reactor.submit(lambda: reactor.io_loop.call_later(0, fail))
+    reactor.submit(lambda: reactor.io_loop.call_later(0.01, future.set, 1))
+    # the errors are reported and IO thread keeps running
+    eq_(future.wait(1), 1)
+    assert reactor.thread.isAlive()
+    reactor.close()
+
+@check_threads
+def test_reactor_submit_from_io_thread():
+    reactor = Reactor()
+    future = Future()
+    reactor.submit(reactor.submit, future.set, 1)
+    # run without waiting for the `poll` timeout
+    eq_(future.wait(1), 1)
+    reactor.close()
+
+def _ping_self(client):
+    client.send_message(client.create_message(to=client.instance_id,
+        type=0, message='ping')).wait(1)
+    eq_(client.receive(timeout=1).message, 'ping')
+
+@check_threads
+def test_shared_reactor_clients():
+    with create_mx_server_context(impl=StandInMxServerThread) as server:
+        with closing(Reactor()) as reactor:
+            threads = threading.activeCount()
+            clients = [Client(type=317, reactor=reactor) for _ in xrange(3)]
+            eq_(threading.activeCount(), threads)
+            for client in clients:
+                client.connect(server.server_address, sync=True, timeout=1)
+                _ping_self(client)
+                # each client tracks only its own channels
+                eq_(len(client._manager._channels), 1)
+
+            # closing a client closes only its channels
+            clients[0].close()
+            eq_(len(reactor.io_loop), 1 + 2)
+            eq_(len(clients[0]._manager._channels), 0)
+            for client in clients[1:]:
+                _ping_self(client)
+                client.close()
+            assert reactor.thread.isAlive()
+            eq_(len(reactor.io_loop), 1)
+
+def test_shared_reactor():
+    reactor = shared_reactor()
+    eq_(shared_reactor(), reactor)
+    reactor.close()
+    assert shared_reactor() is not reactor
+    shared_reactor().close()
+
+@check_threads
+def test_reactor_coalesced_wakeups():
+    reactor = Reactor()
+    wakeups = []
+    wakeup = reactor._wakeup
+    def counting_wakeup():
+        wakeups.append(1)
+        wakeup()
+    reactor._wakeup = counting_wakeup
+
+    blocked, release = threading.Event(), threading.Event()
+    def block():
+        blocked.set()
+        release.wait()
+    reactor.submit(block)
+    blocked.wait(1)
+    results = []
+    for i in xrange(1000):
+        reactor.submit(results.append, i)
+    # only the first task submitted while IO thread is busy wakes it up
+    eq_(len(wakeups), 2)
+    release.set()
+    reactor.close()
+    eq_(results, range(1000))
+
+def test_eventfd():
+    if eventfd is None:
+        raise SkipTest("eventfd is not available")
+    fd = eventfd()
+    try:
+        os.write(fd, struct.pack('=Q', 2))
+        os.write(fd, struct.pack('=Q', 3))
+        eq_(struct.unpack('=Q', os.read(fd, 8)), (5,))
+        # the counter is reset and the descriptor is non-blocking
+        raises(OSError)(lambda: os.read(fd, 8))()
+    finally:
+        os.close(fd)
@@ -4,7 +4,7 @@ from contextlib import closing
 
 from nose.tools import eq_, raises
 
-from pymx.scheduler import Scheduler
+from pymx.scheduler import Scheduler, TimerWheel, ExpiryBatcher
 
 def test_timer():
     l = ['a']
@@ -38,3 +38,115 @@ def test_timer_fast_close():
     scheduler.close(complete=False)
     eq_(l, [])
     raises(RuntimeError)(lambda: scheduler.schedule(0.1, l.pop, 3))()
+
+class _Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+    def __call__(self):
+        return self.now
+
+def _advance(wheel, clock, until):
+    """Runs `wheel` like an IO loop would until `until`. """
+    while True:
+        wheel.run()
+        timeout = wheel.next_timeout()
+        if timeout is None or clock.now + timeout > until:
+            clock.now = until
+            wheel.run()
+            return
+        # a bit more, as the timeout is rounded in real IO loops
+        clock.now += timeout + 1e-6
+
+def test_timer_wheel():
+    clock = _Clock()
+    wheel = TimerWheel(resolution=0.01, levels=2, clock=clock)
+    fired = []
+    def _fire(delay):
+        fired.append((delay, clock.now))
+    delays = [0, 0.005, 0.01, 0.3, 0.64, 0.65, 5, 40.95, 41, 100, 1000]
+    for delay in delays:
+        wheel.schedule(delay, _fire, delay)
+    cancelled = wheel.schedule(3, _fire, 3)
+    eq_(len(wheel), len(delays) + 1)
+    cancelled.cancel()
+    assert cancelled.cancelled
+
+    _advance(wheel, clock, 2000)
+    eq_([delay for delay, _ in fired], delays)
+    for delay, when in fired:
+        # never early, about a tick late at most
+        assert 1000 + delay <= when < 1000 + delay + 0.02, (delay, when)
+    eq_(len(wheel), 0)
+    eq_(wheel.next_timeout(), None)
+
+def test_timer_wheel_reschedule():
+    clock = _Clock()
+    wheel = TimerWheel(resolution=0.01, clock=clock)
+    fired = []
+    def _tick(n):
+        fired.append(n)
+        if n:
+            wheel.schedule(0, _tick, n - 1)
+    wheel.schedule(0, _tick, 3)
+    wheel.run()
+    eq_(fired, [3])
+    _advance(wheel, clock, clock.now + 0.1)
+    eq_(fired, [3, 2, 1, 0])
+
+def test_timer_wheel_callback_error():
+    clock = _Clock()
+    wheel = TimerWheel(resolution=0.01, clock=clock)
+    fired = []
+    def _fail():
+        raise ValueError("callback error")
+    wheel.schedule(0, fired.append, 1)
+    wheel.schedule(0, _fail)
+    wheel.schedule(0, fired.append, 2)
+    # the error is reported, the other callbacks of the slot are called
+    wheel.run()
+    eq_(fired, [1, 2])
+    eq_(len(wheel), 0)
+
+def test_timer_cancel():
+    l = []
+    with closing(Scheduler()) as scheduler:
+        a = scheduler.schedule(0.02, l.append, 'a')
+        b = scheduler.schedule(0.01, l.append, 'b')
+        eq_(len(scheduler), 2)
+        a.cancel()
+        a.cancel()
+        eq_(len(scheduler), 1)
+    eq_(l, ['b'])
+    b.cancel()
+
+def test_timer_cancel_many():
+    l = []
+    with closing(Scheduler()) as scheduler:
+        timers = [scheduler.schedule(0.05, l.append, i) for i in xrange(100)]
+        for timer in timers[::2]:
+            timer.cancel()
+        eq_(len(scheduler), 50)
+        # the heap is rebuilt when more than a half of it is cancelled
+        timers[1].cancel()
+        eq_(len(scheduler._tasks), 49)
+    eq_(l, range(3, 100, 2))
+
+def test_expiry_batcher():
+    clock = _Clock()
+    wheel = TimerWheel(resolution=0.01, clock=clock)
+    expired = []
+    batcher = ExpiryBatcher(wheel.schedule, expired.append, granularity=0.5,
+            clock=clock)
+    clock.now += 0.1
+    batcher.add(5, [1, 2])
+    clock.now += 0.2
+    batcher.add(5, [3])
+    clock.now += 0.3
+    batcher.add(5, [4])
+    eq_(len(wheel), 2)
+    _advance(wheel, clock, 1005.4)
+    eq_(expired, [])
+    _advance(wheel, clock, 1005.6)
+    eq_(expired, [[1, 2, 3]])
+    _advance(wheel, clock, 1006.1)
+    eq_(expired, [[1, 2, 3], [4]])
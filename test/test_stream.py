@@ -0,0 +1,52 @@
+
+from StringIO import StringIO
+
+from nose.tools import eq_
+from nose.plugins.skip import SkipTest
+
+from pymx.stream import iter_chunks, pack_chunk, unpack_chunk, HEADER, END, \
+        pickle_chunks, unpickle_chunks
+
+class _Message(object):
+    def __init__(self, message):
+        self.message = message
+
+def test_iter_chunks():
+    eq_(list(iter_chunks(['abc', '', 'defghij', 'k'], chunk_size=3)),
+            ['abc', 'def', 'ghi', 'j', 'k'])
+    eq_(list(iter_chunks(StringIO('abcdefg'), chunk_size=3)),
+            ['abc', 'def', 'g'])
+    eq_(list(iter_chunks(StringIO(''))), [])
+
+def test_pack_chunk():
+    eq_(len(pack_chunk(7)), HEADER.size)
+    eq_(unpack_chunk(_Message(pack_chunk(2**32 - 1, END, 'data'))),
+            (2**32 - 1, END, 'data'))
+
+def test_pickle_chunks():
+    large = 'x' * 1000
+    obj = {'large': large, 'again': [large, 'small', 1.5], 'other': 'y' * 500}
+    chunks = list(pickle_chunks(obj, chunk_size=300, threshold=500))
+    # the pickle and 4 + 2 chunks of the two large strings
+    eq_(len(chunks), 7)
+    assert max(map(len, chunks[1:])) <= 300
+    loaded = unpickle_chunks(chunks)
+    eq_(loaded, obj)
+    assert loaded['large'] is loaded['again'][0]
+    # chunks may be split differently when received
+    eq_(unpickle_chunks(iter_chunks(chunks, chunk_size=7)), obj)
+
+def test_pickle_chunks_ndarray():
+    try:
+        import numpy
+    except ImportError:
+        raise SkipTest("numpy is not available")
+    array = numpy.arange(10000, dtype=numpy.float64).reshape(100, 100)
+    obj = (array, array[:, 1], numpy.zeros(3))
+    chunks = list(pickle_chunks(obj, chunk_size=3000, threshold=100))
+    # the pickle and the chunks of the contiguous large array only
+    eq_(len(chunks), 1 + (array.nbytes + 2999) // 3000)
+    loaded = unpickle_chunks(iter_chunks(chunks, chunk_size=1000))
+    for expected, value in zip(obj, loaded):
+        eq_(value.dtype, expected.dtype)
+        assert (value == expected).all()
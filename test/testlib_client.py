@@ -7,5 +7,5 @@ from pymx.client import Client
 from .test_constants import PeerTypes as TestPeerTypes
 
 @nottest
-def create_test_client(type=TestPeerTypes.TEST_CLIENT):
-    return closing(Client(type=type))
+def create_test_client(type=TestPeerTypes.TEST_CLIENT, **kwargs):
+    return closing(Client(type=type, **kwargs))
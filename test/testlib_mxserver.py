@@ -8,13 +8,18 @@ import time
 from threading import RLock
 import subprocess
 import contextlib
+import select
+from random import randint
 
 from pkg_resources import resource_filename
 from distutils.spawn import find_executable
 
-from pymx.frame import Deframer
-from pymx.protobuf import parse_message
+from pymx.frame import Deframer, create_frame
+from pymx.protobuf import parse_message, make_message
 from pymx.message import MultiplexerMessage
+from pymx.protocol import WelcomeMessage, BackendForPacketSearch, \
+        DeliveryError
+from pymx.protocol_constants import MessageTypes, PeerTypes
 from pymx.hacks.popen import terminate
 from .testlib_threads import TestThread
 
@@ -118,6 +123,120 @@ class SimpleMxServerThread(_ThreadEnabledServerMixin, object):
                 message = parse_message(MultiplexerMessage, contents)
                 return message
 
+class StandInMxServerThread(_ThreadEnabledServerMixin, object):
+
+    """A minimal Multiplexer server implemented in Python. It performs the
+    CONNECTION_WELCOME handshake and routes messages by ``to`` or by the
+    ``routes`` dict mapping message type to peer type (delivering to any
+    peer of that type). Not routable messages are answered with
+    DELIVERY_ERROR. """
+
+    def __init__(self, routes=None):
+        object.__init__(self)
+        _ThreadEnabledServerMixin.__init__(self)
+
+        self.routes = dict(routes or {})
+        self.message_counters = {}
+        self.received_bytes = 0
+        self._lock = RLock()
+        self._sock = socket.socket()
+        self._sock.bind(('localhost', 0))
+        self._sock.listen(64)
+        self.server_address = self._sock.getsockname()
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._shutdown_called = False
+        self._instance_id = randint(1, 2 ** 63)
+        self._peers = {} # socket -> (deframer, peer id, peer type)
+
+    def _run(self):
+        try:
+            while True:
+                with self._lock:
+                    if self._shutdown_called:
+                        break
+                readable, _, _ = select.select([self._sock,
+                    self._wakeup_reader] + self._peers.keys(), [], [])
+                for sock in readable:
+                    if sock is self._sock:
+                        self._accept()
+                    elif sock is not self._wakeup_reader:
+                        self._read(sock)
+        finally:
+            for sock in self._peers.keys() + [self._sock,
+                    self._wakeup_reader, self._wakeup_writer]:
+                sock.close()
+
+    def _accept(self):
+        client, _ = self._sock.accept()
+        self._peers[client] = (Deframer(), None, None)
+        welcome = make_message(WelcomeMessage, type=PeerTypes.MULTIPLEXER,
+                id=self._instance_id)
+        self._send(client, make_message(MultiplexerMessage,
+            id=randint(1, 2 ** 63), from_=self._instance_id,
+            type=MessageTypes.CONNECTION_WELCOME,
+            message=welcome.SerializeToString()))
+
+    def _read(self, sock):
+        try:
+            chunk = sock.recv(65536)
+        except socket.error:
+            chunk = ''
+        if not chunk:
+            del self._peers[sock]
+            sock.close()
+            return
+        self.received_bytes += len(chunk)
+        deframer = self._peers[sock][0]
+        for contents in deframer.push(chunk):
+            self._handle(sock, parse_message(MultiplexerMessage, contents))
+
+    def _handle(self, sock, message):
+        with self._lock:
+            self.message_counters[message.type] = \
+                    self.message_counters.get(message.type, 0) + 1
+        if message.type == MessageTypes.CONNECTION_WELCOME:
+            welcome = parse_message(WelcomeMessage, message.message)
+            self._peers[sock] = (self._peers[sock][0], welcome.id,
+                    welcome.type)
+        elif message.type == MessageTypes.HEARTBIT:
+            pass
+        elif message.to:
+            self._deliver(sock, message, lambda (_, id, type):
+                    id == message.to)
+        else:
+            type = message.type
+            if type == MessageTypes.BACKEND_FOR_PACKET_SEARCH:
+                type = parse_message(BackendForPacketSearch,
+                        message.message).packet_type
+            if type in self.routes:
+                self._deliver(sock, message, lambda (_, id, peer_type):
+                        peer_type == self.routes[type])
+
+    def _deliver(self, source, message, accept_peer):
+        for sock, peer in self._peers.items():
+            if accept_peer(peer):
+                self._send(sock, message)
+                return
+        error = make_message(DeliveryError, packet_id=message.id,
+                failed_to=message.to or None)
+        self._send(source, make_message(MultiplexerMessage,
+            id=randint(1, 2 ** 63), from_=self._instance_id,
+            to=message.from_, references=message.id,
+            type=MessageTypes.DELIVERY_ERROR,
+            message=error.SerializeToString()))
+
+    def _send(self, sock, message):
+        try:
+            sock.sendall(create_frame(message.SerializeToString()))
+        except socket.error:
+            pass
+
+    def _shutdown(self):
+        with self._lock:
+            self._shutdown_called = True
+        self._wakeup_writer.send('x')
+
+
 class _SubprocessPseudoThread(object):
     def __init__(self, subproc):
         object.__init__(self)
@@ -199,5 +318,5 @@ class JmxServerThread(_ThreadEnabledServerMixin, object):
     def _shutdown(self):
         terminate(self.subproc)
 
-def create_mx_server_context(impl=JmxServerThread):
-    return contextlib.closing(impl.run_threaded())
+def create_mx_server_context(impl=JmxServerThread, *args, **kwargs):
+    return contextlib.closing(impl.run_threaded(*args, **kwargs))